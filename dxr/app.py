@@ -1,41 +1,81 @@
 from cStringIO import StringIO
 from datetime import datetime
-from functools import partial
-from itertools import chain, izip
+from functools import partial, wraps
+from hashlib import sha1
+from itertools import chain, imap, izip
+import json
 from logging import StreamHandler
 import os
-from os.path import join, basename, split, dirname
+from os.path import join, basename, split, dirname, isfile, relpath
 from sys import stderr
 from mimetypes import guess_type
 
 from flask import (Blueprint, Flask, current_app, send_file, request, redirect,
-                   jsonify, render_template, url_for)
-from funcy import merge
-from pyelasticsearch import ElasticSearch
+                   jsonify, render_template, url_for, Response,
+                   stream_with_context)
+from funcy import memoize, merge
 from werkzeug.exceptions import NotFound
-
-from dxr.es import (filtered_query, frozen_config, frozen_configs,
-                    es_alias_or_not_found)
+from werkzeug.http import is_resource_modified, parse_date, quote_etag
+from werkzeug.local import LocalProxy
+from werkzeug.utils import cached_property
+
+from dxr.compression import accepts_gzip, compress_response, gunzipped
+from dxr.config import FORMAT
+from dxr.es import (CatalogCache, connect, filtered_query,
+                    filtered_query_pages, frozen_config, frozen_configs,
+                    es_alias_or_not_found, multi_search, scroll_pages)
 from dxr.exceptions import BadTerm
 from dxr.filters import FILE, LINE
-from dxr.lines import html_line, tags_per_line, finished_tags, Ref, Region
+from dxr.lines import (html_line, tags_per_line, finished_tags, Ref,
+                       RefTable, Region)
 from dxr.mime import icon, is_binary_image, is_textual_image, decode_data
 from dxr.plugins import plugins_named
 from dxr.query import Query, filter_menu_items
+from dxr.render_cache import RenderCache
 from dxr.utils import (non_negative_int, decode_es_datetime, DXR_BLUEPRINT,
                        format_number, append_by_line, build_offset_map,
-                       split_content_lines)
+                       split_content_lines, LruCache)
 from dxr.vcs import file_contents_at_rev
 
+
+class PrecompressedStaticsBlueprint(Blueprint):
+    """A Blueprint which sends clients that take gzip the gzipped copies of
+    static files that ``make static`` leaves alongside them, rather than
+    compressing them anew for each request"""
+
+    def send_static_file(self, filename):
+        gzipped_name = filename + '.gz'
+        if accepts_gzip() and isfile(join(self.static_folder, gzipped_name)):
+            response = super(PrecompressedStaticsBlueprint,
+                             self).send_static_file(gzipped_name)
+            response.mimetype = guess_type(filename)[0]
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = super(PrecompressedStaticsBlueprint,
+                             self).send_static_file(filename)
+        response.vary.add('Accept-Encoding')
+        return response
+
+
 # Look in the 'dxr' package for static files, etc.:
-dxr_blueprint = Blueprint(DXR_BLUEPRINT,
-                          'dxr',
-                          template_folder='templates',
-                          # static_folder seems to register a "static" route
-                          # with the blueprint so the url_prefix (set later)
-                          # takes effect for static files when found through
-                          # url_for('static', ...).
-                          static_folder='static')
+dxr_blueprint = PrecompressedStaticsBlueprint(
+    DXR_BLUEPRINT,
+    'dxr',
+    template_folder='templates',
+    # static_folder seems to register a "static" route with the blueprint so
+    # the url_prefix (set later) takes effect for static files when found
+    # through url_for('static', ...).
+    static_folder='static')
+
+# How many LINE docs to fetch from ES at a time when showing a file:
+LINE_PAGE_SIZE = 2000
+
+# How many FILE docs to fetch from ES at a time when showing a folder:
+FOLDER_PAGE_SIZE = 1000
+
+# How many template chunks (roughly, lines) to send per write when streaming a
+# page:
+STREAM_CHUNKS_PER_WRITE = 100
 
 
 class HashedStatics(object):
@@ -94,7 +134,8 @@ def make_app(config):
     Also set up the static and template folder.
 
     """
-    app = Flask('dxr')
+    # Leave static files to the blueprint, which can send precompressed ones:
+    app = Flask('dxr', static_folder=None)
     app.dxr_config = config
     app.register_blueprint(dxr_blueprint, url_prefix=config.www_root)
     HashedStatics(app=app)
@@ -107,18 +148,130 @@ def make_app(config):
     app.logger.addHandler(StreamHandler(stderr))
 
     # Make an ES connection pool shared among all threads:
-    app.es = ElasticSearch(config.es_hosts)
+    app.es = connect(config.es_hosts)
+    app.catalog_cache = CatalogCache(config.catalog_cache_seconds)
+    app.render_cache = (RenderCache(config.render_cache_folder) if
+                        config.render_cache_folder else None)
+    app.search_cache = LruCache(config.search_cache_size)
+    app.query_cache = LruCache(config.query_cache_size)
+    app.tree_menu = None, []
+    app.page_version = _page_version(config)
+
+    app.after_request(partial(compress_response,
+                              min_size=config.gzip_min_bytes))
 
     return app
 
 
+@memoize
+def _code_hash():
+    """Return a hash of DXR's Python code, templates, and static-asset
+    manifest, which, along with the index, determine how pages come out."""
+    hasher = sha1()
+    package = dirname(__file__)
+    for folder, folders, files in os.walk(package):
+        folders.sort()
+        for name in sorted(files):
+            if name.endswith(('.py', '.html')) or name == 'static_manifest':
+                path = join(folder, name)
+                hasher.update(relpath(path, package))
+                with open(path, 'rb') as file:
+                    hasher.update(file.read())
+    return hasher.hexdigest()
+
+
+def _page_version(config):
+    """Return a hash of everything besides the deployed indices that goes
+    into rendering a page: DXR's code and the config options pages reflect.
+
+    Cached renderings and ETags include it, so they go stale when DXR is
+    upgraded or reconfigured.
+
+    """
+    def plugin_options(tree):
+        return [(p.name, tree._section.get(p.name))
+                for p in tree.enabled_plugins]
+
+    return sha1(json.dumps(
+        [_code_hash(),
+         config.www_root,
+         config.google_analytics_key,
+         [(name, plugin_options(tree))
+          for name, tree in config.trees.iteritems()]],
+        sort_keys=True,
+        # Plugin options may hold things like compiled regexes:
+        default=lambda o: getattr(o, 'pattern', repr(o)))).hexdigest()
+
+
+def _http_cached(*vary):
+    """Decorate a view of a tree's index to support conditional requests.
+
+    Such a view's output depends on nothing but the request and the deployed
+    indices, which never change once built--and on the code and config
+    rendering it. So its responses get an ETag derived from the tree's
+    index, the catalog generation, and the page version (weak, since it's
+    shared by gzipped and plain copies of a page), a Last-Modified of the
+    newest tree's ``generated_date``, and a Cache-Control which lets proxies
+    store them. A request whose validators still match gets a 304 without
+    the view running at all. Since any response may be gzipped on the way
+    out, all of them vary on Accept-Encoding.
+
+    :arg vary: The names of request headers, other than the URL, which the
+        view's output depends on
+
+    """
+    def decorator(view):
+        @wraps(view)
+        def cached_view(tree, *args, **kwargs):
+            index = frozen_config(tree).get('es_index')
+            if index is None:  # The catalog predates es_index.
+                return view(tree, *args, **kwargs)
+            generation = current_app.catalog_cache.generation()
+            etag = sha1(repr((FORMAT,
+                              index,
+                              generation,
+                              current_app.page_version,
+                              [request.headers.get(h) for h in vary]))
+                        ).hexdigest()
+            dates = filter(None, (parse_date(date) for _, date in generation))
+            last_modified = max(dates) if dates else None
+            if is_resource_modified(request.environ,
+                                    quote_etag(etag, weak=True),
+                                    last_modified=last_modified):
+                response = current_app.make_response(
+                    view(tree, *args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            else:
+                response = current_app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            response.cache_control.public = True
+            response.cache_control.max_age = \
+                current_app.dxr_config.http_cache_seconds
+            response.vary.update(vary)
+            response.vary.add('Accept-Encoding')
+            return response
+        return cached_view
+    return decorator
+
+
 @dxr_blueprint.route('/')
 def index():
     return redirect(url_for('.browse',
                             tree=current_app.dxr_config.default_tree))
 
 
+@dxr_blueprint.route('/stats')
+def stats():
+    """Return JSON describing how well this process's in-memory caches are
+    doing, for operators tuning their sizes."""
+    return jsonify({'query_cache': current_app.query_cache.stats(),
+                    'search_cache': current_app.search_cache.stats()})
+
+
 @dxr_blueprint.route('/<tree>/search')
+@_http_cached('Accept')
 def search(tree):
     """Normalize params, and dispatch between JSON- and HTML-returning
     searches, based on Accept header.
@@ -136,7 +289,19 @@ def search(tree):
     query = Query(partial(current_app.es.search,
                           index=frozen['es_alias']),
                   query_text,
-                  plugins_named(frozen['enabled_plugins']))
+                  plugins_named(frozen['enabled_plugins']),
+                  partial(multi_search,
+                          current_app.es,
+                          index=frozen['es_alias']),
+                  # Catalogs from before es_index can't key a cache:
+                  results_cache=(current_app.search_cache if
+                                 frozen.get('es_index') else None),
+                  cache_key=frozen.get('es_index'),
+                  verify_natively=config.regex_verification == 'python',
+                  parse_cache=current_app.query_cache,
+                  es_scroll=partial(scroll_pages,
+                                    current_app.es,
+                                    index=frozen['es_alias']))
 
     # Fire off one of the two search routines:
     searcher = _search_json if _request_wants_json() else _search_html
@@ -157,26 +322,38 @@ def _search_json(query, tree, query_text, offset, limit, config):
           a bubble indicating as much.
     We only redirect to a direct/unique result if the original query contained a
     'redirect=true' parameter, which the user can elicit by hitting enter on the query
-    input."""
-
-    # If we're asked to redirect and have a direct hit, then return the url to that.
-    if request.values.get('redirect') == 'true':
-        result = query.direct_result()
-        if result:
-            path, line = result
-            # TODO: Does this escape query_text properly?
-            params = {
-                'tree': tree,
-                'path': path,
-                'q': query_text,
-                'redirect_type': 'direct'
-            }
-            return jsonify({'redirect': url_for('.browse', _anchor=line, **params)})
+    input.
+
+    'explain=true' returns {plan: how the search would be run} instead, for
+    tuning the query planner."""
+
+    should_redirect = request.values.get('redirect') == 'true'
     try:
-        count_and_results = query.results(offset, limit)
+        if request.values.get('explain') == 'true':
+            # Show how we'd search rather than searching:
+            return jsonify({'plan': query.plan(offset, limit)})
+        if should_redirect:
+            # Look for a direct hit and do the normal search at the same
+            # time, so hitting enter costs a single round trip:
+            result, count_and_results = query.direct_result_or_results(
+                offset, limit)
+            # If we have a direct hit, then return the url to that.
+            if result:
+                path, line = result
+                # TODO: Does this escape query_text properly?
+                params = {
+                    'tree': tree,
+                    'path': path,
+                    'q': query_text,
+                    'redirect_type': 'direct'
+                }
+                return jsonify({'redirect': url_for('.browse', _anchor=line, **params)})
+        else:
+            count_and_results = query.results(offset, limit)
         # If we're asked to redirect and there's a single result, redirect to the result.
-        if (request.values.get('redirect') == 'true' and
-            count_and_results['result_count'] == 1):
+        if (should_redirect and
+            count_and_results['result_count'] == 1 and
+            not count_and_results['result_count_approximate']):
             _, path, line = next(count_and_results['results'])
             line = line[0][0] if line else None
             params = {
@@ -199,7 +376,12 @@ def _search_json(query, tree, query_text, offset, limit, config):
         'tree': tree,
         'results': results,
         'result_count': count_and_results['result_count'],
-        'result_count_formatted': format_number(count_and_results['result_count']),
+        'result_count_approximate':
+            count_and_results['result_count_approximate'],
+        # An upper bound, when native regex verification stopped early:
+        'result_count_formatted':
+            ('up to ' if count_and_results['result_count_approximate']
+             else '') + format_number(count_and_results['result_count']),
         'tree_tuples': _tree_tuples('.search', q=query_text)})
 
 
@@ -230,17 +412,32 @@ def _search_html(query, tree, query_text, offset, limit, config):
 
 def _tree_tuples(endpoint, **kwargs):
     """Return a list of rendering info for Switch Tree menu items."""
-    return [(f['name'],
-             url_for(endpoint,
-                     tree=f['name'],
-                     **kwargs),
-             f['description'],
-             [(lang, color) for p in plugins_named(f['enabled_plugins'])
-              for lang, color in sorted(p.badge_colors.iteritems())])
-            for f in frozen_configs()]
+    return [(name, url_for(endpoint, tree=name, **kwargs), description, badges)
+            for name, description, badges in _tree_menu()]
+
+
+def _tree_menu():
+    """Return a (name, description, badges) tuple for each tree, for the
+    Switch Tree menu.
+
+    Every page draws the menu, and badges mean looking up every tree's
+    plugins, so we work it out only once per catalog generation.
+
+    """
+    generation = current_app.catalog_cache.generation()
+    menu_generation, menu = current_app.tree_menu
+    if menu_generation != generation:
+        menu = [(f['name'],
+                 f['description'],
+                 [(lang, color) for p in plugins_named(f['enabled_plugins'])
+                  for lang, color in sorted(p.badge_colors.iteritems())])
+                for f in frozen_configs()]
+        current_app.tree_menu = generation, menu
+    return menu
 
 
 @dxr_blueprint.route('/<tree>/raw/<path:path>')
+@_http_cached()
 def raw(tree, path):
     """Send raw data at path from tree, for binary things like images."""
     if not is_binary_image(path) and not is_textual_image(path):
@@ -284,6 +481,7 @@ def raw_rev(tree, revision, path):
 
 
 @dxr_blueprint.route('/<tree>/lines/')
+@_http_cached()
 def lines(tree):
     """Return lines start:end of path in tree, where start, end, path are URL params.
     """
@@ -316,6 +514,7 @@ def lines(tree):
 
 @dxr_blueprint.route('/<tree>/source/')
 @dxr_blueprint.route('/<tree>/source/<path:path>')
+@_http_cached()
 def browse(tree, path=''):
     """Show a directory listing or a single file from one of the trees.
 
@@ -323,6 +522,9 @@ def browse(tree, path=''):
 
     """
     config = current_app.dxr_config
+    cached = _cached_file_page(tree, path)
+    if cached is not None:
+        return cached
     try:
         # Strip any trailing slash because we do not store it in ES.
         return _browse_folder(tree, path.rstrip('/'), config)
@@ -334,7 +536,8 @@ def browse(tree, path=''):
             FILE,
             filter={'path': path},
             size=1,
-            include=['link', 'links', 'is_binary'])
+            include=['link', 'links', 'is_binary', 'ref_payloads',
+                     'line_count'])
         if not files:
             raise NotFound
         file_doc = files[0]
@@ -342,21 +545,78 @@ def browse(tree, path=''):
             # Then this path is a symlink, so redirect to the real thing.
             return redirect(url_for('.browse', tree=tree, path=file_doc['link'][0]))
 
-        lines = filtered_query(
+        # Fetch the lines a page at a time, once the page gets to them:
+        lines = imap(_dereffed_line, filtered_query_pages(
             frozen['es_alias'],
             LINE,
             filter={'path': path},
-            sort=['number'],
-            size=1000000,
-            include=['content', 'refs', 'regions', 'annotations'])
-        # Deref the content field in each document. We can do this because we
-        # do not store empty lines in ES.
-        for doc in lines:
-            doc['content'] = doc['content'][0]
+            key='number',
+            size=LINE_PAGE_SIZE,
+            include=['content', 'packed_refs', 'refs', 'regions',
+                     'annotations']))
+
+        response = _browse_file(tree, path, lines, file_doc, config,
+                                file_doc.get('is_binary', [False])[0],
+                                frozen['generated_date'])
+        _cache_file_page(tree, path, response)
+        return response
+
+
+def _dereffed_line(doc):
+    """Deref the content field of a LINE doc. We can do this because we do
+    not store empty lines in ES."""
+    doc['content'] = doc['content'][0]
+    return doc
+
 
-        return _browse_file(tree, path, lines, file_doc, config,
-                            file_doc.get('is_binary', [False])[0],
-                            frozen['generated_date'])
+def _render_cache_address(tree, path):
+    """Return the (index, key) under which the rendered page for a file is
+    cached, or None if it shouldn't be.
+
+    Pages for searches' redirects have per-request bits in them, so they
+    aren't cached. The key includes the catalog generation, since the page
+    lists the other trees in its Switch Tree menu, and the page version, so
+    pages rendered by other code or config aren't served.
+
+    """
+    if (current_app.render_cache is None or
+            request.args.get('q') or request.args.get('redirect_type')):
+        return None
+    index = frozen_config(tree).get('es_index')
+    if index is None:  # The catalog predates es_index.
+        return None
+    return index, repr((path,
+                        current_app.catalog_cache.generation(),
+                        current_app.page_version))
+
+
+def _cached_file_page(tree, path):
+    """Return a response bearing the cached rendering of a file view, or
+    None.
+
+    Pages are cached gzipped, so clients that take gzip get them as they are.
+
+    """
+    address = _render_cache_address(tree, path)
+    if address:
+        html = current_app.render_cache.get_gzipped(tree, *address)
+        if html is not None:
+            if accepts_gzip():
+                response = Response(html, mimetype='text/html')
+                response.headers['Content-Encoding'] = 'gzip'
+            else:
+                response = Response(gunzipped(html), mimetype='text/html')
+            response.vary.add('Accept-Encoding')
+            return response
+
+
+def _cache_file_page(tree, path, response):
+    """Arrange for the streamed rendering of a file view to be remembered as
+    it's sent, if it's cacheable."""
+    address = _render_cache_address(tree, path)
+    if address:
+        response.response = current_app.render_cache.tee(
+            tree, address[0], address[1], response.response)
 
 
 def concat_plugin_headers(plugin_list):
@@ -389,14 +649,19 @@ def _browse_folder(tree, path, config):
     frozen = frozen_config(tree)
 
     plugin_headers = concat_plugin_headers(plugins_named(frozen['enabled_plugins']))
-    files_and_folders = filtered_query(
-        frozen['es_alias'],
-        FILE,
-        filter={'folder': path},
-        sort=[{'is_folder': 'desc'}, 'name'],
-        size=1000000,
-        include=['name', 'modified', 'size', 'link', 'path', 'is_binary',
-                 'is_folder'] + plugin_headers)
+    # Page through the folder's contents by name, which is unique within a
+    # folder. Then move the subfolders to the top, keeping them and the files
+    # in name order.
+    files_and_folders = sorted(
+        filtered_query_pages(
+            frozen['es_alias'],
+            FILE,
+            filter={'folder': path},
+            key='name',
+            size=FOLDER_PAGE_SIZE,
+            include=['name', 'modified', 'size', 'link', 'path', 'is_binary',
+                     'is_folder'] + plugin_headers),
+        key=lambda doc: not item_or_list(doc['is_folder']))
 
     if not files_and_folders:
         raise NotFound
@@ -471,12 +736,14 @@ def _build_common_file_template(tree, path, is_binary, date, config):
 
 def _browse_file(tree, path, line_docs, file_doc, config, is_binary,
                  date=None, contents=None, image_rev=None):
-    """Return a rendered page displaying a source file.
+    """Return a response which streams a rendered page displaying a source
+    file.
 
     :arg string tree: name of tree on which file is found
     :arg string path: relative path from tree root of file
-    :arg list line_docs: LINE documents as defined in the mapping of core.py,
-        where the `content` field is dereferenced
+    :arg line_docs: An iterable of LINE documents as defined in the mapping of
+        core.py, sorted by line number, where the `content` field is
+        dereferenced. It isn't consumed until the page gets to the lines.
     :arg file_doc: the FILE document as defined in core.py
     :arg config: TreeConfig object of this tree
     :arg is_binary: Whether file is binary or not
@@ -516,26 +783,21 @@ def _browse_file(tree, path, line_docs, file_doc, config, is_binary,
     common = _build_common_file_template(tree, path, is_binary, date, config)
     links = file_doc.get('links', [])
     if is_binary_image(path):
-        return render_template(
+        return _stream_template(
             'image_file.html',
             **merge(common, {
                 'sections': sidebar_links(links),
                 'revision': image_rev}))
     elif is_binary:
-        return render_template(
+        return _stream_template(
             'text_file.html',
             **merge(common, {
                 'lines': [],
+                'line_count': 0,
+                'annotation_sets': [],
                 'is_binary': True,
                 'sections': sidebar_links(links)}))
     else:
-        # We concretize the lines into a list because we iterate over it multiple times
-        lines = [doc['content'] for doc in line_docs]
-        if not contents:
-            # If contents are not provided, we can reconstruct them by
-            # stitching the lines together.
-            contents = ''.join(lines)
-        offsets = build_offset_map(lines)
         tree_config = config.trees[tree]
         if is_textual_image(path) and image_rev:
             # Add a link to view textual images on revs:
@@ -546,39 +808,164 @@ def _browse_file(tree, path, line_docs, file_doc, config, is_binary,
                                               tree=tree_config.name,
                                               path=path,
                                               revision=image_rev))])]))
+        file_lines = _FileLines(path, line_docs, file_doc, tree_config,
+                                contents)
+        return _stream_template(
+            'text_file.html',
+            **merge(common, {
+                # The template makes a single pass over the lines, pulling
+                # each one through markup as it goes:
+                'lines': file_lines,
+                'line_count': LocalProxy(lambda: file_lines.count),
+                'annotation_sets': file_lines.annotation_sets,
+                'sections': LocalProxy(
+                    lambda: sidebar_links(links + file_lines.links)),
+                'query': request.args.get('q', ''),
+                'bubble': request.args.get('redirect_type')}))
+
+
+class _FileLines(object):
+    """The marked-up lines of a source file, along with what skimming it
+    turns up
+
+    Nothing is fetched or skimmed until the template first asks for it, so
+    the top of the page can go out in the meantime. After that, lines are
+    marked up one at a time as the template iterates over them, rather than
+    all being built up in RAM first. Skimmers see the whole file at once, so,
+    if any might have something to say, all the lines are fetched before the
+    first is marked up. Otherwise, each is fetched only as it's reached.
+
+    :ivar annotation_sets: The annotations of each line iterated over so far
+
+    """
+    def __init__(self, path, line_docs, file_doc, tree_config, contents=None):
+        """
+        :arg line_docs: An iterable of LINE docs, sorted by line number, with
+            their ``content`` fields dereferenced
+        :arg contents: The contents of the file, defaulting to the joined
+            ``content`` of the line docs
+
+        """
+        self._path = path
+        self._line_docs = line_docs
+        self._file_doc = file_doc
+        self._tree_config = tree_config
+        self._contents = contents
+        self.annotation_sets = []
+        self._skims = any(
+            plugin.file_to_skim and
+            not (file_doc and plugin.file_to_skim.unindexed_only)
+            for plugin in tree_config.enabled_plugins)
+
+    @cached_property
+    def _skimmed(self):
+        """Fetch the lines, run the skimmers, and work out the tags."""
+        line_docs = list(self._line_docs)
+        lines = [doc['content'] for doc in line_docs]
+        # If contents are not provided, we can reconstruct them by stitching
+        # the lines together.
+        contents = self._contents or ''.join(lines)
         # Construct skimmer objects for all enabled plugins that define a
         # file_to_skim class.
-        skimmers = [plugin.file_to_skim(path,
+        skimmers = [plugin.file_to_skim(self._path,
                                         contents,
                                         plugin.name,
-                                        tree_config,
-                                        file_doc,
+                                        self._tree_config,
+                                        self._file_doc,
                                         line_docs)
-                    for plugin in tree_config.enabled_plugins
+                    for plugin in self._tree_config.enabled_plugins
                     if plugin.file_to_skim]
-        skim_links, refses, regionses, annotationses = skim_file(skimmers, len(line_docs))
-        index_refs = (Ref.es_to_triple(ref, tree_config) for ref in
-                      chain.from_iterable(doc.get('refs', [])
-                                          for doc in line_docs))
+        links, refses, regionses, annotationses = skim_file(skimmers,
+                                                             len(line_docs))
+        if 'ref_payloads' in self._file_doc:
+            index_refs = RefTable.es_to_triples(
+                (doc.get('packed_refs', []) for doc in line_docs),
+                self._file_doc['ref_payloads'],
+                self._tree_config)
+        else:  # an index from before refs were packed
+            index_refs = (Ref.es_to_triple(ref, self._tree_config) for ref in
+                          chain.from_iterable(doc.get('refs', [])
+                                              for doc in line_docs))
         index_regions = (Region.es_to_triple(region) for region in
                          chain.from_iterable(doc.get('regions', [])
                                              for doc in line_docs))
         tags = finished_tags(lines,
                              chain(chain.from_iterable(refses), index_refs),
-                             chain(chain.from_iterable(regionses), index_regions))
-        return render_template(
-            'text_file.html',
-            **merge(common, {
-                # Someday, it would be great to stream this and not concretize
-                # the whole thing in RAM. The template will have to quit
-                # looping through the whole thing 3 times.
-                'lines': [(html_line(doc['content'], tags_in_line, offset),
-                           doc.get('annotations', []) + skim_annotations)
-                          for doc, tags_in_line, offset, skim_annotations
-                              in izip(line_docs, tags_per_line(tags), offsets, annotationses)],
-                'sections': sidebar_links(links + skim_links),
-                'query': request.args.get('q', ''),
-                'bubble': request.args.get('redirect_type')}))
+                             chain(chain.from_iterable(regionses),
+                                   index_regions))
+        return line_docs, links, tags, annotationses
+
+    @property
+    def count(self):
+        if self._skims:
+            return len(self._skimmed[0])
+        if 'line_count' in self._file_doc:
+            return self._file_doc['line_count']
+        # An index from before line_count, or a file from version control:
+        self._line_docs = list(self._line_docs)
+        return len(self._line_docs)
+
+    @property
+    def links(self):
+        """Return the sidebar links contributed by skimmers."""
+        return self._skimmed[1] if self._skims else []
+
+    def __iter__(self):
+        """Yield a line of Markup at a time, noting its annotations in
+        :attr:`annotation_sets`."""
+        if not self._skims:
+            for line in self._unskimmed_lines():
+                yield line
+            return
+        line_docs, _, tags, annotationses = self._skimmed
+        offsets = build_offset_map(doc['content'] for doc in line_docs)
+        for doc, tags_in_line, offset, skim_annotations in izip(
+                line_docs, tags_per_line(tags), offsets, annotationses):
+            self.annotation_sets.append(doc.get('annotations', []) +
+                                        skim_annotations)
+            yield html_line(doc['content'], tags_in_line, offset)
+
+    def _unskimmed_lines(self):
+        """Yield a line of Markup at a time, marked up from the index alone,
+        pulling each LINE doc only as it's needed.
+
+        The indexer splits refs and regions at line ends, so each line can be
+        marked up by itself.
+
+        """
+        tree = self._tree_config
+        if 'ref_payloads' in self._file_doc:
+            refs = RefTable.es_to_refs(self._file_doc['ref_payloads'], tree)
+            line_refs = lambda doc: ((start, end, refs[index]) for
+                                     start, end, index in
+                                     doc.get('packed_refs', []))
+        else:  # an index from before refs were packed
+            line_refs = lambda doc: (Ref.es_to_triple(ref, tree) for ref in
+                                     doc.get('refs', []))
+        offset = 0
+        for doc in self._line_docs:
+            content = doc['content']
+            tags = finished_tags(
+                [content],
+                ((start - offset, end - offset, ref)
+                 for start, end, ref in line_refs(doc)),
+                ((start - offset, end - offset, region)
+                 for start, end, region in
+                 (Region.es_to_triple(r) for r in doc.get('regions', []))))
+            self.annotation_sets.append(doc.get('annotations', []))
+            yield html_line(content, next(tags_per_line(tags), []), 0)
+            offset += len(content)
+
+
+def _stream_template(template_name, **context):
+    """Return a response which renders a template bit by bit as it's sent,
+    rather than all at once up front."""
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    # Send a few lines per write rather than every little template chunk:
+    stream.enable_buffering(STREAM_CHUNKS_PER_WRITE)
+    return Response(stream_with_context(stream))
 
 
 @dxr_blueprint.route('/<tree>/rev/<revision>/<path:path>')
@@ -675,6 +1062,40 @@ def parallel(tree, path=''):
                                                      path=path))
 
 
+@dxr_blueprint.route('/<tree>/parallel-trees/')
+@dxr_blueprint.route('/<tree>/parallel-trees/<path:path>')
+def parallel_trees(tree, path=''):
+    """Return JSON listing the trees which have a file or dir at the given
+    path, and where to browse it in each.
+
+    All the trees are checked in a single multi-search, so a menu of them
+    costs one round trip to ES no matter how many trees there are. The root,
+    which has no file doc of its own, is in every tree.
+
+    """
+    es_alias_or_not_found(tree)  # 404 for unknown trees, like other views
+    configs = frozen_configs()
+    path = path.rstrip('/')
+    if not path:
+        return jsonify({
+            'trees': [{'name': f['name'],
+                       'url': url_for('.browse', tree=f['name'])}
+                      for f in configs]})
+    responses = multi_search(
+        current_app.es,
+        [(f['es_alias'],
+          FILE,
+          {'query': {'filtered': {'query': {'match_all': {}},
+                                  'filter': {'term': {'path': path}}}},
+           'size': 0})
+         for f in configs])
+    return jsonify({
+        'trees': [{'name': f['name'],
+                   'url': url_for('.browse', tree=f['name'], path=path)}
+                  for f, response in izip(configs, responses)
+                  if response['hits']['total']]})
+
+
 def _icon_class_name(file_doc):
     """Return a string for the CSS class of the icon for file document."""
     if file_doc['is_folder']:
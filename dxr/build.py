@@ -1,14 +1,18 @@
+from collections import defaultdict, namedtuple, OrderedDict
+from cPickle import dump, load, HIGHEST_PROTOCOL, UnpicklingError
 from datetime import datetime
 from errno import ENOENT
-from fnmatch import fnmatchcase
+from hashlib import sha1
 from itertools import chain, izip, repeat
+import json
 import os
-from os import stat, makedirs
-from os.path import islink, relpath, join, split
+from os import fsync, getpid, listdir, lstat, stat, makedirs, readlink
+from os.path import isfile, islink, relpath, join, split
 from shutil import rmtree
 import subprocess
 import sys
 from sys import exc_info
+from time import time
 from traceback import format_exc
 from uuid import uuid1
 
@@ -16,23 +20,173 @@ from binaryornot.helpers import is_binary_string
 from concurrent.futures import as_completed, ProcessPoolExecutor
 from click import progressbar
 from flask import current_app
-from funcy import ichunks, first
-from pyelasticsearch import (ElasticSearch, IndexAlreadyExistsError,
+from funcy import first, ichunks
+from pyelasticsearch import (ElasticHttpNotFoundError, IndexAlreadyExistsError,
                              bulk_chunks, Timeout, ConnectionError)
+from tabulate import tabulate
+try:
+    # scandir's walk() gets file types from the directory entries rather than
+    # stat()ing every file to tell it from a folder.
+    from scandir import walk
+except ImportError:
+    from os import walk
 
 from dxr.app import make_app, dictify_links
 from dxr.config import FORMAT
-from dxr.es import UNINDEXED_STRING, UNANALYZED_STRING, TREE, create_index_and_wait
+from dxr.es import (UNINDEXED_STRING, UNANALYZED_STRING, TREE, BulkSender,
+                    BulkStats, connect, create_index_and_wait,
+                    invalidate_catalog_cache, scroll_hits)
 from dxr.exceptions import BuildError
 from dxr.filters import LINE, FILE
-from dxr.lines import es_lines, finished_tags
+from dxr.indexers import FileToIndex as FileToIndexBase
+from dxr.lines import es_lines, finished_tags, RefTable
 from dxr.mime import decode_data
+from dxr.profiling import IndexingProfile
 from dxr.utils import (open_log, deep_update, append_update,
                        append_update_by_line, append_by_line, bucket,
-                       split_content_lines, unicode_for_display)
+                       IgnoreMatcher, split_content_lines, unicode_for_display)
 from dxr.vcs import VcsCache
 
 
+# Files are handed to indexing workers in chunks of about this many bytes of
+# source, never more than PATHS_PER_CHUNK files at a time. Chunks need to be
+# big enough to amortize sending the TreesToIndex along with them but small
+# enough that the last few don't keep one worker busy long after the others
+# have run out of work.
+BYTES_PER_CHUNK = 4 * 1024 * 1024
+PATHS_PER_CHUNK = 500
+
+# Folders are cheap to index, so they go out in bigger batches:
+FOLDERS_PER_CHUNK = 1000
+
+
+# What a worker reports back after indexing a chunk successfully:
+ChunkTiming = namedtuple('ChunkTiming',
+                         ['pid', 'started', 'finished', 'num_files',
+                          'bulk_stats', 'profile'])
+
+
+class TreeIndexersSnapshot(object):
+    """A handle to a list of TreeToIndexes, pickled to disk once after
+    post_build
+
+    Send this to indexing workers in place of the TreeToIndexes themselves.
+    Then the master doesn't have to re-pickle them--clang's inheritance graphs
+    and all--for every chunk, and each worker process unpickles them only the
+    first time it sees them, no matter how many chunks it indexes.
+
+    """
+    # (path, nonce) -> unpickled TreeToIndexes, in whatever process we're in.
+    # The nonce is new for each snapshot, so a later one written to the same
+    # path--the next tree, or the next run in a long-lived process--is never
+    # mistaken for one already loaded:
+    _loaded = {}
+
+    def __init__(self, tree_indexers, path):
+        TreeIndexersSnapshot._loaded.clear()
+        with open(path, 'wb') as file:
+            dump(tree_indexers, file, HIGHEST_PROTOCOL)
+        self.path = path
+        self.key = path, uuid1().hex
+
+    def tree_indexers(self):
+        """Return the TreeToIndexes, loading them if this process hasn't
+        already."""
+        loaded = TreeIndexersSnapshot._loaded
+        if self.key not in loaded:
+            loaded.clear()  # Don't hang onto some previous tree's.
+            with open(self.path, 'rb') as file:
+                loaded[self.key] = load(file)
+        return loaded[self.key]
+
+
+class IndexingJournal(object):
+    """A record, kept in the temp folder, of how far an indexing run has
+    gotten, so ``dxr index --resume`` can pick up where a failed run left off
+
+    The journal is a series of pickled records, each appended and flushed to
+    disk as a stage or chunk of files finishes. A crash thus loses no more
+    than the work that was in flight, and a record half-written during the
+    crash is simply ignored.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index = None
+        self.previous_index = None
+        self.fingerprint = None
+        self.build_done = False
+        self.folders_done = False
+        self.completed_paths = set()
+        self.resuming = False
+
+    @classmethod
+    def load(cls, path):
+        """Return the journal at ``path`` so a run can be resumed, or None if
+        there isn't one."""
+        journal = cls(path)
+        try:
+            file = open(path, 'rb')
+        except IOError as exc:
+            if exc.errno == ENOENT:
+                return None
+            raise
+        with file:
+            while True:
+                try:
+                    record = load(file)
+                except (EOFError, UnpicklingError, ValueError):
+                    break
+                journal._apply(record)
+        if journal.index is None:
+            return None
+        journal.resuming = True
+        return journal
+
+    def start(self, index, fingerprint, previous_index=None):
+        """Begin a fresh journal for a new index, replacing any old one."""
+        with open(self.path, 'wb'):
+            pass
+        self._append(('start', (index, fingerprint, previous_index)))
+
+    def note_build(self):
+        """Record that the build stage is done."""
+        self._append(('build', None))
+
+    def note_folders(self):
+        """Record that all folders have been indexed."""
+        self._append(('folders', None))
+
+    def note_chunk(self, paths):
+        """Record that a chunk of files has been indexed and its docs are
+        safely in ES."""
+        self._append(('chunk', paths))
+
+    def finish(self):
+        """Delete the journal once its index is complete."""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _append(self, record):
+        with open(self.path, 'ab') as file:
+            dump(record, file, HIGHEST_PROTOCOL)
+            file.flush()
+            fsync(file.fileno())
+        self._apply(record)
+
+    def _apply(self, (kind, value)):
+        if kind == 'start':
+            self.index, self.fingerprint, self.previous_index = value
+        elif kind == 'build':
+            self.build_done = True
+        elif kind == 'folders':
+            self.folders_done = True
+        elif kind == 'chunk':
+            self.completed_paths.update(value)
+
+
 def full_traceback(callable, *args, **kwargs):
     """Work around the wretched exception reporting of concurrent.futures.
 
@@ -48,17 +202,25 @@ def full_traceback(callable, *args, **kwargs):
         raise Exception(format_exc())
 
 
-def index_and_deploy_tree(tree, verbose=False):
+def index_and_deploy_tree(tree, verbose=False, incremental=False,
+                          checkpoint=False, resume=False):
     """Index a tree, and make it accessible.
 
     :arg tree: The TreeConfig of the tree to build
+    :arg incremental: Whether to copy the docs of files which haven't changed
+        from the tree's live index rather than re-indexing them
+    :arg checkpoint: Whether to journal progress and keep a partially built
+        index around after a failure so the run can be resumed
+    :arg resume: Whether to finish the index left behind by a failed
+        checkpointed run rather than starting a new one
 
     """
     config = tree.config
-    es = ElasticSearch(config.es_hosts,
-                       timeout=config.es_indexing_timeout,
-                       max_retries=config.es_indexing_retries)
-    index_name = index_tree(tree, es, verbose=verbose)
+    es = connect(config.es_hosts,
+                 timeout=config.es_indexing_timeout,
+                 max_retries=config.es_indexing_retries)
+    index_name = index_tree(tree, es, verbose=verbose, incremental=incremental,
+                            checkpoint=checkpoint, resume=resume)
     if 'index' not in tree.config.skip_stages:
         deploy_tree(tree, es, index_name)
 
@@ -99,12 +261,18 @@ def deploy_tree(tree, es, index_name):
                             'format': UNANALYZED_STRING,
                             # In case es_alias changes in the conf file:
                             'es_alias': UNINDEXED_STRING,
+                            # The index the alias pointed to as of this
+                            # deploy, for keying caches of rendered pages:
+                            'es_index': UNINDEXED_STRING,
                             # Needed so new trees or edited descriptions can show
                             # up without a WSGI restart:
                             'description': UNINDEXED_STRING,
                             # ["clang", "pygmentize"]:
                             'enabled_plugins': UNINDEXED_STRING,
-                            'generated_date': UNINDEXED_STRING
+                            'generated_date': UNINDEXED_STRING,
+                            # So incremental builds can tell whether the
+                            # live index's docs are still reusable:
+                            'index_fingerprint': UNINDEXED_STRING
                             # We may someday also need to serialize some plugin
                             # configuration here.
                         }
@@ -121,10 +289,55 @@ def deploy_tree(tree, es, index_name):
              doc=dict(name=tree.name,
                       format=FORMAT,
                       es_alias=alias,
+                      es_index=index_name,
                       description=tree.description,
                       enabled_plugins=[p.name for p in tree.enabled_plugins],
-                      generated_date=config.generated_date),
+                      generated_date=config.generated_date,
+                      index_fingerprint=index_fingerprint(tree)),
              id='%s/%s' % (FORMAT, tree.name))
+    invalidate_catalog_cache()
+
+
+def index_fingerprint(tree):
+    """Return a hash of everything besides file contents which influences the
+    docs produced for a tree: the format version, the enabled plugins, and
+    their configuration.
+
+    An incremental build can reuse a file's docs from an earlier index only if
+    the fingerprints of the two match.
+
+    """
+    def plugin_config(plugin):
+        # Plugin config sections may hold things like compiled regexes, so
+        # serialize those by their patterns:
+        return json.dumps(tree._section.get(plugin.name),
+                          sort_keys=True,
+                          default=lambda o: getattr(o, 'pattern', repr(o)))
+
+    return sha1(json.dumps([FORMAT,
+                            tree.source_encoding,
+                            [(p.name, plugin_config(p))
+                             for p in tree.enabled_plugins]])).hexdigest()
+
+
+def reusable_index(tree, es):
+    """Return the name of the index currently live for a tree if an
+    incremental build can reuse its docs. Otherwise, return None.
+
+    """
+    config = tree.config
+    try:
+        frozen = es.get(config.es_catalog_index,
+                        TREE,
+                        '%s/%s' % (FORMAT, tree.name))['_source']
+    except (ElasticHttpNotFoundError, KeyError):
+        return None
+    if frozen.get('index_fingerprint') != index_fingerprint(tree):
+        return None
+    try:
+        return first(es.aliases(frozen['es_alias']))
+    except ElasticHttpNotFoundError:
+        return None
 
 
 def swap_alias(alias, index, es):
@@ -146,10 +359,23 @@ def swap_alias(alias, index, es):
         es.delete_index(old_index)
 
 
-def index_tree(tree, es, verbose=False):
+def index_tree(tree, es, verbose=False, incremental=False, checkpoint=False,
+               resume=False):
     """Index a single tree into ES and the filesystem, and return the
     name of the new ES index.
 
+    :arg incremental: Whether to copy the docs of unchanged files from the
+        tree's live index rather than re-indexing them. Files which no longer
+        exist are simply not copied, so they vanish when the new index goes
+        live.
+    :arg checkpoint: Whether to keep an :class:`IndexingJournal` in the temp
+        folder and, if indexing fails, leave the partial index in place rather
+        than deleting it
+    :arg resume: Whether to reattach to the partial index named in the
+        journal of a failed checkpointed run, skipping the build if it was
+        done and any chunks of files that were finished. Implies
+        ``checkpoint``. If there is nothing to resume, start afresh.
+
     """
     def new_pool():
         return ProcessPoolExecutor(max_workers=tree.workers)
@@ -164,12 +390,15 @@ def index_tree(tree, es, verbose=False):
 
         """
         if not tree.workers:
-            return [save_scribbles(ti, method_name) for ti in tree_indexers]
+            results = [save_scribbles(ti, method_name) for ti in tree_indexers]
         else:
             futures = [pool.submit(full_traceback, save_scribbles, ti, method_name)
                        for ti in tree_indexers]
-            return [future.result() for future in
-                    show_progress(futures, 'Running %s' % method_name)]
+            results = [future.result() for future in
+                       show_progress(futures, 'Running %s' % method_name)]
+        for _, method_profile in results:
+            profile.merge(method_profile)
+        return [ti for ti, _ in results]
 
     def delete_index_quietly(es, index):
         """Delete an index, and ignore any error.
@@ -189,26 +418,57 @@ def index_tree(tree, es, verbose=False):
 
     # Note starting time
     start_time = datetime.now()
+    profile = IndexingProfile()
 
     config = tree.config
     skip_indexing = 'index' in config.skip_stages
     skip_build = 'build' in config.skip_stages
     skip_cleanup = skip_indexing or skip_build or 'clean' in config.skip_stages
+    clear_folders = not skip_cleanup
+    checkpoint = (checkpoint or resume) and not skip_indexing
+
+    journal = None
+    if checkpoint:
+        journal_path = join(tree.temp_folder, 'journal.pickle')
+        if resume:
+            journal = resumable_journal(tree, es, journal_path)
+            if journal:
+                print 'Resuming indexing into %s.' % journal.index
+                skip_build = skip_build or journal.build_done
+                # Keep the build's output and the logs of the failed run
+                # until this one finishes:
+                clear_folders = False
+            else:
+                print ("No partial index to resume for '%s'. Starting afresh."
+                       % tree.name)
 
     # Create and/or clear out folders:
-    ensure_folder(tree.object_folder, tree.source_folder != tree.object_folder)
-    ensure_folder(tree.temp_folder, not skip_cleanup)
-    ensure_folder(tree.log_folder, not skip_cleanup)
-    ensure_folder(join(tree.temp_folder, 'plugins'), not skip_cleanup)
+    ensure_folder(tree.object_folder,
+                  tree.source_folder != tree.object_folder and
+                      not (journal and journal.build_done))
+    ensure_folder(tree.temp_folder, clear_folders)
+    ensure_folder(tree.log_folder, clear_folders)
+    ensure_folder(join(tree.temp_folder, 'plugins'), clear_folders)
     for plugin in tree.enabled_plugins:
         ensure_folder(join(tree.temp_folder, 'plugins', plugin.name),
-                      not skip_cleanup)
+                      clear_folders)
 
     vcs_cache = VcsCache(tree)
     tree_indexers = [p.tree_to_index(p.name, tree, vcs_cache) for p in
                      tree.enabled_plugins if p.tree_to_index]
     try:
-        if not skip_indexing:
+        if journal:
+            index = journal.index
+            previous_index = journal.previous_index
+            # Make everything the failed run sent visible to delete-by-query,
+            # so we can clear out the docs of any half-finished chunks:
+            es.refresh(index=index)
+            if not journal.folders_done:
+                es.delete_by_query(
+                    index,
+                    FILE,
+                    {'filtered': {'filter': {'term': {'is_folder': True}}}})
+        elif not skip_indexing:
             # Substitute the format, tree name, and uuid into the index identifier.
             index = tree.es_index.format(format=FORMAT,
                                          tree=tree.name,
@@ -247,6 +507,20 @@ def index_tree(tree, es, verbose=False):
             index = None
             print "Skipping indexing (due to 'index' in 'skip_stages')"
 
+        if not journal:
+            previous_index = None
+            if incremental and not skip_indexing:
+                previous_index = reusable_index(tree, es)
+                if previous_index:
+                    print ("Reusing docs of unchanged files from %s." %
+                           previous_index)
+                else:
+                    print ("No compatible index to reuse for '%s'. Indexing "
+                           "every file." % tree.name)
+            if checkpoint:
+                journal = IndexingJournal(journal_path)
+                journal.start(index, index_fingerprint(tree), previous_index)
+
         # Run pre-build hooks:
         with new_pool() as pool:
             tree_indexers = farm_out('pre_build')
@@ -254,7 +528,12 @@ def index_tree(tree, es, verbose=False):
 
         if not skip_build:
             # Set up env vars, and build:
-            build_tree(tree, tree_indexers, verbose)
+            with profile.timing('build'):
+                build_tree(tree, tree_indexers, verbose)
+            if journal:
+                journal.note_build()
+        elif journal and journal.build_done:
+            print 'Skipping rebuild (already done before resuming)'
         else:
             print "Skipping rebuild (due to 'build' in 'skip_stages')"
 
@@ -262,11 +541,13 @@ def index_tree(tree, es, verbose=False):
         if not skip_indexing:
             with new_pool() as pool:
                 tree_indexers = farm_out('post_build')
-                index_files(tree, tree_indexers, index, pool, es)
+                index_files(tree, tree_indexers, index, pool, profile,
+                            previous_index=previous_index, journal=journal)
 
             # refresh() times out in prod. Wait until it doesn't. That
             # probably means things are ready to rock again.
-            with aligned_progressbar(repeat(None), label='Refreshing index') as bar:
+            with profile.timing('refresh'), \
+                 aligned_progressbar(repeat(None), label='Refreshing index') as bar:
                 for _ in bar:
                     try:
                         es.refresh(index=index)
@@ -288,17 +569,41 @@ def index_tree(tree, es, verbose=False):
         # If anything went wrong, delete the index, because we're not
         # going to have a way of returning its name if we raise an
         # exception.
-        if not skip_indexing:
+        if journal:
+            print >> sys.stderr, ("Leaving partial index %s in place. Run "
+                                  "`dxr index --resume %s` to finish it." %
+                                  (index, tree.name))
+        elif not skip_indexing:
             delete_index_quietly(es, index)
         raise
 
+    if journal:
+        # There's nothing left to resume:
+        journal.finish()
     print "Finished '%s' in %s." % (tree.name, datetime.now() - start_time)
+    print 'Wrote timings to %s.' % profile.write(tree.log_folder)
     if not skip_cleanup:
         # By default, we remove the temp files, because they're huge.
         rmtree(tree.temp_folder)
     return index
 
 
+def resumable_journal(tree, es, path):
+    """Return the IndexingJournal of a failed run of ``tree`` if its index
+    still exists and was built with the same configuration. Otherwise, return
+    None.
+
+    """
+    journal = IndexingJournal.load(path)
+    if not journal or journal.fingerprint != index_fingerprint(tree):
+        return None
+    try:
+        es.get_settings(journal.index)
+    except ElasticHttpNotFoundError:
+        return None
+    return journal
+
+
 def aligned_progressbar(*args, **kwargs):
     """Fall through to click's progress bar, but line up all the bars so they
     aren't askew."""
@@ -317,14 +622,17 @@ def show_progress(futures, message):
 
 
 def save_scribbles(obj, method):
-    """Call obj.method(), then return obj and the result so the master process
-    can see anything method() scribbled on it.
+    """Call obj.method(), then return obj and an IndexingProfile of the call so
+    the master process can see anything method() scribbled on it and how long
+    it took.
 
     This is meant to run in a remote process.
 
     """
-    getattr(obj, method)()
-    return obj
+    profile = IndexingProfile()
+    with profile.timing('%s:%s' % (method, obj.plugin_name)):
+        getattr(obj, method)()
+    return obj, profile
 
 
 def ensure_folder(folder, clean=False):
@@ -339,22 +647,6 @@ def ensure_folder(folder, clean=False):
         makedirs(folder)
 
 
-def _unignored_folders(folders, source_path, ignore_filenames, ignore_paths):
-    """Yield the folders from ``folders`` which are not ignored by the given
-    patterns and paths.
-
-    :arg source_path: Relative path to the source directory
-    :arg ignore_filenames: Filename-based globs to be ignored
-    :arg ignore_paths: Path-based globs to be ignored
-
-    """
-    for folder in folders:
-        if not any(fnmatchcase(folder, p) for p in ignore_filenames):
-            folder_path = '/' + join(source_path, folder).replace(os.sep, '/') + '/'
-            if not any(fnmatchcase(folder_path, p) for p in ignore_paths):
-                yield folder
-
-
 def unicode_contents(path, encoding_guess):  # TODO: Make accessible to TreeToIndex.post_build.
     """Return the unicode contents of a file if we can figure out a decoding,
     or else None.
@@ -377,7 +669,27 @@ def unicode_contents(path, encoding_guess):  # TODO: Make accessible to TreeToIn
                 return contents
 
 
-def unignored(folder, ignore_paths, ignore_filenames, want_folders=False):
+def content_hash(path):
+    """Return a hex digest which changes whenever the contents of a file or the
+    target of a symlink do, or None if the file can't be read.
+
+    :arg path: Bytestring absolute path to the file
+
+    """
+    hasher = sha1()
+    try:
+        if islink(path):
+            hasher.update('link:' + readlink(path))
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(65536), ''):
+                hasher.update(block)
+    except (IOError, OSError):
+        return None
+    return hasher.hexdigest()
+
+
+def unignored(folder, ignore_paths, ignore_filenames, want_folders=False,
+              matcher=None):
     """Return an iterable of bytestring absolute paths to unignored source
     tree files or the folders that contain them.
 
@@ -385,18 +697,22 @@ def unignored(folder, ignore_paths, ignore_filenames, want_folders=False):
 
     :arg want_folders: If falsey, return files. If truthy, return folders
         instead.
+    :arg matcher: An :class:`~dxr.utils.IgnoreMatcher` to use instead of
+        compiling ``ignore_paths`` and ``ignore_filenames`` afresh, like a
+        tree's ``ignore_matcher``
 
     """
     # On Linux (which is what we guarantee support for), paths are bags of
     # bytes; they may not even be representable as Unicode code points.
     if isinstance(folder, unicode):
         folder = folder.encode('utf8')
+    if matcher is None:
+        matcher = IgnoreMatcher(ignore_filenames, ignore_paths)
 
     def raise_(exc):
         raise exc
 
-    # TODO: Expose a lot of pieces of this as routines plugins can call.
-    for root, folders, files in os.walk(folder, topdown=True, onerror=raise_):
+    for root, folders, files in walk(folder, topdown=True, onerror=raise_):
         # Find relative path
         rel_path = relpath(root, folder)
         if rel_path == '.':
@@ -404,42 +720,47 @@ def unignored(folder, ignore_paths, ignore_filenames, want_folders=False):
 
         if not want_folders:
             for f in files:
-                # Ignore file if it matches an ignore pattern
-                if any(fnmatchcase(f, e) for e in ignore_filenames):
-                    continue  # Ignore the file.
-
-                path = join(rel_path, f)
-
-                # Ignore file if its path (relative to the root) matches an
-                # ignore path.
-                if any(fnmatchcase("/" + path.replace(os.sep, "/"), e) for e in ignore_paths):
-                    continue  # Ignore the file.
-
-                yield join(root, f)
+                if not matcher.is_ignored_file(join(rel_path, f), f):
+                    yield join(root, f)
 
         # Exclude folders that match an ignore pattern.
-        # os.walk listens to any changes we make in `folders`.
-        folders[:] = _unignored_folders(
-            folders, rel_path, ignore_filenames, ignore_paths)
+        # walk() listens to any changes we make in `folders`.
+        folders[:] = [f for f in folders
+                      if not matcher.is_ignored_folder(join(rel_path, f), f)]
         if want_folders:
             for f in folders:
                 yield join(root, f)
 
-def index_file(tree, tree_indexers, path, es, index):
+
+def index_file(tree, tree_indexers, path, es, index, sender=None,
+               profile=None, digest=None, siblings_hash=None):
     """Index a single file into ES, and build a static HTML representation of it.
 
     For the moment, we execute plugins in series, figuring that we have plenty
-    of files to keep our processors busy in most trees that take very long. I'm
-    a little afraid of the cost of passing potentially large TreesToIndex to
-    worker processes. That goes at 52MB/s on my OS X laptop, measuring by the
-    size of the pickled object and including the pickling and unpickling time.
+    of files to keep our processors busy in most trees that take very long.
+    Passing potentially large TreesToIndex to worker processes goes at 52MB/s
+    on my OS X laptop, measuring by the size of the pickled object and
+    including the pickling and unpickling time, which is why workers get them
+    through a :class:`TreeIndexersSnapshot`, once apiece.
 
     :arg path: Bytestring absolute path to the file to index
     :arg index: The ES index name
+    :arg sender: A :class:`~dxr.es.BulkSender` to ship docs through. If
+        omitted, docs are sent synchronously.
+    :arg profile: An :class:`~dxr.profiling.IndexingProfile` to record
+        timings in
+    :arg digest: The file's :func:`content_hash()`, if the caller has
+        already worked it out
+    :arg siblings_hash: The file's entry from :func:`siblings_hashes()`, if
+        the caller has already worked it out
 
     """
+    if profile is None:
+        profile = IndexingProfile()
+    started = time()
     try:
-        contents = unicode_contents(path, tree.source_encoding)
+        with profile.timing('file:unicode_contents'):
+            contents = unicode_contents(path, tree.source_encoding)
     except IOError as exc:
         if exc.errno == ENOENT and islink(path):
             # It's just a bad symlink (or a symlink that was swiped out
@@ -453,6 +774,10 @@ def index_file(tree, tree_indexers, path, es, index):
     rel_path = relpath(path, tree.source_folder)
     is_text = isinstance(contents, unicode)
     is_link = islink(path)
+    if digest is None:
+        digest = content_hash(path)
+    if siblings_hash is None:
+        siblings_hash = siblings_hashes(tree, [path])[path]
     # Index by line if the contents are text and the path is not a symlink.
     index_by_line = is_text and not is_link
     if index_by_line:
@@ -461,25 +786,78 @@ def index_file(tree, tree_indexers, path, es, index):
         needles_by_line = [{} for _ in xrange(num_lines)]
         annotations_by_line = [[] for _ in xrange(num_lines)]
         refses, regionses = [], []
+        # Identical files of the same name can share refs and regions from
+        # plugins which vouch that those depend on nothing else:
+        duplicate_key = digest and (tree.name, digest, split(rel_path)[1])
     needles = {}
     linkses = []
 
+    files_to_index = []
     for tree_indexer in tree_indexers:
-        file_to_index = tree_indexer.file_to_index(rel_path, contents)
-        if file_to_index.is_interesting():
-            # Per-file stuff:
-            append_update(needles, file_to_index.needles())
-            if not is_link:
-                linkses.append(file_to_index.links())
-
-            # Per-line stuff:
-            if index_by_line:
-                refses.append(file_to_index.refs())
-                regionses.append(file_to_index.regions())
-                append_update_by_line(needles_by_line,
-                                      file_to_index.needles_by_line())
-                append_by_line(annotations_by_line,
-                               file_to_index.annotations_by_line())
+        with profile.timing('file:%s.file_to_index' % tree_indexer.plugin_name):
+            file_to_index = tree_indexer.file_to_index(rel_path, contents)
+            if file_to_index.is_interesting():
+                files_to_index.append((tree_indexer.plugin_name,
+                                       file_to_index))
+
+    # If every interesting plugin's refs and regions can be reused, see if
+    # we've already done all the per-line tagging for this file's twin:
+    line_tags = tags_key = None
+    if (index_by_line and duplicate_key and
+            all(depends_only_on_contents(f) for _, f in files_to_index)):
+        tags_key = duplicate_key + tuple(name for name, _ in files_to_index)
+        line_tags = _duplicates.get(tags_key)
+
+    for plugin_name, file_to_index in files_to_index:
+        def timed(method_name):
+            """Return what file_to_index.method_name() returns, charging the
+            time it takes to produce to a stage named for the plugin."""
+            stage = 'file:%s.%s' % (plugin_name, method_name)
+            with profile.timing(stage):
+                result = getattr(file_to_index, method_name)()
+            return profile.timed_iter(stage, result, calls=0)
+
+        # Per-file stuff:
+        append_update(needles, timed('needles'))
+        if not is_link:
+            linkses.append(timed('links'))
+
+        # Per-line stuff:
+        if index_by_line:
+            if line_tags is None:
+                if duplicate_key and depends_only_on_contents(file_to_index):
+                    plugin_key = duplicate_key + (plugin_name,)
+                    refs_and_regions = _duplicates.get(plugin_key)
+                    if refs_and_regions is None:
+                        refs_and_regions = (list(timed('refs')),
+                                            list(timed('regions')))
+                        _duplicates.put(plugin_key, refs_and_regions,
+                                        num_lines)
+                    else:
+                        profile.count('deduplicated_plugin_runs')
+                    refses.append(refs_and_regions[0])
+                    regionses.append(refs_and_regions[1])
+                else:
+                    refses.append(timed('refs'))
+                    regionses.append(timed('regions'))
+            append_update_by_line(needles_by_line,
+                                  timed('needles_by_line'))
+            append_by_line(annotations_by_line,
+                           timed('annotations_by_line'))
+
+    if index_by_line:
+        if line_tags is not None:
+            profile.count('deduplicated_files')
+        else:
+            line_tags = profile.timed_iter(
+                'file:finished_tags',
+                es_lines(finished_tags(lines,
+                                       chain.from_iterable(refses),
+                                       chain.from_iterable(regionses))))
+            if tags_key and num_lines <= _duplicates.max_lines:
+                line_tags = list(line_tags)
+                _duplicates.put(tags_key, line_tags, num_lines)
+    profile.count('files')
 
     def docs():
         """Yield documents for bulk indexing.
@@ -487,36 +865,12 @@ def index_file(tree, tree_indexers, path, es, index):
         Big Warning: docs also clears the contents of all elements of
         needles_by_line because they will no longer be used.
         """
-        # Index a doc of type 'file' so we can build folder listings.
-        # At the moment, we send to ES in the same worker that does the
-        # indexing. We could interpose an external queueing system, but I'm
-        # willing to potentially sacrifice a little speed here for the easy
-        # management of self-throttling.
-        file_info = stat(path)
-        folder_name, file_name = split(rel_path)
-        # Hard-code the keys that are hard-coded in the browse()
-        # controller. Merge with the pluggable ones from needles:
-        doc = dict(# Some non-array fields:
-                    folder=unicode_for_display(folder_name),
-                    name=unicode_for_display(file_name),
-                    size=file_info.st_size,
-                    is_folder=False,
-
-                    # And these, which all get mashed into arrays:
-                    **needles)
-        links = dictify_links(chain.from_iterable(linkses))
-        if links:
-            doc['links'] = links
-        yield es.index_op(doc, doc_type=FILE)
+        ref_table = RefTable()
 
         # Index all the lines.
         if index_by_line:
             for total, annotations_for_this_line, tags in izip(
-                    needles_by_line,
-                    annotations_by_line,
-                    es_lines(finished_tags(lines,
-                                           chain.from_iterable(refses),
-                                           chain.from_iterable(regionses)))):
+                    needles_by_line, annotations_by_line, line_tags):
                 # Duplicate the file-wide needles into this line:
                 total.update(needles)
 
@@ -527,7 +881,8 @@ def index_file(tree, tree_indexers, path, es, index):
                                           isinstance(index_obj['payload'], basestring) else
                                           "refs")
                 if 'refs' in refs_and_regions:
-                    total['refs'] = refs_and_regions['refs']
+                    total['packed_refs'] = ref_table.pack(
+                        refs_and_regions['refs'])
                 if 'regions' in refs_and_regions:
                     total['regions'] = refs_and_regions['regions']
                 if annotations_for_this_line:
@@ -539,13 +894,194 @@ def index_file(tree, tree_indexers, path, es, index):
                 # the contents, saving substantial memory on long files.
                 total.clear()
 
-    # Indexing a 277K-line file all in one request makes ES time out (>60s),
-    # so we chunk it up. 300 docs is optimal according to the benchmarks in
-    # https://bugzilla.mozilla.org/show_bug.cgi?id=1122685. So large docs like
-    # images don't make our chunk sizes ridiculous, there's a size ceiling as
-    # well: 10000 is based on the 300 and an average of 31 chars per line.
-    for chunk in bulk_chunks(docs(), docs_per_chunk=300, bytes_per_chunk=10000):
-        es.bulk(chunk, index=index, doc_type=LINE)
+        # Index a doc of type 'file' so we can build folder listings. It goes
+        # last so it can carry the table of ref payloads the lines point into.
+        # At the moment, we send to ES from threads in the same worker that
+        # does the indexing. We could interpose an external queueing system,
+        # but the BulkSender's bounded queue gives us easy self-throttling.
+        file_info = stat(path)
+        folder_name, file_name = split(rel_path)
+        # Hard-code the keys that are hard-coded in the browse()
+        # controller. Merge with the pluggable ones from needles:
+        doc = dict(# Some non-array fields:
+                    folder=unicode_for_display(folder_name),
+                    name=unicode_for_display(file_name),
+                    size=file_info.st_size,
+                    is_folder=False,
+                    content_hash=digest,
+                    siblings_hash=siblings_hash,
+
+                    # And these, which all get mashed into arrays:
+                    **needles)
+        links = dictify_links(chain.from_iterable(linkses))
+        if links:
+            doc['links'] = links
+        if ref_table.payloads:
+            doc['ref_payloads'] = ref_table.es()
+        if index_by_line:
+            # So file views can number the lines before fetching them:
+            doc['line_count'] = num_lines
+        yield es.index_op(doc, doc_type=FILE)
+
+    if sender is None:
+        sender = BulkSender(es, index, LINE, in_flight=0)
+    for chunk in config_bulk_chunks(docs(), tree.config):
+        # This includes any time spent waiting for the sender to catch up:
+        with profile.timing('file:bulk_send'):
+            sender.send(chunk)
+    profile.note_file(rel_path, time() - started)
+
+
+class DuplicateCache(object):
+    """The refs, regions, and finished per-line tags of recently indexed
+    files, so byte-identical copies of them--vendored libraries, generated
+    stubs, license files--needn't be analyzed again
+
+    Entries are evicted oldest first once they add up to more than
+    ``max_lines`` lines of source. That's plenty: chunks are handed out
+    biggest files first, and identical files are of course the same size, so
+    copies of a file tend to be indexed one after another by the same worker.
+
+    """
+    def __init__(self, max_lines=200000):
+        self.max_lines = max_lines
+        self._entries = OrderedDict()  # key -> (value, number of lines)
+        self._lines = 0
+
+    def get(self, key):
+        """Return the value stored under a key, or None."""
+        entry = self._entries.get(key)
+        return entry and entry[0]
+
+    def put(self, key, value, num_lines):
+        """Remember a value which covers ``num_lines`` lines of source."""
+        if key in self._entries or num_lines > self.max_lines:
+            return
+        self._entries[key] = value, num_lines
+        self._lines += num_lines
+        while self._lines > self.max_lines:
+            _, (_, lines) = self._entries.popitem(last=False)
+            self._lines -= lines
+
+
+# One per process:
+_duplicates = DuplicateCache()
+
+
+def depends_only_on_contents(file_to_index):
+    """Return whether a FileToIndex's refs and regions can be reused for any
+    identical file of the same name.
+
+    That's so if its plugin says so or if it just inherits the empty default
+    implementations.
+
+    """
+    cls = type(file_to_index)
+    return cls.contents_only or (
+        cls.refs.im_func is FileToIndexBase.refs.im_func and
+        cls.regions.im_func is FileToIndexBase.regions.im_func)
+
+
+def config_bulk_chunks(actions, config):
+    """Divide bulk actions into request-sized chunks as the config dictates.
+
+    Indexing a 277K-line file all in one request makes ES time out (>60s), so
+    we chunk it up. 300 docs (the default) is optimal according to the
+    benchmarks in https://bugzilla.mozilla.org/show_bug.cgi?id=1122685. So
+    large docs like images don't make our chunk sizes ridiculous, there's a
+    size ceiling as well: the default of 10000 is based on the 300 and an
+    average of 31 chars per line.
+
+    """
+    return bulk_chunks(actions,
+                       docs_per_chunk=config.es_indexing_docs_per_chunk,
+                       bytes_per_chunk=config.es_indexing_bytes_per_chunk)
+
+
+def siblings_hashes(tree, paths):
+    """Return a dict mapping each of ``paths`` to a hex digest of the names of
+    the unignored files in its folder.
+
+    Some of a file's docs depend on its neighbors--extmatch links a header to
+    its implementation file, for instance--so an incremental build copies a
+    file's docs only if this, as well as its contents, hasn't changed. Each
+    folder is listed only once.
+
+    :arg paths: Bytestring absolute paths to files
+
+    """
+    by_folder = {}
+    hashes = {}
+    for path in paths:
+        folder = split(path)[0]
+        if folder not in by_folder:
+            rel_folder = relpath(folder, tree.source_folder)
+            if rel_folder == '.':
+                rel_folder = ''
+            try:
+                names = listdir(folder)
+            except OSError:
+                names = []
+            by_folder[folder] = sha1('\0'.join(sorted(
+                name for name in names
+                if isfile(join(folder, name)) and
+                   not tree.ignore_matcher.is_ignored_file(
+                       join(rel_folder, name), name)))).hexdigest()
+        hashes[path] = by_folder[folder]
+    return hashes
+
+
+def unchanged_paths(tree, es, previous_index, digests, siblings):
+    """Return the set of files whose contents and siblings haven't changed
+    since ``previous_index`` was built.
+
+    :arg digests: A dict mapping bytestring absolute paths of files to their
+        :func:`content_hash()`\ es
+    :arg siblings: A dict mapping the same paths to their
+        :func:`siblings_hashes()`
+
+    """
+    paths = dict((unicode_for_display(relpath(path, tree.source_folder)),
+                  path)
+                 for path in digests)
+    old_files = scroll_hits(
+        es,
+        {'query': {'filtered': {'filter': {'and': [
+            {'terms': {'path': paths.keys()}},
+            {'term': {'is_folder': False}}]}}},
+         '_source': {'include': ['path', 'content_hash', 'siblings_hash']}},
+        previous_index,
+        doc_type=FILE)
+    unchanged = set()
+    for hit in old_files:
+        path = paths[hit['_source']['path'][0]]
+        if (digests[path] is not None and
+                hit['_source'].get('content_hash') == digests[path] and
+                hit['_source'].get('siblings_hash') == siblings[path]):
+            unchanged.add(path)
+    return unchanged
+
+
+def copy_docs(tree, es, previous_index, paths, sender):
+    """Send the FILE and LINE docs of some files from ``previous_index`` to
+    the new index as they are.
+
+    :arg paths: Bytestring absolute paths to files
+    :arg sender: The :class:`~dxr.es.BulkSender` for the new index
+
+    """
+    old_docs = scroll_hits(
+        es,
+        {'query': {'filtered': {'filter': {'terms': {'path': [
+            unicode_for_display(relpath(p, tree.source_folder))
+            for p in paths]}}}}},
+        previous_index,
+        doc_type=[FILE, LINE])
+    for chunk in config_bulk_chunks((es.index_op(hit['_source'],
+                                                 doc_type=hit['_type'])
+                                     for hit in old_docs),
+                                    tree.config):
+        sender.send(chunk)
 
 
 def index_chunk(tree,
@@ -553,31 +1089,83 @@ def index_chunk(tree,
                 paths,
                 index,
                 swallow_exc=False,
-                worker_number=None):
+                worker_number=None,
+                previous_index=None,
+                discard_stale=False):
     """Index a pile of files.
 
     This is the entrypoint for indexer pool workers.
 
+    :arg tree_indexers: A list of TreeToIndexes or a TreeIndexersSnapshot of
+        them
     :arg worker_number: A unique number assigned to this worker so it knows
         what to call its log file
+    :arg previous_index: The name of an index from which to copy the docs of
+        files that haven't changed, or None to index every file afresh
+    :arg discard_stale: Whether to first delete any docs already in the index
+        for these paths, left over from a failed run being resumed
 
     """
     path = '(no file yet)'
+    started = time()
     try:
+        if isinstance(tree_indexers, TreeIndexersSnapshot):
+            tree_indexers = tree_indexers.tree_indexers()
         # So we can use Flask's url_from():
         with make_app(tree.config).test_request_context():
             es = current_app.es
+            sender = BulkSender(
+                es,
+                index,
+                LINE,
+                in_flight=tree.config.es_indexing_requests_in_flight)
+            profile = IndexingProfile()
             try:
                 # Don't log if single-process:
                 log = (worker_number and
                        open_log(tree.log_folder,
                                 'index-chunk-%s.log' % worker_number))
+                if discard_stale:
+                    es.delete_by_query(
+                        index,
+                        [FILE, LINE],
+                        {'filtered': {'filter': {'terms': {'path': [
+                            unicode_for_display(relpath(p, tree.source_folder))
+                            for p in paths]}}}})
+                with profile.timing('file:hashes'):
+                    digests = dict((p, content_hash(p)) for p in paths)
+                    siblings = siblings_hashes(tree, paths)
+                unchanged = set()
+                if previous_index:
+                    with profile.timing('file:unchanged_paths'):
+                        unchanged = unchanged_paths(tree, es, previous_index,
+                                                    digests, siblings)
+                    if unchanged:
+                        with profile.timing('file:copy_docs'):
+                            copy_docs(tree, es, previous_index, unchanged,
+                                      sender)
+                        profile.count('reused_files', len(unchanged))
+                    log and log.write('Copied %s of %s files.\n' %
+                                      (len(unchanged), len(paths)))
                 for path in paths:
+                    if path in unchanged:
+                        continue
                     log and log.write('Starting %s.\n' % path)
-                    index_file(tree, tree_indexers, path, es, index)
+                    index_file(tree, tree_indexers, path, es, index, sender,
+                               profile,
+                               digest=digests[path],
+                               siblings_hash=siblings[path])
+                path = '(waiting on bulk requests)'
+                with profile.timing('file:bulk_drain'):
+                    sender.close()
                 log and log.write('Finished chunk.\n')
             finally:
+                # On failure, don't leave threads and queued chunks behind in
+                # this long-lived pool worker:
+                sender.abort()
                 log and log.close()
+        return ChunkTiming(getpid(), started, time(), len(paths),
+                           sender.stats, profile)
     except Exception as exc:
         if swallow_exc:
             type, value, traceback = exc_info()
@@ -586,58 +1174,304 @@ def index_chunk(tree,
             raise
 
 
-def index_folders(tree, index, es):
-    """Index the folder hierarchy into ES."""
-    folder_indexers = [(p.name, p.folder_to_index)
-                       for p in tree.enabled_plugins if p.folder_to_index]
-    with aligned_progressbar(unignored(tree.source_folder,
-                                       tree.ignore_paths,
-                                       tree.ignore_filenames,
-                                       want_folders=True),
-                     show_eta=False,  # never even close
-                     label='Indexing folders') as folders:
+def index_folder_chunk(tree, folders, index, swallow_exc=False):
+    """Index a pile of folders, sending them to ES in bulk, and return an
+    IndexingProfile of the work.
+
+    This is the entrypoint for folder-indexing pool workers.
+
+    """
+    folder = '(no folder yet)'
+    profile = IndexingProfile()
+    try:
+        config = tree.config
+        es = connect(config.es_hosts,
+                     timeout=config.es_indexing_timeout,
+                     max_retries=config.es_indexing_retries)
+        folder_indexers = [(p.name, p.folder_to_index)
+                           for p in tree.enabled_plugins if p.folder_to_index]
+        actions = []
         for folder in folders:
             needles = {'is_folder': True}
             for name, folder_to_index in folder_indexers:
-                needles.update(dict(folder_to_index(name, tree, folder).needles()))
-            es.index(index, FILE, needles)
+                with profile.timing('folder:%s.needles' % name):
+                    needles.update(dict(folder_to_index(name, tree, folder).needles()))
+            actions.append(es.index_op(needles))
+        folder = '(waiting on bulk requests)'
+        sender = BulkSender(es,
+                            index,
+                            FILE,
+                            in_flight=config.es_indexing_requests_in_flight)
+        try:
+            with profile.timing('folder:bulk_send'):
+                for chunk in config_bulk_chunks(actions, config):
+                    sender.send(chunk)
+                sender.close()
+        finally:
+            sender.abort()
+        return profile
+    except Exception:
+        if swallow_exc:
+            type, value, traceback = exc_info()
+            return format_exc(), type, value, folder
+        else:
+            raise
 
 
-def index_files(tree, tree_indexers, index, pool, es):
-    """Divide source files into groups, and send them out to be indexed."""
+def index_folders(tree, index, pool, profile):
+    """Index the folder hierarchy into ES, spreading the work across the pool
+    like file indexing.
 
-    def path_chunks(tree):
-        """Return an iterable of worker-sized iterables of paths."""
-        return ichunks(500, unignored(tree.source_folder,
-                                      tree.ignore_paths,
-                                      tree.ignore_filenames))
-
-    index_folders(tree, index, es)
+    :arg profile: An IndexingProfile to merge the workers' timings into
 
+    """
+    folder_chunks = ichunks(FOLDERS_PER_CHUNK,
+                            unignored(tree.source_folder,
+                                      tree.ignore_paths,
+                                      tree.ignore_filenames,
+                                      want_folders=True,
+                                      matcher=tree.ignore_matcher))
     if not tree.workers:
-        for paths in path_chunks(tree):
-            index_chunk(tree,
-                        tree_indexers,
-                        paths,
-                        index,
-                        swallow_exc=False)
+        with aligned_progressbar(folder_chunks,
+                                 show_eta=False,  # never even close
+                                 label='Indexing folders') as chunks:
+            for folders in chunks:
+                profile.merge(index_folder_chunk(tree, folders, index))
     else:
-        futures = [pool.submit(index_chunk,
+        futures = [pool.submit(index_folder_chunk,
                                tree,
-                               tree_indexers,
-                               paths,
+                               folders,
                                index,
-                               worker_number=worker_number,
                                swallow_exc=True)
-                   for worker_number, paths in enumerate(path_chunks(tree), 1)]
-        for future in show_progress(futures, 'Indexing files'):
+                   for folders in folder_chunks]
+        for future in show_progress(futures, 'Indexing folders'):
             result = future.result()
-            if result:
-                formatted_tb, type, value, path = result
-                print 'A worker failed while indexing %s:' % path
-                print formatted_tb
+            if isinstance(result, IndexingProfile):
+                profile.merge(result)
+            else:
+                _reraise_failure(result)
+
+
+def _reraise_failure(failure):
+    """Print the traceback from a failed worker, and re-raise its exception
+    so as to exit non-zero.
+
+    :arg failure: The tuple returned by a worker that swallowed an exception
+
+    """
+    formatted_tb, type, value, path = failure
+    print 'A worker failed while indexing %s:' % path
+    print formatted_tb
+    raise type, value
+
+
+def index_files(tree, tree_indexers, index, pool, profile,
+                previous_index=None, journal=None):
+    """Divide source files into groups, and send them out to be indexed.
+
+    :arg profile: An IndexingProfile to merge the workers' timings into
+    :arg previous_index: The name of an index from which to copy the docs of
+        unchanged files, or None to index every file afresh
+    :arg journal: An IndexingJournal to record finished work in, or None. If
+        it's one being resumed, work it records as finished is skipped.
+
+    """
+    resuming = journal is not None and journal.resuming
+
+    def path_chunks(tree):
+        """Return an iterable of worker-sized lists of paths, biggest files
+        first."""
+        paths = unignored(tree.source_folder,
+                          tree.ignore_paths,
+                          tree.ignore_filenames,
+                          matcher=tree.ignore_matcher)
+        if resuming:
+            paths = (p for p in paths if p not in journal.completed_paths)
+        return size_balanced_chunks(paths)
+
+    if not (resuming and journal.folders_done):
+        with profile.timing('index_folders'):
+            index_folders(tree, index, pool, profile)
+        if journal:
+            journal.note_folders()
+
+    timings = []
+    if not tree.workers:
+        for paths in path_chunks(tree):
+            timings.append(index_chunk(tree,
+                                       tree_indexers,
+                                       paths,
+                                       index,
+                                       swallow_exc=False,
+                                       previous_index=previous_index,
+                                       discard_stale=resuming))
+            if journal:
+                journal.note_chunk(paths)
+    else:
+        # Pickle the post_build state once rather than once per chunk:
+        snapshot = TreeIndexersSnapshot(
+            tree_indexers,
+            join(tree.temp_folder, 'tree_indexers.pickle'))
+        # The pool queues up only about one chunk per worker ahead of time,
+        # so whichever worker finishes first takes the next chunk.
+        paths_by_future = dict(
+            (pool.submit(index_chunk,
+                         tree,
+                         snapshot,
+                         paths,
+                         index,
+                         worker_number=worker_number,
+                         swallow_exc=True,
+                         previous_index=previous_index,
+                         discard_stale=resuming),
+             paths)
+            for worker_number, paths in enumerate(path_chunks(tree), 1))
+        failure = None
+        for future in show_progress(paths_by_future.keys(), 'Indexing files'):
+            result = future.result()
+            if isinstance(result, ChunkTiming):
+                timings.append(result)
+                if journal:
+                    journal.note_chunk(paths_by_future[future])
+            elif journal:
+                # Let the other workers finish and journal their chunks so
+                # less is left to do when resuming:
+                failure = failure or result
+            else:
                 # Abort everything if anything fails:
-                raise type, value  # exits with non-zero
+                _reraise_failure(result)
+        if failure:
+            _reraise_failure(failure)
+    for timing in timings:
+        profile.merge(timing.profile)
+    report_utilization(timings, tree.log_folder)
+    report_bulk_stats(timings, tree.log_folder)
+    report_duplicates(profile)
+
+
+def file_size(path):
+    """Return the size of a file in bytes, or 0 if it can't be stat'd.
+
+    Symlinks count as their own, tiny size, since we don't index through them.
+
+    """
+    try:
+        return lstat(path).st_size
+    except OSError:
+        return 0
+
+
+def size_balanced_chunks(paths,
+                         bytes_per_chunk=BYTES_PER_CHUNK,
+                         paths_per_chunk=PATHS_PER_CHUNK):
+    """Return an iterable of lists of paths, each totalling about
+    ``bytes_per_chunk`` bytes of files and holding no more than
+    ``paths_per_chunk`` of them.
+
+    The largest files come first. That way, a huge generated file gets
+    started early rather than stranding one worker at the end of the run, and
+    the run finishes with lots of small chunks that fill in the gaps between
+    workers. A file bigger than ``bytes_per_chunk`` gets a chunk to itself.
+
+    """
+    chunk, chunk_bytes = [], 0
+    for size, path in sorted(((file_size(p), p) for p in paths),
+                             reverse=True):
+        if chunk and (chunk_bytes + size > bytes_per_chunk or
+                      len(chunk) >= paths_per_chunk):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(path)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def report_utilization(timings, log_folder):
+    """Print how busy the indexing workers were, and log per-worker details.
+
+    A worker's utilization is the fraction of the file-indexing phase, from
+    the first chunk's start to the last one's end, that it spent indexing.
+
+    :arg timings: An iterable of ChunkTimings
+
+    """
+    timings = list(timings)
+    if not timings:
+        return
+    span = _indexing_span(timings)
+    busy, chunks, files = defaultdict(float), defaultdict(int), defaultdict(int)
+    for t in timings:
+        busy[t.pid] += t.finished - t.started
+        chunks[t.pid] += 1
+        files[t.pid] += t.num_files
+    utilizations = dict((pid, busy[pid] / span) for pid in busy)
+    with open_log(log_folder, 'worker-utilization.log') as log:
+        log.write(tabulate(
+            [(pid, chunks[pid], files[pid], '%.1f' % busy[pid],
+              '%.0f%%' % (utilizations[pid] * 100))
+             for pid in sorted(busy)],
+            headers=['Worker PID', 'Chunks', 'Files', 'Busy (s)',
+                     'Utilization']) + '\n')
+    print ('Indexed files in %.1fs. Worker utilization: %.0f%% mean, %.0f%% '
+           'min.' % (span,
+                     100 * sum(utilizations.itervalues()) / len(utilizations),
+                     100 * min(utilizations.itervalues())))
+
+
+def report_bulk_stats(timings, log_folder):
+    """Print the throughput of bulk indexing requests, and log a histogram of
+    their latencies.
+
+    :arg timings: An iterable of ChunkTimings
+
+    """
+    timings = list(timings)
+    if not timings:
+        return
+    stats = reduce(BulkStats.merge, (t.bulk_stats for t in timings),
+                   BulkStats())
+    if not stats.requests:
+        return
+    span = _indexing_span(timings)
+    summary = ('Sent %s bulk requests: %.0f docs/s, %.2f MB/s, %.3fs mean '
+               'latency.' % (stats.requests,
+                             stats.docs / span,
+                             stats.bytes / span / 1024 / 1024,
+                             stats.seconds / stats.requests))
+    with open_log(log_folder, 'bulk-indexing.log') as log:
+        log.write(summary + '\n\n')
+        log.write(tabulate(stats.histogram_rows(),
+                           headers=['Latency', 'Requests']) + '\n')
+    print summary
+
+
+def report_duplicates(profile):
+    """Print how many files had their per-line tags copied from identical
+    files rather than computed afresh, and how many had their docs copied
+    from the previous index.
+
+    :arg profile: The IndexingProfile of the file-indexing phase
+
+    """
+    files = profile.counters['files']
+    if files:
+        duplicates = profile.counters['deduplicated_files']
+        print ('Deduplicated %s of %s files by content (%.1f%%), and %s '
+               'plugin runs on others.' % (
+                   duplicates, files, 100.0 * duplicates / files,
+                   profile.counters['deduplicated_plugin_runs']))
+    reused = profile.counters['reused_files']
+    if reused:
+        print ('Copied the docs of %s unchanged files from the previous '
+               'index.' % reused)
+
+
+def _indexing_span(timings):
+    """Return the seconds from the start of the first chunk to the end of the
+    last."""
+    return (max(t.finished for t in timings) -
+            min(t.started for t in timings)) or 1e-6
 
 
 def _fill_and_write_template(jinja_env, template_name, out_path, vars):
@@ -1,9 +1,9 @@
 from click import ClickException, command, echo, option
-from pyelasticsearch import ElasticSearch, ElasticHttpNotFoundError
+from pyelasticsearch import ElasticHttpNotFoundError
 
 from dxr.cli.utils import config_option, tree_names_argument
 from dxr.config import FORMAT
-from dxr.es import TREE
+from dxr.es import connect, TREE
 
 
 @command()
@@ -23,7 +23,7 @@ def delete(config, tree_names, all, force):
     this runs under.
 
     """
-    es = ElasticSearch(config.es_hosts)
+    es = connect(config.es_hosts)
     if all:
         echo('Deleting catalog...')
         es.delete_index(config.es_catalog_index)
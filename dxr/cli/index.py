@@ -10,8 +10,20 @@ from dxr.cli.utils import tree_objects, config_option, tree_names_argument
         is_flag=True,
         help='Display the build logs during the build instead of only '
              'on error.')
+@option('--incremental', '-i',
+        is_flag=True,
+        help="Copy the documents of files that haven't changed since the "
+             "live index was built instead of re-indexing them.")
+@option('--checkpoint', '-c',
+        is_flag=True,
+        help='Journal progress, and keep the partial index if indexing '
+             'fails so it can be finished with --resume.')
+@option('--resume', '-r',
+        is_flag=True,
+        help='Finish the partial index left by a failed --checkpoint run, '
+             'skipping work that was already done. Implies --checkpoint.')
 @tree_names_argument
-def index(config, verbose, tree_names):
+def index(config, verbose, incremental, checkpoint, resume, tree_names):
     """Build indices for one or more trees.
 
     When finished, update elasticsearch aliases and the catalog index to make
@@ -21,6 +33,22 @@ def index(config, verbose, tree_names):
     source tree to build. If none are specified, we build all trees, in the
     order they occur in the file.
 
+    With --incremental, only new and changed files are run through the
+    plugins' indexers; docs for the rest are copied from the live index. A
+    file counts as changed if its contents or the set of files beside it
+    have. This falls back to a full index if the format version, enabled
+    plugins, or plugin configuration have changed since the live index was
+    built.
+
+    With --checkpoint, a journal of finished work is kept in each tree's
+    temp_folder. If indexing then fails, the partial index is left in place,
+    and --resume reattaches to it: the build is skipped if it had finished,
+    and only the files which weren't yet safely indexed are indexed again.
+
     """
     for tree in tree_objects(tree_names, config):
-        index_and_deploy_tree(tree, verbose=verbose)
+        index_and_deploy_tree(tree,
+                              verbose=verbose,
+                              incremental=incremental,
+                              checkpoint=checkpoint,
+                              resume=resume)
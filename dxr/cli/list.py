@@ -1,11 +1,10 @@
 from click import command, echo, secho
 from itertools import izip
-from pyelasticsearch import ElasticSearch
 from tabulate import tabulate
 
 from dxr.cli.utils import config_option
 from dxr.config import FORMAT
-from dxr.es import TREE, sources
+from dxr.es import connect, TREE, sources
 
 
 @command()
@@ -19,7 +18,7 @@ def list(config):
     secho('Current format: %s' % FORMAT, fg='green')
     echo('Catalog: %s\n' % config.es_catalog_index)
 
-    es = ElasticSearch(config.es_hosts)
+    es = connect(config.es_hosts)
     query = {
         'query': {
             'match_all': {}
@@ -0,0 +1,81 @@
+"""Gzip compression of responses, whether on the fly or ahead of time"""
+
+import zlib
+
+from flask import request
+
+
+# Types worth compressing. Most images and such are compressed already.
+COMPRESSIBLE_MIMETYPES = frozenset(['application/javascript',
+                                    'application/json',
+                                    'image/svg+xml',
+                                    'text/css',
+                                    'text/html',
+                                    'text/javascript',
+                                    'text/plain'])
+
+
+def accepts_gzip():
+    """Return whether the client of the current request takes gzipped
+    responses."""
+    return 'gzip' in request.accept_encodings
+
+
+def gzip_compressor():
+    """Return a zlib compressor which emits the gzip format."""
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzipped(data):
+    """Return a bytestring, gzipped."""
+    compressor = gzip_compressor()
+    return compressor.compress(data) + compressor.flush()
+
+
+def gunzipped(data):
+    """Return a gzipped bytestring, uncompressed."""
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def gzipped_chunks(chunks):
+    """Gzip an iterable of bytestrings, yielding a compressed chunk as each
+    comes in so a streamed response keeps streaming."""
+    compressor = gzip_compressor()
+    for chunk in chunks:
+        compressed = compressor.compress(chunk) + compressor.flush(
+            zlib.Z_SYNC_FLUSH)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def compress_response(response, min_size):
+    """Gzip a response if its type is worth it and the client takes it, and
+    return it. Meant for use as an ``after_request`` hook.
+
+    Responses already bearing a Content-Encoding, like pre-compressed ones,
+    and files being sent straight from disk are left alone.
+
+    :arg min_size: The number of bytes below which a response isn't worth
+        compressing. Streamed responses, whose size isn't known up front, are
+        always compressed.
+
+    """
+    if (response.status_code != 200 or
+            response.direct_passthrough or
+            'Content-Encoding' in response.headers or
+            response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not accepts_gzip():
+        return response
+    if response.is_streamed:
+        response.response = gzipped_chunks(response.iter_encoded())
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(gzipped(data))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
@@ -6,7 +6,7 @@ Please update docs/source/configuration.rst when you change this.
 from datetime import datetime
 from multiprocessing import cpu_count
 from ordereddict import OrderedDict
-from os import getcwd
+from os import environ, getcwd
 from os.path import abspath
 
 from configobj import ConfigObj
@@ -17,7 +17,7 @@ from schema import Optional, Use, And, Schema, SchemaError
 
 from dxr.exceptions import ConfigError
 from dxr.plugins import all_plugins_but_core, core_plugin
-from dxr.utils import cd, if_raises
+from dxr.utils import cd, if_raises, IgnoreMatcher
 
 
 # Format version, signifying the instance format this web frontend code is
@@ -97,6 +97,11 @@ class Config(DotSection):
             'DXR': {
                 Optional('temp_folder', default=abspath('dxr-temp-{tree}')):
                     AbsPath,
+                Optional('catalog_cache_seconds', default=10):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"catalog_cache_seconds" must be a non-negative '
+                              'integer.'),
                 Optional('default_tree', default=None): basestring,
                 Optional('disabled_plugins', default=plugin_list('')): Plugins,
                 Optional('enabled_plugins', default=plugin_list('*')): Plugins,
@@ -113,7 +118,36 @@ class Config(DotSection):
                 Optional('skip_stages', default=[]): WhitespaceList,
                 Optional('www_root', default=''): Use(lambda v: v.rstrip('/')),
                 Optional('google_analytics_key', default=''): basestring,
-                Optional('es_hosts', default='http://127.0.0.1:9200/'):
+                Optional('gzip_min_bytes', default=1024):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"gzip_min_bytes" must be a non-negative '
+                              'integer.'),
+                Optional('http_cache_seconds', default=0):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"http_cache_seconds" must be a non-negative '
+                              'integer.'),
+                Optional('render_cache_folder', default=''):
+                    Use(lambda v: abspath(v) if v else ''),
+                Optional('query_cache_size', default=1000):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"query_cache_size" must be a non-negative '
+                              'integer.'),
+                Optional('regex_verification', default='script'):
+                    And(basestring,
+                        lambda v: v in ('script', 'python'),
+                        error='"regex_verification" must be "script" or '
+                              '"python".'),
+                Optional('search_cache_size', default=200):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"search_cache_size" must be a non-negative '
+                              'integer.'),
+                Optional('es_hosts',
+                         default=environ.get('DXR_ES_HOSTS',
+                                             'http://127.0.0.1:9200/')):
                     WhitespaceList,
                 # A semi-random name, having the tree name and format version in it.
                 Optional('es_index', default='dxr_{format}_{tree}_{unique}'):
@@ -139,6 +173,21 @@ class Config(DotSection):
                         lambda v: v >= 0,
                         error='"es_indexing_retries" must be a non-negative '
                               'integer.'),
+                Optional('es_indexing_docs_per_chunk', default=300):
+                    And(Use(int),
+                        lambda v: v > 0,
+                        error='"es_indexing_docs_per_chunk" must be a '
+                              'positive integer.'),
+                Optional('es_indexing_bytes_per_chunk', default=10000):
+                    And(Use(int),
+                        lambda v: v > 0,
+                        error='"es_indexing_bytes_per_chunk" must be a '
+                              'positive integer.'),
+                Optional('es_indexing_requests_in_flight', default=2):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"es_indexing_requests_in_flight" must be a '
+                              'non-negative integer.'),
                 Optional('es_refresh_interval', default=60):
                     Use(int, error='"es_refresh_interval" must be an integer.')
             },
@@ -292,6 +341,15 @@ class TreeConfig(DotSectionWrapper):
         """Return ``self.temp_folder`` with the tree name subbed in."""
         return self.config.temp_folder.format(tree=self.name)
 
+    @property
+    def ignore_matcher(self):
+        """Return an :class:`~dxr.utils.IgnoreMatcher` for this tree's
+        ignore patterns, compiled the first time it's asked for."""
+        if not hasattr(self, '_ignore_matcher'):
+            self._ignore_matcher = IgnoreMatcher(self.ignore_filenames,
+                                                 self.ignore_paths)
+        return self._ignore_matcher
+
 
 class ListAndAll(list):
     """A list we can also store an ``all`` attr on, indicating whether it
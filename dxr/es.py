@@ -1,10 +1,20 @@
 """Elasticsearch utilities not general enough to lift into pyelasticsearch"""
 
-from flask import current_app
-from pyelasticsearch import ElasticHttpNotFoundError
+from bisect import bisect_left
+import json
+from Queue import Queue
+from sys import exc_info
+from threading import Lock, Thread
+from time import time
+from weakref import WeakSet
+
+from flask import current_app, g, has_app_context
+from pyelasticsearch import (ElasticSearch, ElasticHttpError,
+                             ElasticHttpNotFoundError)
 from werkzeug.exceptions import NotFound
 
 from dxr.config import FORMAT
+from dxr.es_sqlite import path_from_url, SqliteElasticSearch
 
 
 UNINDEXED_STRING = {
@@ -34,14 +44,142 @@ UNINDEXED_LONG = {
 TREE = 'tree'  # 'tree' doctype
 
 
+def connect(hosts, **kwargs):
+    """Return a pyelasticsearch-compatible client for the ``es_hosts`` config
+    option.
+
+    A ``sqlite:`` URL gets an embedded :class:`~dxr.es_sqlite.
+    SqliteElasticSearch`, which needs no cluster. Anything else is taken to be
+    a list of ES nodes.
+
+    :arg kwargs: Passed to the client's constructor, like ``timeout``
+
+    """
+    urls = [hosts] if isinstance(hosts, basestring) else hosts
+    if urls and path_from_url(urls[0]) is not None:
+        return SqliteElasticSearch(urls[0], **kwargs)
+    return ElasticSearch(hosts, **kwargs)
+
+
+# Every CatalogCache in this process, so a deploy can reach them without an
+# app context:
+_catalog_caches = WeakSet()
+
+
+class CatalogCache(object):
+    """A per-process copy of the catalog's tree docs, refetched at most every
+    ``ttl`` seconds
+
+    A page view asks for frozen configs several times, and the catalog
+    changes only on deploy, so there's no sense going to ES for each. All the
+    trees of the current format come back in one search and are served from
+    memory until they expire.
+
+    Request threads share an instance, so its state is swapped under a lock
+    as a single (configs, by-name, generation) snapshot, and readers never see
+    a half-refreshed mix. With caching off, a snapshot still lasts for the
+    rest of the app context, so one request sees one catalog and pays for
+    only one search.
+
+    """
+    def __init__(self, ttl):
+        """
+        :arg ttl: How many seconds to trust the cached catalog. 0 disables
+            caching across requests.
+
+        """
+        self.ttl = ttl
+        self._lock = Lock()
+        self._snapshot = [], {}, None
+        self._expires = 0
+        _catalog_caches.add(self)
+
+    def invalidate(self):
+        """Forget the cached catalog, so the next lookup refetches it."""
+        with self._lock:
+            self._expires = 0
+        if has_app_context():
+            g.catalog_snapshot = None
+
+    def configs(self):
+        """Return a list of dicts, each describing a tree of the current
+        format version, sorted by name."""
+        return self._fresh_snapshot()[0]
+
+    def generation(self):
+        """Return a value which changes whenever the catalog gains, loses,
+        or regenerates a tree, for keying caches derived from it.
+
+        It's built from the trees' ``generated_date``\ s, so a refetch that
+        finds nothing new leaves it, and those caches, alone.
+
+        """
+        return self._fresh_snapshot()[2]
+
+    def config(self, tree_name):
+        """Return the frozen config of one tree, or raise NotFound."""
+        try:
+            return self._fresh_snapshot()[1][tree_name]
+        except KeyError:
+            # Maybe it was deployed since we last looked. Ask directly, so a
+            # new tree doesn't 404 until the cache expires:
+            frozen = _fetch_frozen_config(tree_name)
+            self.invalidate()
+            return frozen
+
+    def _fresh_snapshot(self):
+        """Return the current (configs, by-name, generation) tuple, refetching
+        it first if it has expired.
+
+        The lock is held across the fetch so that threads arriving at an
+        expired cache wait for one search rather than each making their own.
+
+        """
+        if not self.ttl:
+            snapshot = g.get('catalog_snapshot')
+            if snapshot is None:
+                snapshot = g.catalog_snapshot = self._fetch_snapshot()
+            return snapshot
+        with self._lock:
+            now = time()
+            if now >= self._expires:
+                self._snapshot = self._fetch_snapshot()
+                self._expires = now + self.ttl
+            return self._snapshot
+
+    @staticmethod
+    def _fetch_snapshot():
+        """Search the catalog for the trees of the current format, and return
+        a (configs, by-name, generation) tuple."""
+        configs = filtered_query(current_app.dxr_config.es_catalog_index,
+                                 TREE,
+                                 filter={'format': FORMAT},
+                                 sort=['name'],
+                                 size=10000)
+        return (configs,
+                dict((c['name'], c) for c in configs),
+                tuple((c['name'], c.get('generated_date')) for c in configs))
+
+
+def invalidate_catalog_cache():
+    """Make every catalog cache in this process refetch the catalog next time
+    it's asked for a frozen config.
+
+    Call this after changing the catalog. It needs no app context, so
+    ``dxr deploy`` and ``dxr index`` reach any app living in the same process.
+    Web servers are separate processes, though; their caches pick up a
+    deploy only when they expire, so ``catalog_cache_seconds`` is what bounds
+    how stale they can get.
+
+    """
+    for cache in list(_catalog_caches):
+        cache.invalidate()
+
+
 def frozen_configs():
     """Return a list of dicts, each describing a tree of the current format
     version."""
-    return filtered_query(current_app.dxr_config.es_catalog_index,
-                          TREE,
-                          filter={'format': FORMAT},
-                          sort=['name'],
-                          size=10000)
+    return current_app.catalog_cache.configs()
 
 
 def frozen_config(tree_name):
@@ -51,6 +189,12 @@ def frozen_config(tree_name):
     version. Raise NotFound if the tree
 
     """
+    return current_app.catalog_cache.config(tree_name)
+
+
+def _fetch_frozen_config(tree_name):
+    """Get a tree's frozen config straight from the catalog, bypassing the
+    cache."""
     try:
         frozen = current_app.es.get(current_app.dxr_config.es_catalog_index,
                                     TREE,
@@ -105,6 +249,129 @@ def filtered_query_hits(index, doc_type, filter, sort=None, size=1, include=None
         size=size)['hits']['hits']
 
 
+def filtered_query_pages(index, doc_type, filter, key, size=1000,
+                         include=None, exclude=None):
+    """Yield the sources of the docs matching some term filters, in order of
+    a field whose values are unique among them, pulling them from ES a page at
+    a time.
+
+    Each page after the first picks up where the last left off by way of a
+    range filter on the key field, so, unlike a single search with an
+    enormous ``size``, this keeps memory flat on both ends no matter how many
+    docs match. Unlike :func:`scroll_hits`, it costs only one round trip when
+    everything fits on the first page, and it leaves no search context open
+    on the ES side.
+
+    :arg filter: A dict of field names to values, all of which must match
+    :arg key: The name of the field to sort and page by, like ``number`` for
+        the LINE docs of a single file
+    :arg size: The number of docs to fetch per round trip
+
+    ``include`` and ``exclude`` are mutually exclusive for now.
+
+    """
+    terms = [{'term': {field: value}} for field, value in filter.iteritems()]
+    query = {'query': {'filtered': {'query': {'match_all': {}}}},
+             'sort': [key]}
+    if include is not None:
+        query['_source'] = {'include': include}
+    elif exclude is not None:
+        query['_source'] = {'exclude': exclude}
+    last = None
+    while True:
+        filters = (terms if last is None else
+                   terms + [{'range': {key: {'gt': last}}}])
+        query['query']['filtered']['filter'] = {'and': filters}
+        hits = current_app.es.search(query,
+                                     index=index,
+                                     doc_type=doc_type,
+                                     size=size)['hits']['hits']
+        for hit in hits:
+            yield hit['_source']
+        if len(hits) < size:
+            break
+        last = hits[-1]['sort'][0]
+
+
+def multi_search(es, searches, index=None):
+    """Run several searches in a single round trip, and return their
+    responses, in order.
+
+    :arg searches: An iterable of (doc type, query) pairs, where each query
+        is what you'd pass to ``es.search()``. To search different indices in
+        one go, pass (index, doc type, query) triples instead.
+    :arg index: The index or alias to search, for searches that don't name
+        their own
+
+    If any search fails, raise an ElasticHttpError.
+
+    """
+    def header(search):
+        if len(search) == 3:
+            return {'index': search[0], 'type': search[1]}
+        return {'type': search[0]}
+
+    body = ''.join('%s\n%s\n' % (json.dumps(header(search)),
+                                  json.dumps(search[-1]))
+                   for search in searches)
+    path = [index, '_msearch'] if index else ['_msearch']
+    responses = es.send_request('GET', path, body)['responses']
+    for response in responses:
+        if 'error' in response:
+            raise ElasticHttpError(500, response['error'])
+    return responses
+
+
+def scroll_pages(es, query, index, doc_type=None, size=500, scroll='1m'):
+    """Yield the ES response for each page of a query's hits, pulling them
+    from ES a page at a time, until they run out.
+
+    Unlike paging with ``from``, which makes ES find and sort every hit up to
+    the page's end each time, a scroll picks up where it left off, so a deep
+    page costs no more than the first. Sorts in the query are honored.
+
+    :arg size: The number of hits to fetch per round trip (per shard, if the
+        query has no sort)
+    :arg scroll: How long ES should keep the search context alive between
+        pages
+
+    """
+    response = es.search(query,
+                         index=index,
+                         doc_type=doc_type,
+                         size=size,
+                         es_scroll=scroll)
+    scroll_id = response.get('_scroll_id')
+    try:
+        while response['hits']['hits']:
+            yield response
+            response = es.send_request('GET',
+                                       ['_search', 'scroll'],
+                                       scroll_id,
+                                       query_params={'scroll': scroll})
+            scroll_id = response.get('_scroll_id', scroll_id)
+    finally:
+        if scroll_id:
+            try:
+                es.send_request('DELETE', ['_search', 'scroll'], scroll_id)
+            except ElasticHttpNotFoundError:
+                pass  # It already expired.
+
+
+def scroll_hits(es, query, index, doc_type=None, size=500, scroll='1m'):
+    """Yield every hit of a query, pulling them from ES a page at a time.
+
+    This keeps memory flat on both ends no matter how many docs match, unlike
+    a single search with an enormous ``size``. Arguments are as for
+    :func:`scroll_pages()`.
+
+    """
+    for response in scroll_pages(es, query, index, doc_type=doc_type,
+                                 size=size, scroll=scroll):
+        for hit in response['hits']['hits']:
+            yield hit
+
+
 def create_index_and_wait(es, index, settings=None):
     """Create a new index, and wait for all shards to become ready."""
     es.create_index(index, settings=settings)
@@ -117,3 +384,131 @@ def create_index_and_wait(es, index, settings=None):
 def sources(search_results):
     """Return just the _source attributes of some ES search results."""
     return [r['_source'] for r in search_results]
+
+
+class BulkStats(object):
+    """Counts of bulk requests, their sizes, and a histogram of their
+    latencies
+
+    Small and picklable so workers can send them back to the master, where
+    they're merged.
+
+    """
+    # Upper bounds, in seconds, of the latency histogram's buckets. The last
+    # bucket catches everything slower.
+    BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self):
+        self.requests = 0
+        self.docs = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+
+    def record(self, chunk, seconds):
+        """Note that a bulk request of ``chunk`` took ``seconds``."""
+        self.requests += 1
+        self.docs += len(chunk)
+        self.bytes += sum(len(action) + 1 for action in chunk)  # +1 for \n
+        self.seconds += seconds
+        self.histogram[bisect_left(self.BUCKETS, seconds)] += 1
+
+    def merge(self, other):
+        """Add the counts of another BulkStats to mine, and return myself."""
+        self.requests += other.requests
+        self.docs += other.docs
+        self.bytes += other.bytes
+        self.seconds += other.seconds
+        self.histogram = [a + b for a, b in zip(self.histogram,
+                                                other.histogram)]
+        return self
+
+    def histogram_rows(self):
+        """Return (bucket label, request count) pairs for display."""
+        labels = (['<= %gs' % b for b in self.BUCKETS] +
+                  ['> %gs' % self.BUCKETS[-1]])
+        return zip(labels, self.histogram)
+
+
+class BulkSender(object):
+    """A sender of bulk-indexing requests that runs in background threads so
+    the caller can go on generating docs while ES chews on the last batch
+
+    At most ``in_flight`` requests are outstanding at once, and at most that
+    many more chunks wait in line behind them. Past that, :meth:`send()`
+    blocks, so a fast indexer can't pile up unbounded RAM when ES falls
+    behind. With ``in_flight=0``, requests are sent synchronously.
+
+    Call :meth:`close()` when done, which waits for outstanding requests to
+    finish. If any request failed, :meth:`send()` or :meth:`close()`
+    re-raises its exception in the calling thread. If the caller gives up
+    partway, it should call :meth:`abort()` instead so the threads don't
+    linger; that's a no-op after :meth:`close()`, so it can go in a
+    ``finally``.
+
+    """
+    def __init__(self, es, index, doc_type=None, in_flight=1):
+        self.stats = BulkStats()
+        self._es = es
+        self._index = index
+        self._doc_type = doc_type
+        self._error = None
+        self._aborted = False
+        self._stats_lock = Lock()
+        self._queue = Queue(maxsize=in_flight)
+        self._threads = [Thread(target=self._send_forever)
+                         for _ in xrange(in_flight)]
+        for thread in self._threads:
+            thread.daemon = True  # Don't hang the process on a crash.
+            thread.start()
+
+    def send(self, chunk):
+        """Queue a chunk of bulk actions, as from
+        :func:`~pyelasticsearch.bulk_chunks()`, for sending."""
+        self._raise_if_failed()
+        if self._threads:
+            self._queue.put(chunk)
+        else:
+            self._send(chunk)
+
+    def close(self):
+        """Wait for all queued chunks to be sent, and stop the threads."""
+        self._stop_threads()
+        self._raise_if_failed()
+
+    def abort(self):
+        """Drop any chunks still waiting to be sent, and stop the threads
+        once they finish the requests they're on. Don't raise on failure."""
+        self._aborted = True
+        self._stop_threads()
+
+    def _stop_threads(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _send(self, chunk):
+        start = time()
+        self._es.bulk(chunk, index=self._index, doc_type=self._doc_type)
+        with self._stats_lock:
+            self.stats.record(chunk, time() - start)
+
+    def _send_forever(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            # After a failure, keep draining the queue so the producer doesn't
+            # block forever before it notices.
+            if self._error is None and not self._aborted:
+                try:
+                    self._send(chunk)
+                except Exception:
+                    self._error = exc_info()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            type, value, traceback = self._error
+            raise type, value, traceback
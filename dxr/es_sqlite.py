@@ -0,0 +1,1010 @@
+"""An embedded stand-in for an elasticsearch cluster, backed by SQLite
+
+This speaks just enough of the ES 1.x REST API, through pyelasticsearch's
+``send_request()`` funnel, to run DXR: index creation and aliases, bulk
+inserts, and the filtered queries, sorts, and scrolls DXR issues. It is meant
+for small trees and for running the test suite without a JVM, not for
+mozilla-central.
+
+Docs are stored as JSON and filtered in Python. Two side tables keep that
+from degenerating into a table scan for the common queries:
+
+* ``keywords`` holds the values of ``not_analyzed`` string fields, so term
+  lookups by path or folder hit an index.
+* ``trigrams`` holds the lowercase trigrams of every field that has an nGram
+  multi-field, like ``content.trigrams``. A ``match_phrase`` against such a
+  field is answered by intersecting the posting lists of the phrase's
+  trigrams, just as the ES trigram index would be, and the survivors are then
+  checked exactly. Regex searches get the same treatment, since
+  :func:`~dxr.trigrammer.es_regex_filter` boils them down to trigram phrases
+  plus a verifying script.
+
+"""
+from collections import namedtuple
+from fnmatch import fnmatchcase
+from itertools import islice
+import json
+import re
+import sqlite3
+from threading import local
+from time import time
+from uuid import uuid4
+
+from pyelasticsearch import ElasticHttpError, ElasticSearch
+
+
+# The longest keyword value worth indexing. Term lookups of longer values just
+# don't get accelerated.
+MAX_KEYWORD_LENGTH = 256
+
+# How many doc IDs to stuff into one "IN (...)" clause, staying well under
+# SQLite's limit on bound parameters:
+BATCH_SIZE = 500
+
+# What's left of a scroll: the search to re-run for each page, where the next
+# page starts, and when the scroll expires if not continued. Rerunning costs
+# a little time per page but keeps no hits in memory between them.
+Scroll = namedtuple('Scroll', ['path', 'body', 'offset', 'size', 'expires'])
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS indices (
+        name TEXT PRIMARY KEY,
+        settings TEXT NOT NULL,
+        mappings TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS aliases (
+        alias TEXT NOT NULL,
+        idx TEXT NOT NULL,
+        PRIMARY KEY (alias, idx));
+    CREATE TABLE IF NOT EXISTS docs (
+        doc INTEGER PRIMARY KEY,
+        idx TEXT NOT NULL,
+        type TEXT NOT NULL,
+        id TEXT NOT NULL,
+        source TEXT NOT NULL,
+        UNIQUE (idx, type, id));
+    CREATE TABLE IF NOT EXISTS keywords (
+        idx TEXT NOT NULL,
+        field TEXT NOT NULL,
+        value TEXT NOT NULL,
+        doc INTEGER NOT NULL);
+    CREATE INDEX IF NOT EXISTS keywords_value ON keywords (idx, field, value);
+    CREATE INDEX IF NOT EXISTS keywords_doc ON keywords (doc);
+    CREATE TABLE IF NOT EXISTS trigrams (
+        idx TEXT NOT NULL,
+        field TEXT NOT NULL,
+        trigram TEXT NOT NULL,
+        doc INTEGER NOT NULL,
+        PRIMARY KEY (idx, field, trigram, doc)) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS trigrams_doc ON trigrams (doc);
+"""
+
+
+class UnsupportedRequest(Exception):
+    """A request used a part of the ES API the SQLite backend doesn't
+    emulate"""
+
+
+def path_from_url(url):
+    """Return the database path from a ``sqlite:`` URL, or None if the URL
+    isn't one.
+
+    Both ``sqlite:relative/path.db`` and ``sqlite:///absolute/path.db`` are
+    accepted.
+
+    """
+    if not url.startswith('sqlite:'):
+        return None
+    path = url[len('sqlite:'):]
+    return path[2:] if path.startswith('//') else path
+
+
+class SqliteElasticSearch(ElasticSearch):
+    """A pyelasticsearch client which keeps everything in a SQLite file rather
+    than talking to a cluster
+
+    All the high-level methods of :class:`~pyelasticsearch.ElasticSearch` are
+    inherited and end up in :meth:`send_request()`, which routes them to the
+    database. Errors are raised as the same pyelasticsearch exceptions a real
+    cluster would cause, so callers can't tell the difference.
+
+    Each thread gets its own connection, and several processes can share a
+    file, as the indexing workers do.
+
+    """
+    def __init__(self, urls, timeout=60, **kwargs):
+        """
+        :arg urls: A ``sqlite:`` URL or a list whose first element is one
+        :arg timeout: How many seconds to wait for another process to release
+            a lock on the database
+
+        Other kwargs accepted by :class:`~pyelasticsearch.ElasticSearch` are
+        ignored.
+
+        """
+        if not isinstance(urls, basestring):
+            urls = urls[0]
+        self.path = path_from_url(urls)
+        if self.path is None:
+            raise ValueError('%s is not a sqlite: URL.' % urls)
+        self.timeout = timeout
+        self._local = local()
+        self._scrolls = {}  # scroll ID -> Scroll
+        self._analysis_cache = {}  # index name -> (mappings, analyzers)
+        self._indexed_cache = {}  # (index name, doc type) -> [Field]
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connection(self):
+        """Return this thread's connection to the database."""
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = self._local.connection = sqlite3.connect(
+                self.path, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def send_request(self, method, path_components, body='',
+                     query_params=None):
+        """Carry out an ES REST request against the database, and return what
+        ES would have."""
+        path = [p for p in path_components if p is not None and p != '']
+        if isinstance(body, basestring) and \
+                path[-1:] not in (['_bulk'], ['_msearch']) and \
+                path != ['_search', 'scroll']:
+            # Bulk and multi-search bodies and scroll IDs are the only
+            # non-JSON ones.
+            body = json.loads(body) if body.strip() else {}
+        query_params = query_params or {}
+        try:
+            return self._route(method, path, body, query_params)
+        except UnsupportedRequest as exc:
+            self._raise_exception(400, 'Unsupported by the SQLite backend: '
+                                       '%s %s (%s)' %
+                                       (method, '/'.join(path), exc))
+
+    def _route(self, method, path, body, params):
+        """Dispatch a request to the method that handles its REST path."""
+        last = path[-1] if path else ''
+        if path == ['_search', 'scroll']:
+            return (self._delete_scroll(body) if method == 'DELETE' else
+                    self._next_scroll_page(body, params))
+        if path[:2] == ['_cluster', 'health']:
+            return {'status': 'green', 'timed_out': False}
+        if last == '_bulk':
+            return self._bulk(path[0] if len(path) > 1 else None,
+                              path[1] if len(path) > 2 else None,
+                              body)
+        if last == '_search':
+            return self._search(path[:-1], body or {}, params)
+        if last == '_msearch':
+            return self._multi_search(path[:-1], body)
+        if last == '_count':
+            return {'count': len(self._hits(path[:-1], body or {}))}
+        if last == '_query' and method == 'DELETE':
+            return self._delete_by_query(path[:-1], body or {})
+        if '_aliases' in path:
+            if method == 'POST':
+                return self._update_aliases(body['actions'])
+            at = path.index('_aliases')
+            return self._get_aliases(path[:at], path[at + 1:])
+        if last == '_refresh' or last == '_optimize' or last == '_flush':
+            return {'_shards': {'failed': 0}}
+        if last == '_settings':
+            if method == 'PUT':
+                return self._update_settings(path[0], body)
+            return self._get_settings(path[:-1])
+        if len(path) == 1:
+            if method == 'PUT':
+                return self._create_index(path[0], body or {})
+            if method == 'DELETE':
+                return self._delete_index(path[0])
+        if len(path) == 3 and not path[2].startswith('_'):
+            if method == 'GET':
+                return self._get_doc(*path)
+            if method in ('PUT', 'POST'):
+                return self._put_doc(path[0], path[1], path[2], body,
+                                     params.get('op_type') == 'create')
+            if method == 'DELETE':
+                return self._delete_doc(*path)
+        if len(path) == 2 and method == 'POST':
+            return self._put_doc(path[0], path[1], None, body, False)
+        raise UnsupportedRequest('unknown endpoint')
+
+    # Indices and aliases:
+
+    def _index_names(self, conn):
+        return [row[0] for row in conn.execute('SELECT name FROM indices')]
+
+    def _resolve(self, conn, spec, must_exist=True):
+        """Turn a comma-delimited list of index names, aliases, and wildcards
+        into a list of concrete index names."""
+        names = self._index_names(conn)
+        aliases = {}
+        for alias, idx in conn.execute('SELECT alias, idx FROM aliases'):
+            aliases.setdefault(alias, []).append(idx)
+        if not spec or spec in ('_all', '*'):
+            return names
+        resolved = []
+        for part in spec.split(','):
+            if '*' in part or '?' in part:
+                resolved.extend(n for n in names if fnmatchcase(n, part))
+                for alias, targets in aliases.iteritems():
+                    if fnmatchcase(alias, part):
+                        resolved.extend(targets)
+            elif part in aliases:
+                resolved.extend(aliases[part])
+            elif part in names:
+                resolved.append(part)
+            elif must_exist:
+                self._raise_exception(404, 'IndexMissingException[[%s] '
+                                           'missing]' % part)
+        return sorted(set(resolved))
+
+    def _create_index(self, name, body, conn=None):
+        conn = conn or self._connection()
+        if name in self._index_names(conn):
+            self._raise_exception(400, 'IndexAlreadyExistsException[[%s] '
+                                       'already exists]' % name)
+        with conn:
+            conn.execute('INSERT INTO indices (name, settings, mappings) '
+                         'VALUES (?, ?, ?)',
+                         (name,
+                          json.dumps(body.get('settings', {})),
+                          json.dumps(body.get('mappings', {}))))
+        self._forget_analysis(name)
+        return {'acknowledged': True}
+
+    def _delete_index(self, spec):
+        conn = self._connection()
+        names = self._resolve(conn, spec)
+        with conn:
+            for name in names:
+                for table in ('keywords', 'trigrams', 'docs'):
+                    conn.execute('DELETE FROM %s WHERE idx=?' % table, (name,))
+                conn.execute('DELETE FROM aliases WHERE idx=?', (name,))
+                conn.execute('DELETE FROM indices WHERE name=?', (name,))
+                self._forget_analysis(name)
+        return {'acknowledged': True}
+
+    def _forget_analysis(self, name):
+        self._analysis_cache.pop(name, None)
+        for key in self._indexed_cache.keys():
+            if key[0] == name:
+                del self._indexed_cache[key]
+
+    def _get_settings(self, path):
+        conn = self._connection()
+        names = self._resolve(conn, path[0] if path else None)
+        return dict((name, {'settings': json.loads(settings)})
+                    for name, settings in conn.execute(
+                        'SELECT name, settings FROM indices WHERE name IN (%s)'
+                        % ','.join('?' * len(names)), names))
+
+    def _update_settings(self, spec, body):
+        conn = self._connection()
+        with conn:
+            for name in self._resolve(conn, spec):
+                settings = json.loads(conn.execute(
+                    'SELECT settings FROM indices WHERE name=?',
+                    (name,)).fetchone()[0])
+                settings.update(body)
+                conn.execute('UPDATE indices SET settings=? WHERE name=?',
+                             (json.dumps(settings), name))
+        return {'acknowledged': True}
+
+    def _update_aliases(self, actions):
+        conn = self._connection()
+        with conn:  # atomic, as in ES
+            for action in actions:
+                (verb, args), = action.items()
+                if verb == 'add':
+                    conn.execute('INSERT OR IGNORE INTO aliases (alias, idx) '
+                                 'VALUES (?, ?)',
+                                 (args['alias'], args['index']))
+                elif verb == 'remove':
+                    conn.execute('DELETE FROM aliases WHERE alias=? AND idx=?',
+                                 (args['alias'], args['index']))
+                else:
+                    raise UnsupportedRequest('alias action %s' % verb)
+        return {'acknowledged': True}
+
+    def _get_aliases(self, index_path, alias_path):
+        conn = self._connection()
+        # Like ES, answer with nothing rather than a 404 for unknown indices.
+        indices = self._resolve(conn, index_path[0] if index_path else None,
+                                must_exist=False)
+        patterns = (alias_path[0].split(',') if alias_path else ['*'])
+        # Listing all aliases includes the indices without any.
+        response = (dict((idx, {'aliases': {}}) for idx in indices)
+                    if patterns == ['*'] else {})
+        for alias, idx in conn.execute('SELECT alias, idx FROM aliases'):
+            if idx in indices and any(fnmatchcase(alias, p) for p in patterns):
+                response.setdefault(idx, {'aliases': {}})['aliases'][alias] = {}
+        return response
+
+    def _analysis(self, conn, idx):
+        """Return the mappings and analyzer definitions of an index."""
+        if idx not in self._analysis_cache:
+            row = conn.execute('SELECT settings, mappings FROM indices '
+                               'WHERE name=?', (idx,)).fetchone()
+            settings, mappings = ((json.loads(row[0]), json.loads(row[1]))
+                                  if row else ({}, {}))
+            analysis = settings.get('analysis', {})
+            tokenizers = analysis.get('tokenizer', {})
+            analyzers = {}
+            for name, definition in analysis.get('analyzer', {}).iteritems():
+                tokenizer = tokenizers.get(definition.get('tokenizer'), {})
+                analyzers[name] = Analyzer(
+                    lowercase='lowercase' in definition.get('filter', []),
+                    ngram=tokenizer.get('type') in ('nGram', 'ngram'))
+            analyzers['lowercase'] = analyzers.get(
+                'lowercase', Analyzer(lowercase=True, ngram=False))
+            self._analysis_cache[idx] = mappings, analyzers
+        return self._analysis_cache[idx]
+
+    def _indexed_fields(self, conn, idx, doc_type):
+        """Return the Fields of a doc type whose values go into the side
+        tables."""
+        key = idx, doc_type
+        if key not in self._indexed_cache:
+            mappings, analyzers = self._analysis(conn, idx)
+            self._indexed_cache[key] = list(Field.indexed(
+                mappings.get(doc_type, {}).get('properties', {}), analyzers))
+        return self._indexed_cache[key]
+
+    def _field(self, conn, idx, doc_type, name):
+        """Return a :class:`Field` describing how to look up a dotted field
+        name in the docs of one type."""
+        mappings, analyzers = self._analysis(conn, idx)
+        types = [doc_type] if doc_type else mappings.keys()
+        for type in types:
+            properties = mappings.get(type, {}).get('properties', {})
+            field = Field.from_mapping(name, properties, analyzers)
+            if field.mapping is not None:
+                return field
+        return Field(name.split('.'), None, None)
+
+    # Docs:
+
+    def _bulk(self, default_index, default_type, body):
+        lines = iter(body.splitlines())
+        items = []
+        conn = self._connection()
+        with conn:
+            for line in lines:
+                if not line.strip():
+                    continue
+                (verb, meta), = json.loads(line).items()
+                idx = meta.get('_index', default_index)
+                doc_type = meta.get('_type', default_type)
+                id = meta.get('_id')
+                if verb == 'delete':
+                    found = self._delete_doc_rows(conn, idx, doc_type, id)
+                    items.append({verb: {'_id': id,
+                                         'status': 200 if found else 404}})
+                    continue
+                if verb not in ('index', 'create'):
+                    raise UnsupportedRequest('bulk %s' % verb)
+                source = next(lines)
+                id = self._store(conn, idx, doc_type, id, source,
+                                 json.loads(source))
+                items.append({verb: {'_index': idx, '_type': doc_type,
+                                     '_id': id, 'status': 201}})
+        return {'errors': False, 'items': items}
+
+    def _store(self, conn, idx, doc_type, id, source, doc):
+        """Insert or replace a doc, and index its keywords and trigrams.
+        Return its ID."""
+        if idx not in self._index_names(conn):
+            self._create_index(idx, {}, conn=conn)  # as ES auto-creates them
+        if id is None:
+            id = uuid4().hex
+        self._delete_doc_rows(conn, idx, doc_type, id)
+        rowid = conn.execute(
+            'INSERT INTO docs (idx, type, id, source) VALUES (?, ?, ?, ?)',
+            (idx, doc_type, id, source)).lastrowid
+        keywords, trigrams = set(), set()
+        for field in self._indexed_fields(conn, idx, doc_type):
+            for value in field.values(doc):
+                if not isinstance(value, basestring):
+                    continue
+                if field.is_keyword and len(value) <= MAX_KEYWORD_LENGTH:
+                    keywords.add((field.name, value))
+                if field.has_trigrams:
+                    trigrams.update((field.name, t) for t in
+                                    trigrams_of(value.lower()))
+        conn.executemany('INSERT INTO keywords (idx, field, value, doc) '
+                         'VALUES (?, ?, ?, ?)',
+                         ((idx, f, v, rowid) for f, v in keywords))
+        conn.executemany('INSERT OR IGNORE INTO trigrams '
+                         '(idx, field, trigram, doc) VALUES (?, ?, ?, ?)',
+                         ((idx, f, t, rowid) for f, t in trigrams))
+        return id
+
+    def _delete_doc_rows(self, conn, idx, doc_type, id):
+        """Delete a doc by ID. Return whether there was one."""
+        row = conn.execute('SELECT doc FROM docs WHERE idx=? AND type=? '
+                           'AND id=?', (idx, doc_type, id)).fetchone()
+        if row:
+            self._delete_rowids(conn, [row[0]])
+        return bool(row)
+
+    def _delete_rowids(self, conn, rowids):
+        for batch in batches(rowids):
+            marks = ','.join('?' * len(batch))
+            for table in ('keywords', 'trigrams', 'docs'):
+                conn.execute('DELETE FROM %s WHERE doc IN (%s)' %
+                             (table, marks), batch)
+
+    def _put_doc(self, idx, doc_type, id, doc, create_only):
+        conn = self._connection()
+        with conn:
+            if create_only and conn.execute(
+                    'SELECT 1 FROM docs WHERE idx=? AND type=? AND id=?',
+                    (idx, doc_type, id)).fetchone():
+                self._raise_exception(409, 'DocumentAlreadyExistsException')
+            id = self._store(conn, idx, doc_type, id, json.dumps(doc), doc)
+        return {'_index': idx, '_type': doc_type, '_id': id, 'created': True}
+
+    def _get_doc(self, spec, doc_type, id):
+        conn = self._connection()
+        row = None
+        for idx in self._resolve(conn, spec):
+            row = conn.execute('SELECT idx, type, source FROM docs WHERE '
+                               'idx=? AND type=? AND id=?',
+                               (idx, doc_type, id)).fetchone()
+            if row:
+                break
+        if not row:
+            self._raise_exception(404, {'_index': spec, '_type': doc_type,
+                                        '_id': id, 'found': False})
+        return {'_index': row[0], '_type': row[1], '_id': id, 'found': True,
+                '_source': json.loads(row[2])}
+
+    def _delete_doc(self, spec, doc_type, id):
+        conn = self._connection()
+        with conn:
+            found = any([self._delete_doc_rows(conn, idx, doc_type, id)
+                         for idx in self._resolve(conn, spec)])
+        if not found:
+            self._raise_exception(404, {'_id': id, 'found': False})
+        return {'_id': id, 'found': True}
+
+    def _delete_by_query(self, path, body):
+        conn = self._connection()
+        hits = self._hits(path, body)
+        with conn:
+            self._delete_rowids(conn, [hit.rowid for hit in hits])
+        return {'_indices': {}}
+
+    # Searching:
+
+    def _search(self, path, body, params):
+        start = int(params.get('from', body.get('from', 0)))
+        size = int(params.get('size', body.get('size', 10)))
+        total, documents = self._page(path, body, start, size)
+        response = {'timed_out': False,
+                    '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                    'hits': {'total': total,
+                             'max_score': 1.0,
+                             'hits': documents}}
+        scroll = params.get('scroll', params.get('es_scroll'))
+        if scroll:
+            self._expire_scrolls()
+            scroll_id = uuid4().hex
+            self._scrolls[scroll_id] = Scroll(path, body, start + size, size,
+                                              time() + seconds(scroll))
+            response['_scroll_id'] = scroll_id
+        return response
+
+    def _page(self, path, body, start, size):
+        """Return the number of docs matching a search body and the
+        source-filtered dicts of ``size`` of them, starting at ``start``."""
+        hits = sort_hits(self._hits(path, body), body.get('sort'))
+        include, exclude = source_filter(body.get('_source'))
+        return len(hits), [hit.as_dict(include, exclude)
+                           for hit in islice(hits, start, start + size)]
+
+    def _next_scroll_page(self, scroll_id, params):
+        self._expire_scrolls()
+        scroll = self._scrolls.get(scroll_id)
+        if scroll is None:
+            self._raise_exception(404, 'SearchContextMissingException[%s]'
+                                       % scroll_id)
+        total, documents = self._page(scroll.path, scroll.body,
+                                      scroll.offset, scroll.size)
+        # Like ES, each page renews the scroll for as long as it asks:
+        keep_alive = params.get('scroll')
+        self._scrolls[scroll_id] = scroll._replace(
+            offset=scroll.offset + scroll.size,
+            expires=(time() + seconds(keep_alive) if keep_alive else
+                     scroll.expires))
+        return {'_scroll_id': scroll_id,
+                'hits': {'total': total, 'hits': documents}}
+
+    def _delete_scroll(self, scroll_id):
+        if self._scrolls.pop(scroll_id, None) is None:
+            self._raise_exception(404, 'SearchContextMissingException[%s]'
+                                       % scroll_id)
+        return {'succeeded': True}
+
+    def _expire_scrolls(self):
+        """Forget scrolls that have gone unused for longer than they asked to
+        be kept, as ES would, so abandoned ones don't pile up."""
+        now = time()
+        for scroll_id, scroll in self._scrolls.items():
+            if scroll.expires <= now:
+                self._scrolls.pop(scroll_id, None)
+
+    def _multi_search(self, path, body):
+        lines = [line for line in body.splitlines() if line.strip()]
+        responses = []
+        for header, search in zip(lines[::2], lines[1::2]):
+            header = json.loads(header)
+            search_path = [header.get('index', path[0] if path else None)]
+            doc_type = header.get('type', path[1] if len(path) > 1 else None)
+            if doc_type:
+                search_path.append(doc_type)
+            try:
+                responses.append(self._search(search_path,
+                                              json.loads(search),
+                                              {}))
+            except ElasticHttpError as exc:
+                responses.append({'error': exc.error})
+        return {'responses': responses}
+
+    def _hits(self, path, body):
+        """Return a list of :class:`Hit` objects for every doc matching a
+        search body."""
+        conn = self._connection()
+        indices = self._resolve(conn, path[0] if path else None)
+        types = path[1].split(',') if len(path) > 1 else []
+        clauses = [body.get('query'), body.get('filter')]
+        hits = []
+        for idx in indices:
+            doc_type = types[0] if len(types) == 1 else None
+            evaluator = Evaluator(self, conn, idx, doc_type)
+            candidates = intersection(evaluator.candidates(c) for c in clauses
+                                      if c)
+            for hit in self._load(conn, idx, types, candidates):
+                if all(evaluator.matches(c, hit.source) for c in clauses
+                       if c):
+                    hits.append(hit)
+        return hits
+
+    def _load(self, conn, idx, types, rowids):
+        """Yield a Hit for each doc of an index having one of some types. If
+        ``rowids`` is not None, consider only docs among them."""
+        type_clause = ('AND type IN (%s)' % ','.join('?' * len(types))
+                       if types else '')
+        query = 'SELECT doc, type, id, source FROM docs WHERE idx=? ' + \
+                type_clause
+        if rowids is None:
+            # In a stable order, so re-run scrolls page consistently:
+            rows = conn.execute(query + ' ORDER BY doc', [idx] + types)
+        else:
+            rows = (row for batch in batches(sorted(rowids)) for row in
+                    conn.execute(query + ' AND doc IN (%s)' %
+                                 ','.join('?' * len(batch)),
+                                 [idx] + types + batch))
+        for rowid, type, id, source in rows:
+            yield Hit(rowid, idx, type, id, json.loads(source))
+
+
+class Analyzer(object):
+    """The bits of an ES analyzer that matter for matching: whether it folds
+    case and whether it splits text into ngrams"""
+
+    def __init__(self, lowercase, ngram):
+        self.lowercase = lowercase
+        self.ngram = ngram
+
+    def __call__(self, text):
+        return text.lower() if self.lowercase else text
+
+
+IDENTITY = Analyzer(lowercase=False, ngram=False)
+
+
+class Field(object):
+    """A resolved reference to a field, like "c_function.name.lower"
+
+    :ivar path: The list of keys leading to the field's values in a doc's
+        source
+    :ivar mapping: The ES mapping of the field, or None if unmapped
+    :ivar analyzer: The :class:`Analyzer` of a multi-field, or None if the
+        field is a plain one
+
+    """
+    def __init__(self, path, mapping, analyzer):
+        self.path = path
+        self.mapping = mapping
+        self.analyzer = analyzer
+
+    @property
+    def name(self):
+        return '.'.join(self.path)
+
+    @property
+    def is_keyword(self):
+        return (self.mapping.get('type', 'string') == 'string' and
+                self.mapping.get('index') == 'not_analyzed')
+
+    @property
+    def has_trigrams(self):
+        return self.mapping.get('has_trigrams', False)
+
+    @classmethod
+    def from_mapping(cls, name, properties, analyzers):
+        """Walk the mapping to find a dotted field, noticing when the last
+        part names a multi-field rather than a property."""
+        parts = name.split('.')
+        mapping = None
+        for i, part in enumerate(parts):
+            if part in properties:
+                mapping = properties[part]
+                properties = mapping.get('properties', {})
+            elif mapping is not None and part in mapping.get('fields', {}):
+                analyzer_name = mapping['fields'][part].get('analyzer')
+                return cls(parts[:i], mapping,
+                           analyzers.get(analyzer_name, IDENTITY))
+            else:
+                return cls(parts, None, None)
+        return cls(parts, mapping, None)
+
+    @classmethod
+    def indexed(cls, properties, analyzers, prefix=()):
+        """Yield the Fields under some mapping properties that deserve rows in
+        the keywords or trigrams tables."""
+        for name, mapping in properties.iteritems():
+            path = list(prefix) + [name]
+            if 'properties' in mapping:
+                for field in cls.indexed(mapping['properties'], analyzers,
+                                         path):
+                    yield field
+                continue
+            has_trigrams = any(
+                analyzers.get(sub.get('analyzer'), IDENTITY).ngram for sub in
+                mapping.get('fields', {}).itervalues())
+            field = cls(path, dict(mapping, has_trigrams=has_trigrams), None)
+            if field.is_keyword or has_trigrams:
+                yield field
+
+    def values(self, source):
+        """Return the field's values in a doc, flattening arrays."""
+        values = [source]
+        for part in self.path:
+            next_values = []
+            for value in values:
+                for item in (value if isinstance(value, list) else [value]):
+                    if isinstance(item, dict) and part in item:
+                        next_values.append(item[part])
+            values = next_values
+        flattened = []
+        for value in values:
+            flattened.extend(value if isinstance(value, list) else [value])
+        return [v for v in flattened if v is not None]
+
+
+class Hit(object):
+    """A matching doc, on its way to becoming a search hit"""
+
+    def __init__(self, rowid, index, type, id, source):
+        self.rowid = rowid
+        self.index = index
+        self.type = type
+        self.id = id
+        self.source = source
+        self.sort = None
+
+    def as_dict(self, include=None, exclude=None):
+        source = self.source
+        if include is not None:
+            source = dict((k, v) for k, v in source.iteritems() if
+                          any(fnmatchcase(k, p) for p in include))
+        if exclude is not None:
+            source = dict((k, v) for k, v in source.iteritems() if not
+                          any(fnmatchcase(k, p) for p in exclude))
+        hit = {'_index': self.index, '_type': self.type, '_id': self.id,
+               '_score': 1.0, '_source': source}
+        if self.sort is not None:
+            hit['sort'] = self.sort
+        return hit
+
+
+class Evaluator(object):
+    """Something that checks docs against ES 1.x query and filter clauses,
+    and can narrow down the docs worth checking using the side tables
+
+    Queries and filters are treated alike, since DXR uses queries only for
+    their yes-or-no matching, never for scoring.
+
+    """
+    def __init__(self, es, conn, idx, doc_type):
+        self.es = es
+        self.conn = conn
+        self.idx = idx
+        self.doc_type = doc_type
+        self._fields = {}
+
+    def field(self, name):
+        if name not in self._fields:
+            self._fields[name] = self.es._field(self.conn, self.idx,
+                                                self.doc_type, name)
+        return self._fields[name]
+
+    def candidates(self, clause):
+        """Return the set of rowids of docs that could match a clause, or
+        None if I can't narrow it down."""
+        (kind, args), = clause.items()
+        if kind == 'filtered':
+            return intersection([
+                self.candidates(args['query']) if 'query' in args
+                else None,
+                self.candidates(args['filter']) if 'filter' in args
+                else None])
+        if kind == 'query':
+            return self.candidates(args)
+        if kind == 'and':
+            return intersection(self.candidates(c) for c in
+                                sub_clauses(args))
+        if kind == 'bool':
+            return intersection(self.candidates(c) for c in
+                                as_list(args.get('must', [])))
+        if kind == 'or':
+            sets = [self.candidates(c) for c in sub_clauses(args)]
+            if any(s is None for s in sets):
+                return None
+            return set().union(*sets)
+        if kind in ('term', 'terms'):
+            (name, values), = without_options(args).items()
+            field = self.field(name)
+            values = as_list(values)
+            if (field.mapping is None or field.analyzer is not None or
+                    not field.is_keyword or
+                    any(not isinstance(v, basestring) or
+                        len(v) > MAX_KEYWORD_LENGTH for v in values)):
+                return None
+            return set(rowid for batch in batches(values) for (rowid,) in
+                       self.conn.execute(
+                           'SELECT doc FROM keywords WHERE idx=? AND field=? '
+                           'AND value IN (%s)' % ','.join('?' * len(batch)),
+                           [self.idx, field.name] + batch))
+        if kind in ('match', 'match_phrase'):
+            (name, text), = args.items()
+            if isinstance(text, dict):
+                text = text['query']
+            field = self.field(name)
+            if not (field.analyzer and field.analyzer.ngram and
+                    field.mapping.get('fields')):
+                return None
+            grams = trigrams_of(text.lower())
+            if not grams or kind == 'match':
+                return None
+            docs = None
+            for gram in grams:
+                postings = set(row[0] for row in self.conn.execute(
+                    'SELECT doc FROM trigrams WHERE idx=? AND field=? AND '
+                    'trigram=?', (self.idx, field.name, gram)))
+                docs = postings if docs is None else docs & postings
+                if not docs:
+                    break
+            return docs
+        return None
+
+    def matches(self, clause, source):
+        """Return whether a doc's source satisfies a clause."""
+        (kind, args), = clause.items()
+        if kind == 'match_all':
+            return True
+        if kind == 'filtered':
+            return ((self.matches(args['query'], source) if 'query' in
+                     args else True) and
+                    (self.matches(args['filter'], source) if 'filter' in args
+                     else True))
+        if kind == 'query':
+            return self.matches(args, source)
+        if kind == 'constant_score':
+            return self.matches(args.get('filter') or args['query'], source)
+        if kind == 'and':
+            return all(self.matches(c, source) for c in sub_clauses(args))
+        if kind == 'or':
+            return any(self.matches(c, source) for c in sub_clauses(args))
+        if kind == 'not':
+            return not self.matches(args['filter'] if 'filter' in args
+                                    else args, source)
+        if kind == 'bool':
+            return (all(self.matches(c, source) for c in
+                        as_list(args.get('must', []))) and
+                    not any(self.matches(c, source) for c in
+                            as_list(args.get('must_not', []))) and
+                    (not args.get('should') or
+                     any(self.matches(c, source) for c in
+                         as_list(args['should']))))
+        if kind in ('term', 'terms'):
+            (name, wanted), = without_options(args).items()
+            values = self._analyzed_values(name, source)
+            return any(v in values for v in as_list(wanted))
+        if kind in ('match', 'match_phrase'):
+            (name, text), = args.items()
+            if isinstance(text, dict):
+                text = text['query']
+            field = self.field(name)
+            analyzer = field.analyzer or IDENTITY
+            text = analyzer(text)
+            values = self._analyzed_values(name, source)
+            if analyzer.ngram:
+                return any(text in v for v in values
+                           if isinstance(v, basestring))
+            return text in values
+        if kind == 'prefix':
+            (name, prefix), = without_options(args).items()
+            return any(isinstance(v, basestring) and v.startswith(prefix)
+                       for v in self._analyzed_values(name, source))
+        if kind == 'range':
+            (name, bounds), = args.items()
+            return any(in_range(v, bounds) for v in
+                       self._analyzed_values(name, source))
+        if kind == 'exists':
+            return bool(self.field(args['field']).values(source))
+        if kind == 'missing':
+            return not self.field(args['field']).values(source)
+        if kind == 'script':
+            return self._script_matches(args, source)
+        raise UnsupportedRequest(kind)
+
+    def _analyzed_values(self, name, source):
+        field = self.field(name)
+        analyzer = field.analyzer or IDENTITY
+        return [analyzer(v) if isinstance(v, basestring) else v
+                for v in field.values(source)]
+
+    def _script_matches(self, args, source):
+        """Run the one kind of script DXR sends: a JS regex test against the
+        first value of a field, as generated by
+        :func:`~dxr.trigrammer.es_regex_filter`."""
+        match = SCRIPT_RE.match(args.get('script', ''))
+        if not match:
+            raise UnsupportedRequest('script %r' % args.get('script'))
+        params = args.get('params', {})
+        regex = compiled_js_regex(params['pattern'], params.get('flags', ''))
+        values = self.field(match.group(1)).values(source)
+        return bool(values) and bool(regex.search(values[0]))
+
+
+SCRIPT_RE = re.compile(
+    r'''^\(new RegExp\(pattern, flags\)\)\.test\(doc\["([^"]+)"\]\[0\]\)$''')
+
+
+_js_regexes = {}
+
+
+def compiled_js_regex(pattern, flags):
+    """Compile a JS regex, as emitted by :class:`~dxr.trigrammer.
+    JsRegexVisitor`, into a Python one.
+
+    The only escape JS has that Python 2's unicode regexes lack is \\uXXXX,
+    so translate that.
+
+    """
+    key = pattern, flags
+    if key not in _js_regexes:
+        python = re.sub(r'(?<!\\)((?:\\\\)*)\\u([0-9a-fA-F]{4})',
+                        lambda m: m.group(1) + re.escape(
+                            unichr(int(m.group(2), 16))),
+                        pattern)
+        _js_regexes[key] = re.compile(
+            python, re.UNICODE | (re.IGNORECASE if 'i' in flags else 0))
+    return _js_regexes[key]
+
+
+def trigrams_of(text):
+    """Return the set of 3-character substrings of a string."""
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
+def intersection(sets):
+    """Intersect some sets, treating None as "everything". Return None if
+    all were None."""
+    result = None
+    for s in sets:
+        if s is not None:
+            result = s if result is None else result & s
+    return result
+
+
+def batches(items, size=BATCH_SIZE):
+    items = list(items)
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
+def as_list(thing):
+    return thing if isinstance(thing, list) else [thing]
+
+
+def sub_clauses(args):
+    """Return the clauses of an "and" or "or" filter, in either of the forms
+    ES takes."""
+    return args['filters'] if isinstance(args, dict) else args
+
+
+def without_options(args):
+    """Strip the options ES allows alongside the field of a term-ish
+    filter."""
+    return dict((k, v) for k, v in args.iteritems()
+                if k not in ('_cache', '_cache_key', '_name', 'execution',
+                             'boost'))
+
+
+def in_range(value, bounds):
+    for op, test in (('gte', lambda b: value >= b),
+                     ('gt', lambda b: value > b),
+                     ('lte', lambda b: value <= b),
+                     ('lt', lambda b: value < b),
+                     ('from', lambda b: value >= b),
+                     ('to', lambda b: value <= b)):
+        if op in bounds and bounds[op] is not None and not test(bounds[op]):
+            return False
+    return True
+
+
+def source_filter(spec):
+    """Return (include patterns, exclude patterns) from a search body's
+    ``_source`` value."""
+    if spec is None or spec is True:
+        return None, None
+    if spec is False:
+        return [], None
+    if isinstance(spec, basestring):
+        return [spec], None
+    if isinstance(spec, list):
+        return spec, None
+    return (as_list(spec['include']) if 'include' in spec else None,
+            as_list(spec['exclude']) if 'exclude' in spec else None)
+
+
+# ES time units, in seconds. A bare number is milliseconds.
+TIME_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60,
+              '': 0.001}
+
+
+def seconds(duration):
+    """Return the number of seconds in an ES duration string like "1m"."""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*(ms|s|m|h|d|)\s*$',
+                     str(duration))
+    if not match:
+        raise UnsupportedRequest('duration %s' % duration)
+    return float(match.group(1)) * TIME_UNITS[match.group(2)]
+
+
+def sort_hits(hits, spec):
+    """Sort a list of Hits in place as an ES sort spec says, fill out their
+    ``sort`` values, and return the list."""
+    if not spec:
+        return hits
+    keys = []
+    for item in as_list(spec):
+        if isinstance(item, basestring):
+            name, order = item, 'asc'
+        else:
+            (name, options), = item.items()
+            order = (options if isinstance(options, basestring) else
+                     options.get('order', 'asc'))
+        keys.append((Field(name.split('.'), None, None), order == 'desc'))
+
+    for hit in hits:
+        # Like ES, sort multi-valued fields by their least value when
+        # ascending and greatest when descending.
+        hit.sort = [(max if descending else min)(field.values(hit.source) or
+                                                 [None])
+                    for field, descending in keys]
+    # Stable sorts from the least significant key up. Missing values go last,
+    # whichever the order.
+    for i in reversed(xrange(len(keys))):
+        descending = keys[i][1]
+        present = [h for h in hits if h.sort[i] is not None]
+        missing = [h for h in hits if h.sort[i] is None]
+        present.sort(key=lambda h: h.sort[i], reverse=descending)
+        hits[:] = present + missing
+    return hits
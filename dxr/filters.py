@@ -87,6 +87,30 @@ class Filter(object):
         """
         raise NotImplementedError
 
+    def candidate_filter(self):
+        """Return an ES filter clause which finds a superset of what
+        :meth:`filter()` does without the expensive part, leaving
+        :meth:`matches()` to weed out the extras, or None if there's no such
+        shortcut.
+
+        DXR uses this in place of :meth:`filter()` when the
+        ``regex_verification`` option is "python", so, for example, regex
+        filters can lean on the trigram index alone and check the candidates
+        in-process rather than running a script in ES for each.
+
+        """
+        return None
+
+    def matches(self, result):
+        """Return whether a result found by :meth:`candidate_filter()` really
+        satisfies this filter.
+
+        :arg result: A mapping representing properties from a search result,
+            as for :meth:`highlight_content()`
+
+        """
+        raise NotImplementedError
+
     def highlight_path(self, result):
         """Return an unsorted iterable of extents that should be highlighted in
         the ``path`` field of a search result.
@@ -87,8 +87,9 @@ class TreeToIndex(PluginConfig):
     Instances must be pickleable so as to make the journey to worker processes.
     You might also want to keep the size down. It takes on the order of 2s for
     a 150MB pickle to make its way across process boundaries, including
-    pickling and unpickling time. For this reason, we send the TreeToIndex once
-    and then have it index several files before sending it again.
+    pickling and unpickling time. For this reason, after ``post_build()``, we
+    pickle the TreeToIndex to disk once, and each worker process unpickles it
+    once and then uses it for every file it indexes.
 
     """
     def __init__(self, plugin_name, tree, vcs_cache):
@@ -182,7 +183,15 @@ class FileToSkim(PluginConfig):
     to store it in the index. An instance of me is mostly an opportunity for a
     shared cache among my methods.
 
+    :ivar unindexed_only: Whether :meth:`is_interesting()` is always false
+        for indexed files--those given ``file_properties``. If so, views of
+        indexed files needn't make me at all, so they can mark up and send
+        each line as it's fetched rather than fetching the whole file first.
+        Default: False
+
     """
+    unindexed_only = False
+
     def __init__(self, path, contents, plugin_name, tree, file_properties=None,
                  line_properties=None):
         """
@@ -351,7 +360,15 @@ class FileToSkim(PluginConfig):
 
 
 class FileToIndex(FileToSkim):
-    """A source of search and rendering data about one source file"""
+    """A source of search and rendering data about one source file
+
+    :ivar contents_only: Whether :meth:`refs()` and :meth:`regions()` depend on
+        nothing but the file's contents and name--not its folder, the build's
+        output, or anything else. If so, they are computed once for a batch of
+        byte-identical files and reused for the rest. Default: False
+
+    """
+    contents_only = False
 
     def __init__(self, path, contents, plugin_name, tree):
         """Analyze a file or digest an analysis that happened at compile time.
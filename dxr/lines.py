@@ -100,14 +100,30 @@ class Ref(object):
         """Convert ES-dwelling ref representation to a (start, end,
         :class:`~dxr.lines.Ref` subclass) triple.
 
+        :arg es_data: An item from the array under the 'refs' key of an ES LINE
+            document
+        :arg tree: The :class:`~dxr.config.TreeConfig` representing the tree
+            from which the ``es_data`` was pulled
+
+        """
+        return (es_data['start'],
+                es_data['end'],
+                Ref.from_es_payload(es_data['payload'], tree))
+
+    @staticmethod
+    def from_es_payload(payload, tree):
+        """Convert the ES-dwelling representation of a ref's payload to a
+        :class:`~dxr.lines.Ref` subclass.
+
         Return a subclass of Ref, chosen according to the ES data. Into its
         attributes "menu_data", "hover" and "qualname_hash", copy the ES
         properties of the same names, JSON-decoding "menu_data" first.
 
-        :arg es_data: An item from the array under the 'refs' key of an ES LINE
-            document
+        :arg payload: The 'payload' key of an item from the array under the
+            'refs' key of an ES LINE document, or an item of a
+            :class:`~dxr.lines.RefTable`
         :arg tree: The :class:`~dxr.config.TreeConfig` representing the tree
-            from which the ``es_data`` was pulled
+            from which the ``payload`` was pulled
 
         """
         def ref_class(plugin, id):
@@ -121,14 +137,11 @@ class Ref(object):
                      'in the index but not found in the current '
                      'implementation. Ignored.' % (plugin, id))
 
-        payload = es_data['payload']
         cls = ref_class(payload['plugin'], payload['id'])
-        return (es_data['start'],
-                es_data['end'],
-                cls(tree,
-                    json.loads(payload['menu_data']),
-                    hover=payload.get('hover'),
-                    qualname_hash=payload.get('qualname_hash')))
+        return cls(tree,
+                   json.loads(payload['menu_data']),
+                   hover=payload.get('hover'),
+                   qualname_hash=payload.get('qualname_hash'))
 
     def menu_items(self):
         """Return an iterable of menu items to be attached to a ref.
@@ -521,6 +534,69 @@ def es_lines(tags):
     # yield here to catch remnants.
 
 
+class RefTable(object):
+    """A deduplicated table of the ref payloads of a single file
+
+    The same few symbols tend to be referenced all over a file, so, rather
+    than each LINE doc repeating whole ref payloads, LINE docs hold packed
+    ``[start, end, index]`` triples in their ``packed_refs`` field, and the
+    FILE doc holds the table those indices point into, as a JSON string in
+    its ``ref_payloads`` field. Each distinct payload is then stored, sent to
+    ES, and decoded at request time only once per file.
+
+    :ivar payloads: The distinct payloads seen so far, in order of first
+        appearance
+
+    """
+    def __init__(self):
+        self.payloads = []
+        self._indices = {}  # hashable form of payload -> index in payloads
+
+    def pack(self, refs):
+        """Return packed triples for some refs as emitted by
+        :func:`es_lines()`, adding their payloads to the table as needed."""
+        return [[ref['start'], ref['end'], self._index(ref['payload'])]
+                for ref in refs]
+
+    def _index(self, payload):
+        key = tuple(sorted(payload.iteritems()))
+        index = self._indices.get(key)
+        if index is None:
+            index = self._indices[key] = len(self.payloads)
+            self.payloads.append(payload)
+        return index
+
+    def es(self):
+        """Return a serialization of the table to store in elasticsearch."""
+        return json.dumps(self.payloads)
+
+    @staticmethod
+    def es_to_triples(packed_refses, es_data, tree):
+        """Unpack the packed refs of a run of lines into (start, end,
+        :class:`~dxr.lines.Ref` subclass) triples.
+
+        Each distinct ref is made just once and shared among the triples.
+
+        :arg packed_refses: An iterable of the ``packed_refs`` fields of LINE
+            docs
+        :arg es_data: The ``ref_payloads`` field of their FILE doc
+        :arg tree: The :class:`~dxr.config.TreeConfig` representing the tree
+            from which the data was pulled
+
+        """
+        refs = RefTable.es_to_refs(es_data, tree)
+        return ((start, end, refs[index])
+                for start, end, index in chain.from_iterable(packed_refses))
+
+    @staticmethod
+    def es_to_refs(es_data, tree):
+        """Return a list of the :class:`~dxr.lines.Ref` subclasses a FILE
+        doc's ``ref_payloads`` field describes, which the indices in its LINE
+        docs' ``packed_refs`` point into."""
+        return [Ref.from_es_payload(payload, tree)
+                for payload in json.loads(es_data)]
+
+
 def html_line(text, tags, bof_offset):
     """Return a line of Markup, interleaved with the refs and regions that
     decorate it.
@@ -10,6 +10,8 @@ from dxr.plugins import Plugin, AdHocTreeToIndex
 
 
 class FileToIndex(dxr.indexers.FileToIndex):
+    contents_only = True
+
     def refs(self):
         for m in self.plugin_config.regex.finditer(self.contents):
             bug = m.group(1)
@@ -11,6 +11,7 @@ from flask import url_for
 from funcy import identity
 from jinja2 import Markup
 from parsimonious import ParseError
+from werkzeug.utils import cached_property
 
 from dxr.es import (UNINDEXED_STRING, UNANALYZED_STRING, UNINDEXED_INT,
                     UNINDEXED_LONG)
@@ -21,7 +22,7 @@ from dxr.mime import is_binary_image, is_textual_image
 from dxr.query import some_filters
 from dxr.plugins import direct_search
 from dxr.trigrammer import (regex_grammar, NGRAM_LENGTH, es_regex_filter,
-                            NoTrigrams, PythonRegexVisitor)
+                            es_trigram_filter, NoTrigrams, PythonRegexVisitor)
 from dxr.utils import glob_to_regex, split_content_lines, unicode_for_display
 
 __all__ = ['mappings', 'analyzers', 'TextFilter', 'PathFilter', 'FilenameFilter',
@@ -71,6 +72,8 @@ mappings = {
             # filename.cpp or leaf_folder (for sorting and display)
             'name': UNANALYZED_STRING,
             'size': UNINDEXED_INT,  # bytes. not present for folders.
+            # The number of LINE docs. Present only for text files.
+            'line_count': UNINDEXED_INT,
             'modified': {  # not present for folders
                 'type': 'date',
                 'index': 'no'
@@ -88,6 +91,16 @@ mappings = {
             },
             'description': UNINDEXED_STRING,
 
+            # SHA-1s of the file's bytes and of the names of the files beside
+            # it, so incremental builds can tell whether its docs can be
+            # copied rather than rebuilt:
+            'content_hash': UNINDEXED_STRING,
+            'siblings_hash': UNINDEXED_STRING,
+
+            # A JSON list of the distinct ref payloads the packed_refs of the
+            # file's LINE docs point into. See dxr.lines.RefTable.
+            'ref_payloads': UNINDEXED_STRING,
+
             # Sidebar nav links:
             'links': {
                 'type': 'object',
@@ -155,6 +168,12 @@ mappings = {
                 }
             },
 
+            # Refs as [start, end, index into the ref_payloads of the FILE
+            # doc] triples. See dxr.lines.RefTable.
+            'packed_refs': UNINDEXED_INT,
+
+            # Refs with their payloads inline, as indexed before packed_refs
+            # existed:
             'refs': {
                 'type': 'object',
                 'start': UNINDEXED_INT,
@@ -280,22 +299,48 @@ class TextFilter(Filter):
 
 
 class _PathSegmentFilterBase(Filter):
-    """A base class for a filter that matches a glob against a path segment."""
+    """A base class for a filter that matches a glob against a path segment.
+
+    :cvar path_seg_property_name: The property holding the path segment
+    :cvar no_trigrams_error_text: What to tell the user when the glob is too
+        vague to search for
+
+    """
     domain = FILE
 
-    def _regex_filter(self, path_seg_property_name, no_trigrams_error_text):
-        """Return an ES regex filter that matches this filter's glob against the
-        path segment at path_seg_property_name.
+    def __init__(self, term, enabled_plugins):
+        super(_PathSegmentFilterBase, self).__init__(term, enabled_plugins)
+        self._parsed_regex = regex_grammar.parse(glob_to_regex(term['arg']))
 
-        """
-        glob = self._term['arg']
+    @negatable
+    def filter(self):
+        """Return an ES regex filter that matches this filter's glob against
+        the path segment at path_seg_property_name."""
+        return self._regex_filter(es_regex_filter)
+
+    def candidate_filter(self):
+        if self._term['not']:
+            return None  # The inverse of a superset would be a subset.
+        return self._regex_filter(es_trigram_filter)
+
+    def matches(self, result):
+        return bool(self._compiled_regex.search(
+            result[self.path_seg_property_name][0]))
+
+    @cached_property
+    def _compiled_regex(self):
+        return re.compile(PythonRegexVisitor().visit(self._parsed_regex),
+                          flags=0 if self._term['case_sensitive'] else re.I)
+
+    def _regex_filter(self, make_filter):
+        """Return the ES filter made by ``make_filter``, one of the
+        ``es_*_filter`` functions from the trigrammer, for my glob."""
         try:
-            return es_regex_filter(
-                regex_grammar.parse(glob_to_regex(glob)),
-                path_seg_property_name,
-                is_case_sensitive=self._term['case_sensitive'])
+            return make_filter(self._parsed_regex,
+                               self.path_seg_property_name,
+                               is_case_sensitive=self._term['case_sensitive'])
         except NoTrigrams:
-            raise BadTerm(no_trigrams_error_text)
+            raise BadTerm(self.no_trigrams_error_text)
 
 
 class PathFilter(_PathSegmentFilterBase):
@@ -309,12 +354,9 @@ class PathFilter(_PathSegmentFilterBase):
     description = Markup('File or directory sub-path to search within. <code>*'
                          '</code>, <code>?</code>, and <code>[...]</code> act '
                          'as shell wildcards.')
-
-    @negatable
-    def filter(self):
-        return self._regex_filter('path',
-                                  'Path globs need at least 3 literal '
-                                  'characters in a row for speed.')
+    path_seg_property_name = 'path'
+    no_trigrams_error_text = ('Path globs need at least 3 literal characters '
+                              'in a row for speed.')
 
 
 class FilenameFilter(_PathSegmentFilterBase):
@@ -323,12 +365,9 @@ class FilenameFilter(_PathSegmentFilterBase):
     description = Markup('File to search within. <code>*</code>, '
                          '<code>?</code>, and <code>[...]</code> act as shell '
                          'wildcards.')
-
-    @negatable
-    def filter(self):
-        return self._regex_filter('file_name',
-                                  'File globs need at least 3 literal '
-                                  'characters in a row for speed.')
+    path_seg_property_name = 'file_name'
+    no_trigrams_error_text = ('File globs need at least 3 literal characters '
+                              'in a row for speed.')
 
 
 class ExtFilter(Filter):
@@ -377,8 +416,19 @@ class RegexpFilter(Filter):
 
     @negatable
     def filter(self):
+        return self._regex_filter(es_regex_filter)
+
+    def candidate_filter(self):
+        if self._term['not']:
+            return None  # The inverse of a superset would be a subset.
+        return self._regex_filter(es_trigram_filter)
+
+    def matches(self, result):
+        return bool(self._compiled_regex.search(result['content'][0]))
+
+    def _regex_filter(self, make_filter):
         try:
-            return es_regex_filter(
+            return make_filter(
                 self._parsed_regex,
                 'content',
                 is_case_sensitive=self._term['case_sensitive'])
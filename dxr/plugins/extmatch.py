@@ -5,8 +5,6 @@ Currently we match "Header" file extensions with "Implementation" file
 extensions.
 """
 
-from fnmatch import fnmatchcase
-import os
 from os.path import join, basename, splitext, isfile
 from collections import namedtuple
 
@@ -51,21 +49,12 @@ class FileToIndex(FileToIndexBase):
                 return self.ext_pairings[0]
             return _TitledExts((), '')
 
-        def is_indexed(path):
-            if any(fnmatchcase(basename(path), e)
-                   for e in self.tree.ignore_filenames):
-                return False
-            if any(fnmatchcase('/' + path.replace(os.sep, '/'), e)
-                   for e in self.tree.ignore_paths):
-                return False
-            return True
-
         path_no_ext, ext = splitext(self.path)
         dual_exts = dual_exts_for(ext)
         for dual_ext in dual_exts.exts:
             dual_path = path_no_ext + dual_ext
             if (isfile(join(self.tree.source_folder, dual_path)) and
-                is_indexed(dual_path)):
+                not self.tree.ignore_matcher.is_ignored_file(dual_path)):
                 yield (4,
                        dual_exts.title,
                        [(icon(dual_path),
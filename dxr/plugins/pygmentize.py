@@ -98,6 +98,8 @@ def _regions_for_contents(lexer, contents):
 
 class FileToIndex(dxr.indexers.FileToIndex):
     """Emitter of CSS classes for syntax-highlit regions"""
+    # The lexer is chosen by file name alone:
+    contents_only = True
 
     def regions(self):
         lexer = _lexer_for_filename(basename(self.path))
@@ -108,6 +110,8 @@ class FileToIndex(dxr.indexers.FileToIndex):
 
 class FileToSkim(dxr.indexers.FileToSkim):
     """Emitter of CSS classes for syntax-highlit regions"""
+    # Indexed files get their highlighting from FileToIndex:
+    unindexed_only = True
 
     def is_interesting(self):
         return not self.file_properties
@@ -53,7 +53,8 @@ class TreeToIndex(TreeToIndexBase):
     @property
     def unignored_files(self):
         return unignored(self.tree.source_folder, self.tree.ignore_paths,
-                         self.tree.ignore_filenames)
+                         self.tree.ignore_filenames,
+                         matcher=self.tree.ignore_matcher)
 
     def post_build(self):
         paths = ((path, self.tree.source_encoding)
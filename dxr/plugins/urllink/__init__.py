@@ -9,6 +9,8 @@ url_re = re.compile(r"https?://[A-Za-z0-9\-\._~:\/\?#[\]@!\$&'()*\+,;=%]+\.[A-Za
 
 
 class FileToIndex(dxr.indexers.FileToIndex):
+    contents_only = True
+
     def refs(self):
         for m in url_re.finditer(self.contents):
             url = m.group(0)
@@ -0,0 +1,142 @@
+"""Timing and memory instrumentation for indexing runs"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+from heapq import heappush, heappushpop, nlargest
+import json
+from os import getpid
+from os.path import join
+from resource import getrusage, RUSAGE_SELF
+from time import clock, time
+
+
+class IndexingProfile(object):
+    """Wall time, CPU time, and peak RSS accumulated per pipeline stage, plus
+    the slowest files indexed
+
+    Each worker fills out one of these for every chunk it indexes and sends it
+    back to the master, which merges them with :meth:`merge()` and writes the
+    result out with :meth:`write()`.
+
+    Stage names are of the form "phase:detail", like "post_build:clang" or
+    "file:clang.refs". Stage times are inclusive: since plugins' refs and
+    regions are lazily consumed by ``finished_tags``, for example, the
+    "file:finished_tags" stage includes the time spent in them.
+
+    Peak RSS is that of the process as of the end of the stage, in KB: the
+    high-water mark a stage might have pushed up, not memory it alone used.
+
+    Anything else worth tallying, like how many files were deduplicated, goes
+    in :attr:`counters`.
+
+    """
+    # How many of the slowest files to remember:
+    SLOWEST_FILES = 20
+
+    def __init__(self):
+        self.stages = {}  # name -> [calls, wall seconds, CPU seconds, peak RSS]
+        self.peak_rss_by_pid = {}
+        self.counters = defaultdict(int)
+        self._slowest_files = []  # a min-heap of (seconds, path)
+
+    @contextmanager
+    def timing(self, stage):
+        """Charge the time spent in a ``with`` block to a stage."""
+        wall, cpu = time(), clock()
+        try:
+            yield
+        finally:
+            self._record(stage, 1, time() - wall, clock() - cpu)
+
+    def timed_iter(self, stage, iterable, calls=1):
+        """Yield the items of an iterable, charging the time spent producing
+        them to a stage.
+
+        Plugins' refs(), needles(), and such are mostly generators, so they
+        don't do their work until they're iterated over.
+
+        :arg calls: How many calls to count toward the stage. Pass 0 if the
+            call that returned the iterable has already been counted.
+
+        """
+        iterator = iter(iterable)
+        wall = cpu = 0.0
+        try:
+            while True:
+                wall_start, cpu_start = time(), clock()
+                try:
+                    item = next(iterator)
+                finally:
+                    wall += time() - wall_start
+                    cpu += clock() - cpu_start
+                yield item
+        except StopIteration:
+            pass
+        finally:
+            self._record(stage, calls, wall, cpu)
+
+    def count(self, counter, amount=1):
+        """Add to one of my counters."""
+        self.counters[counter] += amount
+
+    def note_file(self, path, seconds):
+        """Remember a file if it's among the slowest to index so far."""
+        entry = seconds, path
+        if len(self._slowest_files) < self.SLOWEST_FILES:
+            heappush(self._slowest_files, entry)
+        else:
+            heappushpop(self._slowest_files, entry)
+
+    def merge(self, other):
+        """Add the measurements of another profile to mine, and return
+        myself."""
+        for stage, (calls, wall, cpu, rss) in other.stages.iteritems():
+            self._add(stage, calls, wall, cpu, rss)
+        for pid, rss in other.peak_rss_by_pid.iteritems():
+            self.peak_rss_by_pid[pid] = max(rss,
+                                            self.peak_rss_by_pid.get(pid, 0))
+        for counter, amount in other.counters.iteritems():
+            self.counters[counter] += amount
+        for entry in other._slowest_files:
+            self.note_file(entry[1], entry[0])
+        return self
+
+    def as_dict(self):
+        """Return a JSON-serializable summary of the profile."""
+        return {
+            'stages': dict((stage, {'calls': calls,
+                                    'wall_seconds': wall,
+                                    'cpu_seconds': cpu,
+                                    'peak_rss_kb': rss})
+                           for stage, (calls, wall, cpu, rss)
+                           in self.stages.iteritems()),
+            'counters': dict(self.counters),
+            'peak_rss_kb_by_pid': dict((str(pid), rss) for pid, rss in
+                                       self.peak_rss_by_pid.iteritems()),
+            'slowest_files': [{'path': path, 'seconds': seconds}
+                              for seconds, path in
+                              nlargest(self.SLOWEST_FILES,
+                                       self._slowest_files)]}
+
+    def write(self, folder, name='indexing-profile.json'):
+        """Write the profile as JSON into a folder, and return the path."""
+        path = join(folder, name)
+        with open(path, 'w') as file:
+            json.dump(self.as_dict(), file, indent=2, sort_keys=True)
+        return path
+
+    def _record(self, stage, calls, wall, cpu):
+        rss = getrusage(RUSAGE_SELF).ru_maxrss
+        pid = getpid()
+        self.peak_rss_by_pid[pid] = max(rss, self.peak_rss_by_pid.get(pid, 0))
+        self._add(stage, calls, wall, cpu, rss)
+
+    def _add(self, stage, calls, wall, cpu, rss):
+        totals = self.stages.get(stage)
+        if totals is None:
+            self.stages[stage] = [calls, wall, cpu, rss]
+        else:
+            totals[0] += calls
+            totals[1] += wall
+            totals[2] += cpu
+            totals[3] = max(totals[3], rss)
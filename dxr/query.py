@@ -1,15 +1,95 @@
 import cgi
-from itertools import chain, groupby
+from itertools import chain, groupby, izip
+import json
 from operator import itemgetter
 import re
 
 from parsimonious import Grammar, NodeVisitor
 
+from dxr.exceptions import BadTerm
 from dxr.filters import LINE, FILE
 from dxr.mime import icon
 from dxr.utils import append_update, cached
 
 
+# How many candidates to fetch from ES at a time when checking them in Python:
+VERIFY_PAGE_SIZE = 500
+
+# The most candidates to check in Python for one page of results. Past this,
+# the query is too unselective to beat ES's script filter, so we fall back to
+# that.
+MAX_VERIFY_CANDIDATES = 10000
+
+# The most files a path-restricted LINE search will be narrowed to up front
+# (see Query._file_paths()). Past this, a long ``terms`` filter isn't worth
+# it.
+MAX_FILE_PATHS = 1000
+
+# Rough relative costs of running ES filter clauses of various kinds, for
+# ordering them. A term lookup is nearly free, while a script runs once for
+# every doc that gets as far as it.
+FILTER_COSTS = {'term': 1,
+                'terms': 2,
+                'exists': 2,
+                'missing': 2,
+                'prefix': 5,
+                'range': 5,
+                'script': 1000}
+DEFAULT_FILTER_COST = 10
+
+# The cost of a trigram phrase match. Each trigram beyond the first makes it
+# more selective, so it's worth running sooner, down to a floor:
+PHRASE_COST = 30
+MIN_PHRASE_COST = 10
+
+
+def filter_cost(clause):
+    """Return a rough estimate of what it costs to run an ES filter clause,
+    taking into account how much it's likely to narrow down the docs the
+    clauses after it have to look at. Lower is better.
+
+    """
+    if len(clause) != 1:  # something with options we don't know about
+        return DEFAULT_FILTER_COST
+    (kind, args), = clause.items()
+    if kind in ('and', 'or'):
+        if isinstance(args, dict):
+            args = args.get('filters', [])
+        return sum(filter_cost(c) for c in args)
+    if kind == 'not':
+        return filter_cost(args.get('filter', args))
+    if kind == 'query' and args.keys() == ['match_phrase']:
+        (field, text), = args['match_phrase'].items()
+        if isinstance(text, dict):
+            text = text['query']
+        return max(PHRASE_COST - (len(text) - 3), MIN_PHRASE_COST)
+    return FILTER_COSTS.get(kind, DEFAULT_FILTER_COST)
+
+
+def planned(clauses):
+    """Return a list of ES filter clauses which will be ANDed or ORed
+    together, cheapest first and without duplicates.
+
+    ES tries ``and`` and ``or`` clauses in order and stops early when it can,
+    so an expensive clause like a regex script sees only the docs the cheap
+    ones let through.
+
+    """
+    unique = []
+    for clause in clauses:
+        if clause not in unique:
+            unique.append(clause)
+    return sorted(unique, key=filter_cost)  # stable, so ties keep their order
+
+
+def ored(clauses):
+    """Return an ES filter clause ORing together some others, leaving out
+    those that are None or empty, or None if that leaves nothing."""
+    clauses = planned(filter(None, clauses))
+    if clauses:
+        return clauses[0] if len(clauses) == 1 else {'or': clauses}
+
+
 @cached
 def direct_searchers(plugins):
     """Return a list of all direct searchers, ordered by priority, then plugin
@@ -32,13 +112,58 @@ def direct_searchers(plugins):
 class Query(object):
     """Query object, constructor will parse any search query"""
 
-    def __init__(self, es_search, querystr, enabled_plugins):
+    def __init__(self, es_search, querystr, enabled_plugins,
+                 es_multi_search=None, results_cache=None, cache_key=None,
+                 verify_natively=False, parse_cache=None, es_scroll=None):
+        """
+        :arg es_search: A callable which takes a query and a ``doc_type``
+            kwarg and returns the ES response
+        :arg es_multi_search: A callable which takes a list of (doc type,
+            query) pairs and returns their ES responses, fetched in a single
+            round trip. Needed only by :meth:`direct_result_or_results()`.
+        :arg results_cache: A :class:`~dxr.utils.LruCache` in which to keep
+            the output of :meth:`results()`, or None not to
+        :arg cache_key: Something hashable which identifies the index being
+            searched, so results from different indices can share a cache.
+            Since indices never change once built, the name of the concrete
+            index behind the alias is ideal.
+        :arg verify_natively: Whether to let filters which can, like regex
+            ones, find candidates with a cheaper ES filter and check them in
+            Python, rather than doing all the work in ES. See
+            :meth:`~dxr.filters.Filter.candidate_filter()`. This needs
+            ``es_scroll``.
+        :arg parse_cache: A :class:`~dxr.utils.LruCache` in which to keep the
+            parsed terms of queries and the filters instantiated from them,
+            keyed by enabled plugins and query string, or None not to. Filters
+            must not change once made, since they're shared between requests.
+        :arg es_scroll: A callable which takes a query and ``doc_type`` and
+            ``size`` kwargs and yields the ES responses for successive pages
+            of its hits, like :func:`~dxr.es.scroll_pages()`
+
+        """
         self.es_search = es_search
+        self.es_multi_search = es_multi_search
+        self.results_cache = results_cache
+        self.cache_key = cache_key
+        self.verify_natively = verify_natively and es_scroll is not None
+        self.es_scroll = es_scroll
         self.enabled_plugins = list(enabled_plugins)
-
-        # A list of dicts describing query terms:
-        grammar = query_grammar(self.enabled_plugins)
-        self.terms = QueryVisitor().visit(grammar.parse(querystr))
+        self.parse_cache = parse_cache
+        self._parse_cache_key = (tuple(p.name for p in self.enabled_plugins),
+                                 querystr)
+
+        # A list of dicts describing query terms, and the filters made from
+        # them, filled out on demand:
+        cached = (None if parse_cache is None else
+                  parse_cache.get(self._parse_cache_key))
+        if cached is None:
+            grammar = query_grammar(self.enabled_plugins)
+            self.terms = QueryVisitor().visit(grammar.parse(querystr))
+            self._filter_tuples = None
+            if parse_cache is not None:
+                parse_cache.put(self._parse_cache_key, (self.terms, None))
+        else:
+            self.terms, self._filter_tuples = cached
 
     def single_term(self):
         """Return the single, non-negated textual term in the query.
@@ -65,6 +190,8 @@ class Query(object):
                 chain.from_iterable((h(lines[0]) for h in
                                      path_highlighters)))
             icon_for_path = icon(path)
+            # Test: If var-ref (or any structural query) returns 2 refs on
+            # one line, they should both get highlit.
             yield (icon_for_path,
                    highlit_path,
                    [(line['number'][0],
@@ -87,12 +214,132 @@ class Query(object):
         themselves::
 
             {'result_count': 12,
+             'result_count_approximate': False,
              'results': [(icon,
                           path within tree,
                           [(line_number, highlighted_line_of_code), ...]),
                          ...]}
 
+        If ``result_count_approximate`` is True, ``result_count`` is only an
+        upper bound.
+
+        """
+        results = self._cached_results(offset, limit)
+        if results is None:
+            doc_type, query, results_from, verify = self._results_search(
+                offset, limit)
+            if verify:
+                results = self._verified_results(offset, limit, doc_type,
+                                                 query, results_from, verify)
+            else:
+                results = results_from(self.es_search(query,
+                                                      doc_type=doc_type))
+            results = self._cache_results(offset, limit, results)
+        return results
+
+    def _verified_results(self, offset, limit, doc_type, query, results_from,
+                          verify):
+        """Return what :meth:`results()` does for a search that finds a
+        superset of the results, checking them with ``verify``.
+
+        If that would mean checking too many candidates, do the whole search
+        in ES after all.
+
+        """
+        response = self._verified_response(doc_type, query, verify)
+        if response is None:
+            doc_type, query, results_from, _ = self._results_search(
+                offset, limit, verify_natively=False)
+            response = self.es_search(query, doc_type=doc_type)
+        return results_from(response)
+
+    def _verified_response(self, doc_type, query, verify):
+        """Run a query which finds a superset of the results, weed out the
+        extras with ``verify``, and return what's left, shaped like an ES
+        response. Return None if that would mean checking more than
+        ``MAX_VERIFY_CANDIDATES`` candidates.
+
+        Candidates are scrolled through a page at a time, and we stop as soon
+        as we have enough to fill the query's ``from`` and ``size``. Unless we
+        got through all the candidates, the total is an upper bound--all of
+        them, less the ones we've thrown out so far--and is marked
+        ``approximate``.
+
+        """
+        offset, limit = query['from'], query['size']
+        candidates = dict((k, v) for k, v in query.iteritems()
+                          if k not in ('from', 'size'))
+        pages = self.es_scroll(candidates,
+                               doc_type=doc_type,
+                               size=VERIFY_PAGE_SIZE)
+        hits = []
+        matched = rejected = examined = 0
+        try:
+            for page in pages:
+                for hit in page['hits']['hits']:
+                    if len(hits) >= limit:
+                        return {'hits': {'total': (page['hits']['total'] -
+                                                   rejected),
+                                         'hits': hits,
+                                         'approximate': True}}
+                    if examined >= MAX_VERIFY_CANDIDATES:
+                        return None
+                    examined += 1
+                    if verify(hit['_source']):
+                        if matched >= offset:
+                            hits.append(hit)
+                        matched += 1
+                    else:
+                        rejected += 1
+        finally:
+            pages.close()  # Let ES free the scroll now.
+        return {'hits': {'total': matched, 'hits': hits}}
+
+    def _results_cache_key(self, offset, limit):
+        return (self.cache_key,
+                tuple(tuple(sorted(term.iteritems())) for term in self.terms),
+                offset,
+                limit)
+
+    def _cached_results(self, offset, limit):
+        """Return the remembered output of :meth:`results()`, or None."""
+        if self.results_cache is not None:
+            cached = self.results_cache.get(
+                self._results_cache_key(offset, limit))
+            if cached is not None:
+                result_count, approximate, results = cached
+                return {'result_count': result_count,
+                        'result_count_approximate': approximate,
+                        'results': iter(results)}
+
+    def _cache_results(self, offset, limit, results):
+        """Remember the output of :meth:`results()`, if there's a cache, and
+        return it."""
+        if self.results_cache is None:
+            return results
+        # The highlighting is the expensive part, so do it all up front:
+        result_list = list(results['results'])
+        self.results_cache.put(self._results_cache_key(offset, limit),
+                               (results['result_count'],
+                                results['result_count_approximate'],
+                                result_list))
+        return {'result_count': results['result_count'],
+                'result_count_approximate':
+                    results['result_count_approximate'],
+                'results': iter(result_list)}
+
+    def _filters(self):
+        """Return a tuple of tuples of instantiated filters, each inner tuple
+        holding those of one term (or, for union-only filters, one filter
+        name), to be ORed together.
+
+        These are remembered in the parse cache, if any, along with the terms,
+        so a query seen before needn't have its regexes recompiled and such.
+
         """
+        if self._filter_tuples is not None:
+            return self._filter_tuples
+
         enabled_filters_by_name = filters_by_name(self.enabled_plugins)
 
         def group_filters_by_term(predicate):
@@ -113,24 +360,80 @@ class Query(object):
                         d.setdefault(term['name'], []).append(f(term, self.enabled_plugins))
             return d.itervalues()
 
-        # Instantiate applicable filters, yielding a list of lists, each inner
-        # list representing the filters of the name of the parallel term. We
+        # Instantiate applicable filters, yielding a tuple of tuples, each inner
+        # one representing the filters of the name of the parallel term. We
         # will OR the elements of the inner lists and then AND those OR balls
         # together.
         # Some filters, such as ExtFilter, do not make sense to be AND'ed together, so we move
         # them all to their own lists at the end of the regular filters list, such that they
         # will be joined by OR instead.
-        filters = list(chain(group_filters_by_term(lambda f: not f.union_only),
-                             group_filters_by_name(lambda f: f.union_only)))
+        filters = tuple(tuple(term) for term in
+                        chain(group_filters_by_term(lambda f: not f.union_only),
+                              group_filters_by_name(lambda f: f.union_only)))
+        self._filter_tuples = filters
+        if self.parse_cache is not None:
+            self.parse_cache.put(self._parse_cache_key, (self.terms, filters))
+        return filters
+
+    def _results_search(self, offset, limit, verify_natively=True,
+                        resolve_paths=True):
+        """Return the doc type and ES query for :meth:`results()`, along with
+        a function which turns the ES response into its return value.
+
+        Finally, return a function which tells whether a found doc really
+        matches, if the query finds a superset of the results, or else None.
+
+        :arg verify_natively: False to do all the work in ES even if this
+            Query would otherwise check candidates in Python
+        :arg resolve_paths: False to leave constraints on whole files
+            unresolved, standing in for the paths they'd narrow the search to
+            with a ``{'terms': {'path': {'files_matching': <FILE filter>}}}``
+            clause, which isn't a real ES filter
+
+        """
+        filters = self._filters()
         # See if we're returning lines or just files-and-folders:
         is_line_query = any(f.domain == LINE for f in
                             chain.from_iterable(filters))
 
+        # Paths are copied onto every line, so constraints on whole files,
+        # like path: and ext:, would be checked against every LINE doc.
+        # Resolve them against the much smaller FILE doctype instead. If few
+        # enough files match, the LINE query need look only within them.
+        file_terms = ([term for term in filters if term and
+                       all(f.domain == FILE for f in term)]
+                      if is_line_query else [])
+        file_filter = self._file_paths_filter(file_terms)
+        if file_filter is None:
+            paths = None
+        elif resolve_paths:
+            paths = self._file_paths(file_filter)
+        else:
+            paths = {'files_matching': file_filter}
+
         # An ORed-together ball for each term's filters, omitting filters that
-        # punt by returning {} and ors that contain nothing but punts:
-        ors = filter(None, [filter(None, (f.filter() for f in term))
-                            for term in filters])
-        ors = [{'or': x} for x in ors]
+        # punt by returning {} and ors that contain nothing but punts. Where
+        # we're allowed to and all of a ball's filters have a cheap
+        # approximation, use those, and check their candidates ourselves.
+        ors = [] if paths is None else [{'terms': {'path': paths}}]
+        verifiers = []
+        for term in filters:
+            if paths is not None and term in file_terms:
+                continue
+            clauses = None
+            if self.verify_natively and verify_natively and term:
+                clauses = [f.candidate_filter() for f in term]
+                if None in clauses:
+                    clauses = None
+                else:
+                    verifiers.append(
+                        lambda result, term=term: any(f.matches(result)
+                                                      for f in term))
+            if clauses is None:
+                clauses = [f.filter() for f in term]
+            ball = ored(clauses)
+            if ball:
+                ors.append(ball)
 
         if not is_line_query:
             # Don't show folders yet in search results. I don't think the JS
@@ -138,6 +441,7 @@ class Query(object):
             ors.append({'term': {'is_folder': False}})
             # Filter out all FILE docs who are links.
             ors.append({'not': {'exists': {'field': 'link'}}})
+        ors = planned(ors)
 
         if ors:
             query = {
@@ -155,23 +459,118 @@ class Query(object):
                 'match_all': {}
             }
 
-        results = self.es_search(
-            {'query': query,
-             'sort': ['path', 'number'] if is_line_query else ['path'],
-             'from': offset,
-             'size': limit},
-            doc_type=LINE if is_line_query else FILE)['hits']
-        result_count = results['total']
-        results = [r['_source'] for r in results['hits']]
+        def results_from(response):
+            results = response['hits']
+            result_count = results['total']
+            results = [r['_source'] for r in results['hits']]
+
+            path_highlighters = [f.highlight_path for f in chain.from_iterable(filters)
+                                 if hasattr(f, 'highlight_path')]
+            return {'result_count': result_count,
+                    'result_count_approximate':
+                        response['hits'].get('approximate', False),
+                    'results': self._line_query_results(filters, results, path_highlighters)
+                               if is_line_query
+                               else self._file_query_results(results, path_highlighters)}
+
+        def verify(result):
+            return all(v(result) for v in verifiers)
+
+        return (LINE if is_line_query else FILE,
+                {'query': query,
+                 'sort': ['path', 'number'] if is_line_query else ['path'],
+                 'from': offset,
+                 'size': limit,
+                 # Results don't show refs, and these are the bulk of the docs:
+                 '_source': {'exclude': ['packed_refs', 'refs', 'regions',
+                                         'ref_payloads']}},
+                results_from,
+                verify if verifiers else None)
+
+    def _file_paths_filter(self, terms):
+        """Return an ES filter for the FILE docs satisfying some lists of
+        FILE-domain filters, each list ORed together and all of them ANDed,
+        or None if they all punt."""
+        clauses = filter(None, (ored([f.filter() for f in term])
+                                for term in terms))
+        if not clauses:
+            return None
+        return {'and': planned(clauses + [{'term': {'is_folder': False}}])}
+
+    def _file_paths(self, file_filter):
+        """Return the paths of the files matching a filter from
+        :meth:`_file_paths_filter()`, or None if there are too many to be
+        worth listing.
 
-        path_highlighters = [f.highlight_path for f in chain.from_iterable(filters)
-                             if hasattr(f, 'highlight_path')]
-        return {'result_count': result_count,
-                'results': self._line_query_results(filters, results, path_highlighters)
-                           if is_line_query
-                           else self._file_query_results(results, path_highlighters)}
+        Paging through results repeats the same lookup, so the answer is
+        remembered in the results cache, if any, for as long as the index
+        is.
 
-        # Test: If var-ref (or any structural query) returns 2 refs on one line, they should both get highlit.
+        """
+        cache_key = (self.cache_key,
+                     'file_paths',
+                     json.dumps(file_filter, sort_keys=True))
+        if self.results_cache is not None:
+            cached = self.results_cache.get(cache_key)
+            if cached is not None:
+                return cached[0]
+        hits = self.es_search(
+            {'query': {
+                'filtered': {
+                    'query': {
+                        'match_all': {}
+                    },
+                    'filter': file_filter
+                }
+             },
+             'size': MAX_FILE_PATHS,
+             '_source': {'include': ['path']}},
+            doc_type=FILE)['hits']
+        paths = (None if hits['total'] > MAX_FILE_PATHS else
+                 [hit['_source']['path'][0] for hit in hits['hits']])
+        if self.results_cache is not None:
+            self.results_cache.put(cache_key, (paths,))
+        return paths
+
+    def plan(self, offset=0, limit=100):
+        """Return a description of how :meth:`results()` would search, for
+        tuning the planner::
+
+            {'doc_type': 'line',
+             'verified_natively': False,
+             'file_prefilter': {'cost': 3, 'filter': {...},
+                                'max_paths': 1000},
+             'clauses': [{'cost': 1, 'filter': {...}}, ...],
+             'query': {...}}
+
+        The clauses are those ANDed together, in the order ES will get them.
+        If constraints on whole files would first be resolved to a list of
+        paths, ``file_prefilter`` describes that lookup, which isn't run, and
+        the clause it would yield stands in as ``{'terms': {'path':
+        {'files_matching': ...}}}``. Should more than ``max_paths`` files
+        match, those constraints would be checked against each line instead.
+        If there's no such lookup, ``file_prefilter`` is None.
+
+        """
+        doc_type, query, _, verify = self._results_search(
+            offset, limit, resolve_paths=False)
+        clauses = query['query'].get('filtered', {}).get('filter', {}).get(
+            'and', [])
+        file_prefilter = None
+        for clause in clauses:
+            paths = clause.get('terms', {}).get('path')
+            if isinstance(paths, dict):
+                file_filter = paths['files_matching']
+                file_prefilter = {
+                    'cost': sum(filter_cost(c) for c in file_filter['and']),
+                    'filter': file_filter,
+                    'max_paths': MAX_FILE_PATHS}
+        return {'doc_type': doc_type,
+                'verified_natively': verify is not None,
+                'file_prefilter': file_prefilter,
+                'clauses': [{'cost': filter_cost(clause), 'filter': clause}
+                            for clause in clauses],
+                'query': query}
 
     def direct_result(self):
         """Return a single search result that is an exact match for the query.
@@ -181,33 +580,103 @@ class Query(object):
         rather than any specific line. If no result is found, return just None.
 
         """
+        for doc_type, query in self._direct_searches():
+            is_decisive, result = self._direct_verdict(
+                doc_type,
+                self.es_search(query, doc_type=doc_type)['hits']['hits'])
+            if is_decisive:
+                return result
+
+    def direct_result_or_results(self, offset=0, limit=100):
+        """Return a tuple of (:meth:`direct_result()`, None) if there is a
+        direct result, or else (None, :meth:`results()`), making all the
+        searches involved in a single round trip.
+
+        The direct searches and the normal one all go out at once, and the
+        highest-priority direct search to decide the matter wins.
+
+        Raise BadTerm if there's no direct result and the query is bad.
+
+        """
+        direct_searches = self._direct_searches()
+        bad_term = None
+        results = self._cached_results(offset, limit)
+        verify = None
+        if results is None:
+            try:
+                doc_type, query, results_from, verify = self._results_search(
+                    offset, limit)
+            except BadTerm as exc:
+                if not direct_searches:
+                    raise
+                bad_term, searches = exc, direct_searches
+            else:
+                # A verified search takes several round trips, so there's no
+                # sense batching its first.
+                searches = direct_searches + ([] if verify else
+                                              [(doc_type, query)])
+        else:
+            searches = direct_searches
+
+        responses = self.es_multi_search(searches) if searches else []
+        for (doc_type, _), response in izip(direct_searches, responses):
+            is_decisive, result = self._direct_verdict(
+                doc_type, response['hits']['hits'])
+            if is_decisive:
+                if result:
+                    return result, None
+                break
+        if bad_term:
+            raise bad_term
+        if results is None:
+            results = self._cache_results(
+                offset, limit,
+                self._verified_results(offset, limit, doc_type, query,
+                                       results_from, verify)
+                if verify else results_from(responses[-1]))
+        return None, results
+
+    def _direct_searches(self):
+        """Return a list of (doc type, ES query) pairs, one for each direct
+        searcher that has something to say about the query, in priority
+        order."""
         term = self.single_term()
         if not term:
-            return None
+            return []
 
+        searches = []
         for searcher in direct_searchers(self.enabled_plugins):
             clause = searcher(term)
             if clause:
-                results = self.es_search(
-                    {
-                        'query': {
-                            'filtered': {
-                                'query': {
-                                    'match_all': {}
-                                },
-                                'filter': clause
-                            }
-                        },
-                        'size': 2
-                    },
-                    doc_type=searcher.domain)['hits']['hits']
-                if len(results) == 1:
-                    result = results[0]['_source']
-                    # Everything is stored as arrays in ES. Pull it all out:
-                    return (result['path'][0],
-                            result['number'][0] if searcher.domain == LINE else None)
-                elif len(results) > 1:
-                    return None
+                searches.append((searcher.domain,
+                                 {
+                                     'query': {
+                                         'filtered': {
+                                             'query': {
+                                                 'match_all': {}
+                                             },
+                                             'filter': clause
+                                         }
+                                     },
+                                     'size': 2
+                                 }))
+        return searches
+
+    @staticmethod
+    def _direct_verdict(doc_type, hits):
+        """Return whether the hits of a direct search decide the direct
+        result, and what it is.
+
+        A single hit is the direct result, and several mean there isn't one.
+        No hits leave it up to the next direct searcher.
+
+        """
+        if len(hits) == 1:
+            result = hits[0]['_source']
+            # Everything is stored as arrays in ES. Pull it all out:
+            return True, (result['path'][0],
+                          result['number'][0] if doc_type == LINE else None)
+        return len(hits) > 1, None
 
 
 @cached
@@ -0,0 +1,86 @@
+"""An on-disk cache of rendered file pages
+
+DXR indices never change once built, so a file view rendered from one is
+good until its tree's alias moves to a new index. Entries live under
+``<folder>/<tree>/<index>/``; the first time a tree's pages are cached for a
+new index, the folders of its older indices are deleted. Pages are stored
+gzipped, so they can be sent as-is to clients that take gzip.
+
+"""
+from errno import EEXIST
+from hashlib import sha1
+from os import listdir, makedirs, remove, rename
+from os.path import join
+from tempfile import NamedTemporaryFile
+
+from dxr.compression import gunzipped, gzip_compressor
+from dxr.utils import rmtree_if_exists
+
+
+class RenderCache(object):
+    """A folder of rendered HTML bodies, keyed by tree, index name, and an
+    arbitrary key string"""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def get(self, tree, index, key):
+        """Return the cached HTML for a key as unicode, or None if there
+        isn't any."""
+        html = self.get_gzipped(tree, index, key)
+        return None if html is None else gunzipped(html).decode('utf-8')
+
+    def get_gzipped(self, tree, index, key):
+        """Return the cached HTML for a key as gzipped UTF-8, or None if
+        there isn't any."""
+        try:
+            with open(self._path(tree, index, key), 'rb') as file:
+                return file.read()
+        except IOError:
+            return None
+
+    def put(self, tree, index, key, html):
+        """Store the HTML for a key."""
+        for _ in self.tee(tree, index, key, [html]):
+            pass
+
+    def tee(self, tree, index, key, chunks):
+        """Yield the unicode chunks of a page as it's streamed out, storing
+        them for a key along the way.
+
+        The page is written to a temp file and renamed into place only once
+        it's complete, so concurrent readers never see a partial page, and a
+        page whose sending is cut short isn't stored at all.
+
+        """
+        index_folder = join(self.folder, tree, index)
+        try:
+            makedirs(index_folder)
+        except OSError as exc:
+            if exc.errno != EEXIST:
+                raise
+        else:
+            self._evict_other_indices(tree, index)
+        compressor = gzip_compressor()
+        with NamedTemporaryFile(dir=index_folder, delete=False) as file:
+            try:
+                for chunk in chunks:
+                    file.write(compressor.compress(chunk.encode('utf-8')))
+                    yield chunk
+                file.write(compressor.flush())
+            except BaseException:  # including GeneratorExit
+                file.close()
+                remove(file.name)
+                raise
+        rename(file.name, self._path(tree, index, key))
+
+    def _path(self, tree, index, key):
+        return join(self.folder, tree, index,
+                    sha1(key.encode('utf-8')).hexdigest() + '.html.gz')
+
+    def _evict_other_indices(self, tree, index):
+        """Delete the pages of a tree's obsolete indices."""
+        tree_folder = join(self.folder, tree)
+        for name in listdir(tree_folder):
+            if name != index:
+                rmtree_if_exists(join(tree_folder, name))
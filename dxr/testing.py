@@ -1,7 +1,7 @@
 import cgi
 from commands import getoutput
 import json
-from os import mkdir
+from os import environ, mkdir
 from os.path import dirname, join
 import re
 from shutil import rmtree
@@ -12,7 +12,6 @@ import unittest
 
 from flask import url_for
 from nose.tools import eq_, ok_
-from pyelasticsearch import ElasticSearch
 
 try:
     from nose.tools import assert_in
@@ -23,6 +22,7 @@ except ImportError:
 from dxr.app import make_app
 from dxr.build import index_and_deploy_tree
 from dxr.config import Config
+from dxr.es import connect
 from dxr.utils import cd, file_text, run
 
 
@@ -257,7 +257,7 @@ class TestCase(unittest.TestCase):
 
     @classmethod
     def _es(cls):
-        return ElasticSearch('http://127.0.0.1:9200/')
+        return connect(environ.get('DXR_ES_HOSTS', 'http://127.0.0.1:9200/'))
 
     @classmethod
     def _delete_es_indices(cls):
@@ -458,6 +458,23 @@ def make_file(path, filename, contents):
         file.write(contents.encode('utf-8'))
 
 
+def buglink_config(analytics_key='', buglink_regex='bug (\d+)'):
+    """Return a one-tree config, with the tree called "some_tree", having
+    buglink enabled."""
+    return Config("""
+        [DXR]
+        enabled_plugins = buglink
+        google_analytics_key = %s
+
+        [some_tree]
+        source_folder = /some/path
+
+            [[buglink]]
+            url = http://example.com/%%s
+            regex = %s
+        """ % (analytics_key, buglink_regex))
+
+
 def _decoded_menu_on(haystack, text, text_instance=1):
     """Return the JSON-decoded menu found around the ``text_instance``th source
     code occurrence of ``text`` in the HTML ``haystack``.
@@ -17,7 +17,8 @@ Russ Cox, in http://swtch.com/~rsc/regexp/regexp4.html, refines
 that to {(1) extract use from runs of less than 3 static chars and (2) extract
 trigrams that cross the boundaries between subexpressions} by keeping track of
 prefix and suffix information while chewing through a pattern and effectively
-merging adjacent subpatterns. This is a direction we may go in the future.
+merging adjacent subpatterns. :class:`RegexInfoVisitor` does that, and it's
+what :func:`es_regex_filter` uses.
 
 """
 from itertools import chain
@@ -35,13 +36,17 @@ class NoTrigrams(Exception):
 # We should parse a regex. Then go over the tree and turn things like c+ into cc*, perhaps, as it makes it easier to see trigrams to extract.
 # TODO: Parse normal regex syntax, but spit out Lucene-compatible syntax, with " escaped. And all special chars escaped even in character classes, in accordance with https://lucene.apache.org/core/4_6_0/core/org/apache/lucene/util/automaton/RegExp.html?is-external=true.
 
-# TODO: Expand positive char classes so we can get trigrams out of [sp][rne]
-# (trilite expands char classes of up to 10 chars but does nothing for larger
-# ones), and be able to get trigrams out of sp(rint) as well. Production
-# currently does that much. It is not, however, smart enough to expand
-# spr{1,3}, nor spr+. An easy way would be to keep track of prefixes and
-# suffixes (and trigram-or-better infixes) for each node, then work our way up
-# the tree.
+# The most distinct strings we'll track as the possible exact matches of a
+# subpattern before giving up and falling back to its prefixes and suffixes:
+MAX_EXACT = 7
+
+# The most distinct strings we'll keep as possible prefixes or suffixes of a
+# subpattern before shortening them to make fewer:
+MAX_SET = 20
+
+# The most copies of a subpattern we'll lay end to end when expanding a
+# bounded repeat like a{1,3}. Bigger repeats are treated like a{3,}.
+MAX_REPEAT = 3
 
 
 class SubstringTree(list):
@@ -77,17 +82,6 @@ class SubstringTree(list):
                         else '')
             return tree_or_string.simplified(min_length=min_length)
 
-        # TODO: Think about implementing the Cox method. I now see that I'm
-        # going to have to write some kind of theorems into even the FREE
-        # method if I want to be able to extract trigrams from ab[cd]
-        # (prefixes, cross products), so I might as well use Cox's. We can
-        # code his theorems right into the visitor. I don't think it will get
-        # too messy. Low-level nodes' visitation will just cast strings to
-        # ints, etc., and high-level ones will just apply Cox theorems. Btw,
-        # http://code.ohloh.net/file?fid=rfNSbmGXJxqJhWDMLp3VaEMUlgQ&cid=
-        # eDOmLT58hyw&s=&fp=305491&mp=&projSelected=true#L0 is PG's
-        # explanation of their simplification stuff.
-
         # Filter out empty strings and empty subtrees, both of which are
         # equally useless. (Remember, adjacent strings in an And don't mean
         # adjacent strings in the found text, so a '' in an Or doesn't help us
@@ -343,7 +337,7 @@ class SubstringTreeVisitor(NodeVisitor):
         """Return a tuple of (min, max), where '' means infinity."""
         # It'll either be in the hash, or it will have already been broken
         # down into a tuple by visit_repeat_range.
-        return self.quantifier_expansions.get(quantifier.text, quantifier)
+        return self.quantifier_expansions.get(or_.text, quantifier)
 
     def visit_repeat(self, repeat, (brace, repeat_range, end_brace)):
         return repeat_range
@@ -351,14 +345,17 @@ class SubstringTreeVisitor(NodeVisitor):
     def visit_repeat_range(self, repeat_range, children):
         """Return a tuple of (min, max) representing a repeat range.
 
-        If max is unspecified (open-ended), return '' for max.
+        If max is unspecified (open-ended), return '' for max. If there's no
+        comma, as in {3}, max is the same as min.
 
         """
         min, comma, max = repeat_range.text.partition(',')
+        if not comma:
+            return int(min), int(min)
         return int(min), (max if max == '' else int(max))
 
     def visit_number(self, number, children):
-        return int(number)
+        return int(number.text)
 
     def visit_group(self, group, (paren, regexp, end_paren)):
         return regexp
@@ -421,12 +418,289 @@ class SubstringTreeVisitor(NodeVisitor):
 
     def visit_backslash_hex(self, backslash_hex, children):
         """Return the character specified by the hex code."""
-        return unichr(backslash_hex.text[1:])
+        return unichr(int(backslash_hex.text[1:], 16))
 
     def visit_backslash_normal(self, backslash_normal, children):
         return backslash_normal.text
 
 
+def _and(*queries):
+    """Return a SubstringTree (or lone string) requiring all of ``queries``.
+
+    ``u''`` means "anything", so it drops out. Strings contained in other
+    strings are redundant and drop out too.
+
+    """
+    children = []
+    for query in queries:
+        for child in (query if isinstance(query, And) else [query]):
+            if child and child not in children:
+                children.append(child)
+    strings = [c for c in children if isinstance(c, basestring)]
+    children = [c for c in children if not isinstance(c, basestring) or
+                not any(c != s and c in s for s in strings)]
+    if not children:
+        return u''
+    return children[0] if len(children) == 1 else And(children)
+
+
+def _or(*queries):
+    """Return a SubstringTree (or lone string) requiring any of ``queries``.
+
+    If any of them is ``u''``, which means "anything", so is the result.
+    Strings containing other strings are redundant and drop out.
+
+    """
+    children = []
+    for query in queries:
+        if not query:
+            return u''
+        for child in (query if isinstance(query, Or) else [query]):
+            if child not in children:
+                children.append(child)
+    strings = [c for c in children if isinstance(c, basestring)]
+    children = [c for c in children if not isinstance(c, basestring) or
+                not any(s != c and s in c for s in strings)]
+    return children[0] if len(children) == 1 else Or(children)
+
+
+def _any_of(strings):
+    """Return a query requiring at least one of some strings, or ``u''`` if
+    one is too short to make a trigram of, which means "anything"."""
+    if not strings or any(len(s) < NGRAM_LENGTH for s in strings):
+        return u''
+    return _or(*sorted(strings))
+
+
+def _cross(xs, ys):
+    """Return every string made by following one of ``xs`` with one of
+    ``ys``."""
+    return frozenset(x + y for x in xs for y in ys)
+
+
+class RegexInfo(object):
+    """What we know about the strings a regex (or subpattern) matches, per
+    Russ Cox's regexp4
+
+    :ivar emptyable: Whether it can match the empty string
+    :ivar exact: A frozenset of every string it can match, or None if we
+        don't know them all (or there are too many to keep track of)
+    :ivar prefixes: A frozenset of strings, one of which every match starts
+        with. Meaningful only when ``exact`` is None.
+    :ivar suffixes: Likewise, for the ends of matches
+    :ivar match: A SubstringTree (or lone string) which every text containing
+        a match satisfies, or ``u''`` if we can't say anything
+
+    """
+    def __init__(self, emptyable=False, exact=None, prefixes=frozenset(['']),
+                 suffixes=frozenset(['']), match=u''):
+        self.emptyable = emptyable
+        self.exact = exact
+        self.prefixes = prefixes
+        self.suffixes = suffixes
+        self.match = match
+
+    def __repr__(self):
+        return 'RegexInfo(%r, exact=%r, prefixes=%r, suffixes=%r, match=%r)' % (
+            self.emptyable, self.exact, self.prefixes, self.suffixes,
+            self.match)
+
+    def simplified(self, force=False):
+        """Keep my string sets small, moving what they tell us into
+        ``match`` as they shrink. Return myself.
+
+        :arg force: Give up on ``exact`` altogether, as when we're done
+            analyzing and want everything in ``match``
+
+        """
+        if self.exact is not None and (force or len(self.exact) > MAX_EXACT):
+            self._fold_exact()
+        if self.exact is None:
+            self.prefixes = self._shortened(self.prefixes, lambda s, n: s[:n])
+            self.suffixes = self._shortened(
+                self.suffixes, lambda s, n: s[len(s) - n:])
+        return self
+
+    def _fold_exact(self):
+        """Stop tracking exact matches, keeping what they say in ``match``,
+        ``prefixes``, and ``suffixes``."""
+        self.match = _and(self.match, _any_of(self.exact))
+        self.prefixes = self.suffixes = self.exact
+        self.exact = None
+
+    def _shortened(self, strings, truncate):
+        """Require one of a set of prefixes or suffixes in ``match``, then
+        return the set cut down to strings too short to make trigrams of, so
+        they can still combine with neighbors' to make some.
+
+        :arg truncate: A callable that takes a string and a length and trims
+            the string to that length from the appropriate end
+
+        """
+        self.match = _and(self.match, _any_of(strings))
+        length = NGRAM_LENGTH - 1
+        strings = frozenset(truncate(s, length) for s in strings)
+        while len(strings) > MAX_SET:
+            length -= 1
+            strings = frozenset(truncate(s, length) for s in strings)
+        return strings
+
+
+def _empty():
+    """Return the info of a pattern which matches only the empty string."""
+    return RegexInfo(emptyable=True, exact=frozenset(['']))
+
+
+def _any_char():
+    """Return the info of a pattern which matches any one char."""
+    return RegexInfo()
+
+
+def _anything():
+    """Return the info of a pattern which matches any string at all."""
+    return RegexInfo(emptyable=True)
+
+
+def _concat(x, y):
+    """Return the info of ``x`` followed by ``y``."""
+    xy = RegexInfo(emptyable=x.emptyable and y.emptyable,
+                   match=_and(x.match, y.match))
+    if x.exact is not None and y.exact is not None:
+        xy.exact = _cross(x.exact, y.exact)
+    else:
+        if x.exact is not None:
+            xy.prefixes = _cross(x.exact, y.prefixes)
+        else:
+            xy.prefixes = (x.prefixes | y.prefixes if x.emptyable else
+                           x.prefixes)
+        if y.exact is not None:
+            xy.suffixes = _cross(x.suffixes, y.exact)
+        else:
+            xy.suffixes = (y.suffixes | x.suffixes if y.emptyable else
+                           y.suffixes)
+        if x.exact is None and y.exact is None:
+            # Here's where trigrams spanning the seam between x and y come
+            # from:
+            xy.match = _and(xy.match,
+                            _any_of(_cross(x.suffixes, y.prefixes)))
+    return xy.simplified()
+
+
+def _alternate(x, y):
+    """Return the info of ``x|y``."""
+    xy = RegexInfo(emptyable=x.emptyable or y.emptyable)
+    if x.exact is not None and y.exact is not None:
+        xy.exact = x.exact | y.exact
+    else:
+        for info in x, y:
+            if info.exact is not None:
+                exact = info.exact
+                info._fold_exact()
+                info.prefixes = info.suffixes = exact
+        xy.prefixes = x.prefixes | y.prefixes
+        xy.suffixes = x.suffixes | y.suffixes
+    xy.match = _or(x.match, y.match)
+    return xy.simplified()
+
+
+def _plus(x):
+    """Return the info of ``x+``.
+
+    There's at least one x, so its prefixes and suffixes hold, but we no
+    longer know exactly what matches.
+
+    """
+    if x.exact is not None:
+        x = RegexInfo(emptyable=x.emptyable, prefixes=x.exact,
+                      suffixes=x.exact, match=x.match)
+    return x.simplified()
+
+
+def _repeated(x, least, most):
+    """Return the info of ``x{least,most}``, where a ``most`` of '' means no
+    limit.
+
+    Up to ``MAX_REPEAT`` copies of x are laid end to end. Longer repeats
+    contain those, so we settle for what they tell us.
+
+    """
+    if most != '' and most <= MAX_REPEAT:
+        info = _empty()
+        for _ in xrange(least):
+            info = _concat(info, x)
+        for _ in xrange(most - least):
+            info = _concat(info, _alternate(x, _empty()))
+        return info
+    if not least:
+        return _anything()
+    info = _empty()
+    for _ in xrange(min(least, MAX_REPEAT) - 1):
+        info = _concat(info, x)
+    return _concat(info, _plus(x))
+
+
+class RegexInfoVisitor(SubstringTreeVisitor):
+    """Visitor that works out a :class:`RegexInfo` for a parsed
+    ``regex_grammar`` tree
+
+    Unlike :class:`SubstringTreeVisitor`, I keep track of prefixes and
+    suffixes, so I can pull trigrams out of ``sp[rn]intf``, ``foo(bar)?baz``,
+    and ``ab{1,3}c``.
+
+    """
+    # ^ and $ match only the empty string as far as the text's contents go.
+    visit_hat = visit_dollars = lambda self, node, children: _empty()
+
+    def visit_regexp(self, regexp, (branch, other_branches)):
+        return reduce(_alternate, other_branches, branch)
+
+    def visit_branch(self, branch, pieces):
+        """Concatenate the pieces.
+
+        Runs of pieces whose exact matches we know are joined first, so a
+        literal like ``cork`` after ``b*`` is searched for whole rather than
+        as the overlapping trigrams left after each char's turn.
+
+        """
+        runs = []
+        for piece in pieces:
+            if runs and runs[-1].exact is not None and piece.exact is not None:
+                runs[-1] = _concat(runs[-1], piece)
+            else:
+                runs.append(piece)
+        return reduce(_concat, runs, _empty())
+
+    def visit_atom(self, atom, (child,)):
+        """Turn a char, a class, or a useless thing into a RegexInfo. Pass
+        groups and anchors, which are already RegexInfos, through."""
+        if isinstance(child, RegexInfo):
+            return child
+        if child is USELESS:
+            return _any_char()
+        if isinstance(child, Or):  # a small char class
+            return RegexInfo(exact=frozenset(child))
+        return RegexInfo(exact=frozenset([child]))
+
+    def visit_quantified(self, quantified, (atom, (min, max))):
+        if (min, max) == (0, ''):
+            return _anything()
+        if (min, max) == (1, ''):
+            return _plus(atom)
+        return _repeated(atom, min, max)
+
+
+def regex_substrings(parsed_regex):
+    """Return a SubstringTree (or lone string) which every text containing a
+    match of a regex satisfies, or ``u''`` if we can't narrow things down.
+
+    Strings in the tree are all at least ``NGRAM_LENGTH`` long.
+
+    :arg parsed_regex: A regex pattern as an AST from regex_grammar
+
+    """
+    return RegexInfoVisitor().visit(parsed_regex).simplified(force=True).match
+
+
 class JsRegexVisitor(NodeVisitor):
     """Visitor for converting a parsed DXR-flavored regex to a JS equivalent"""
 
@@ -546,6 +820,28 @@ def boolean_filter_tree(substrings, trigram_field):
     }
 
 
+def es_trigram_filter(parsed_regex, raw_field, is_case_sensitive):
+    """Return an ES filter which finds a superset of the fields a regex
+    matches, using only the trigram index.
+
+    Raise NoTrigrams if there's nothing to narrow things down with. Arguments
+    are as for :func:`es_regex_filter()`.
+
+    """
+    trigram_field = ('%s.trigrams' if is_case_sensitive else
+                     '%s.trigrams_lower') % raw_field
+    substrings = regex_substrings(parsed_regex)
+
+    # If tree is a string, just do a match_phrase. Otherwise, build some
+    # boolean algebra.
+    if not substrings:
+        raise NoTrigrams
+        # We could alternatively consider doing an unaccelerated Lucene regex
+        # query at this point. It would be slower but tolerable on a
+        # moz-central-sized codebase: perhaps 500ms rather than 80.
+    return boolean_filter_tree(substrings, trigram_field)
+
+
 def es_regex_filter(parsed_regex, raw_field, is_case_sensitive):
     """Return an efficient ES filter to find matches to a regex.
 
@@ -561,33 +857,21 @@ def es_regex_filter(parsed_regex, raw_field, is_case_sensitive):
         case-sensitive
 
     """
-    trigram_field = ('%s.trigrams' if is_case_sensitive else
-                     '%s.trigrams_lower') % raw_field
-    substrings = SubstringTreeVisitor().visit(parsed_regex).simplified()
-
-    # If tree is a string, just do a match_phrase. Otherwise, add .* to the
-    # front and back, and build some boolean algebra.
-    if isinstance(substrings, basestring) and len(substrings) < NGRAM_LENGTH:
-        raise NoTrigrams
-        # We could alternatively consider doing an unaccelerated Lucene regex
-        # query at this point. It would be slower but tolerable on a
-        # moz-central-sized codebase: perhaps 500ms rather than 80.
-    else:
-        # Should be fine even if the regex already starts or ends with .*:
-        js_regex = JsRegexVisitor().visit(parsed_regex)
-        return {
-            'and': [
-                boolean_filter_tree(substrings, trigram_field),
-                {
-                    'script': {
-                        'lang': 'js',
-                        # test() tests for containment, not matching:
-                        'script': '(new RegExp(pattern, flags)).test(doc["%s"][0])' % raw_field,
-                        'params': {
-                            'pattern': js_regex,
-                            'flags': '' if is_case_sensitive else 'i'
-                        }
+    # Should be fine even if the regex already starts or ends with .*:
+    js_regex = JsRegexVisitor().visit(parsed_regex)
+    return {
+        'and': [
+            es_trigram_filter(parsed_regex, raw_field, is_case_sensitive),
+            {
+                'script': {
+                    'lang': 'js',
+                    # test() tests for containment, not matching:
+                    'script': '(new RegExp(pattern, flags)).test(doc["%s"][0])' % raw_field,
+                    'params': {
+                        'pattern': js_regex,
+                        'flags': '' if is_case_sensitive else 'i'
                     }
                 }
-            ]
-        }
+            }
+        ]
+    }
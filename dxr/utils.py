@@ -1,4 +1,4 @@
-from collections import Mapping, defaultdict
+from collections import Mapping, OrderedDict, defaultdict
 from commands import getstatusoutput
 from contextlib import contextmanager
 from datetime import datetime
@@ -6,10 +6,12 @@ from errno import ENOENT
 import fnmatch
 from functools import wraps
 from itertools import izip, imap
-from os import chdir, dup, fdopen, getcwd
-from os.path import join
+from os import chdir, dup, fdopen, getcwd, sep
+from os.path import basename, join
+import re
 from shutil import rmtree
 from sys import stdout
+from threading import Lock
 from urllib import quote, quote_plus
 
 from flask import current_app
@@ -168,6 +170,81 @@ def glob_to_regex(glob):
     return fnmatch.translate(glob)[:-_FNMATCH_TRANSLATE_SUFFIX_LEN]
 
 
+class IgnoreMatcher(object):
+    """A test of whether a file or folder in a source tree is ignored, with
+    all the tree's ignore patterns compiled in advance
+
+    Calling ``fnmatchcase()`` once per pattern per path is slow, and it gets
+    much slower past 100 patterns, at which point fnmatch's internal cache of
+    compiled patterns starts thrashing. Instead, the literal patterns go into
+    sets, and the rest are ORed into one regex apiece for names and paths, so
+    the cost of a check barely grows with the number of patterns.
+
+    """
+    def __init__(self, ignore_filenames, ignore_paths):
+        """
+        :arg ignore_filenames: Globs to match against bare file and folder
+            names
+        :arg ignore_paths: Globs to match against paths relative to the
+            source folder, with a leading slash. Folders' paths get a trailing
+            slash as well.
+
+        """
+        self._names, self._name_regex = self._compile(ignore_filenames)
+        self._paths, self._path_regex = self._compile(ignore_paths)
+
+    @staticmethod
+    def _compile(globs):
+        """Return a set of the literal globs and a regex matching the rest
+        (or None if there aren't any)."""
+        literals = set(g for g in globs if not _GLOB_CHARS.search(g))
+        wildcards = [g for g in globs if g not in literals]
+        regex = (re.compile('(?:%s)\\Z' % '|'.join(glob_to_regex(g)
+                                                    for g in wildcards),
+                            re.DOTALL)
+                 if wildcards else None)
+        return literals, regex
+
+    def _is_ignored(self, name, path):
+        return (name in self._names or
+                path in self._paths or
+                (self._name_regex is not None and
+                 self._name_regex.match(name) is not None) or
+                (self._path_regex is not None and
+                 self._path_regex.match(path) is not None))
+
+    def is_ignored_file(self, rel_path, name=None):
+        """Return whether a file is ignored.
+
+        :arg rel_path: The path of the file relative to the source folder
+        :arg name: The last component of ``rel_path``, if you have it handy
+
+        """
+        if name is None:
+            name = basename(rel_path)
+        return self._is_ignored(name, '/' + _slashed(rel_path))
+
+    def is_ignored_folder(self, rel_path, name=None):
+        """Return whether a folder is ignored. (Anything within it is, too,
+        but this doesn't check for that.)
+
+        :arg rel_path: The path of the folder relative to the source folder
+        :arg name: The last component of ``rel_path``, if you have it handy
+
+        """
+        if name is None:
+            name = basename(rel_path)
+        return self._is_ignored(name, '/' + _slashed(rel_path) + '/')
+
+
+_GLOB_CHARS = re.compile(r'[*?[]')
+
+
+def _slashed(path):
+    """Return a relative path with forward slashes."""
+    return path if sep == '/' else path.replace(sep, '/')
+
+
 def cached(f):
     """Cache the result of a function that takes an iterable of plugins."""
     # TODO: Generalize this into a general memoizer function later if needed.
@@ -186,6 +263,60 @@ def cached(f):
     return inner
 
 
+class LruCache(object):
+    """A thread-safe mapping of limited size which, once full, forgets
+    whatever was least recently used to make room
+
+    :ivar hits: How many lookups have found something
+    :ivar misses: How many lookups have come up empty
+
+    """
+    def __init__(self, size):
+        """
+        :arg size: The most entries to keep. 0 disables the cache.
+
+        """
+        self.size = size
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()  # least recently used first
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Return the value stored under a key, or ``default``."""
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value  # Move it to the recent end.
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store a value under a key, evicting the least recently used entry
+        if there's no room."""
+        if not self.size:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Return a JSON-serializable dict of my size, how full I am, and my
+        hit and miss counts."""
+        with self._lock:
+            return {'size': self.size,
+                    'entries': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
 class frozendict(dict):
     """A dict that can be hashed if all its values are hashable
 
@@ -6,9 +6,10 @@ everything else. Here are a few unit tests.
 """
 from unittest import TestCase
 
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 
-from dxr.app import _linked_pathname
+from dxr.app import _FileLines, _linked_pathname, _page_version
+from dxr.testing import buglink_config
 
 
 class LinkedPathnameTests(TestCase):
@@ -22,3 +23,37 @@ class LinkedPathnameTests(TestCase):
     def test_root_folder(self):
         """Make sure the root folder is treated correctly."""
         eq_(_linked_pathname('', 'stuff'), [('/stuff/source', 'stuff')])
+
+
+def test_page_version():
+    """The page version should be stable but change with the config options
+    that show up on pages."""
+    eq_(_page_version(buglink_config()), _page_version(buglink_config()))
+    ok_(_page_version(buglink_config()) !=
+        _page_version(buglink_config('UA-1')))
+    ok_(_page_version(buglink_config()) !=
+        _page_version(buglink_config(buglink_regex='Bug (\d+)')))
+
+
+def test_file_lines_lazy():
+    """Without skimmers, the line count should come from the FILE doc, and
+    each LINE doc should be fetched only once its line is reached."""
+    fetched = []
+
+    def line_docs():
+        for number, content in enumerate([u'int a;\n', u'int b;\n'], 1):
+            fetched.append(number)
+            yield {'content': content,
+                   'regions': [{'start': 7 * (number - 1),
+                                'end': 7 * (number - 1) + 3,
+                                'payload': 'k'}]}
+
+    tree = type('FakeTreeConfig', (), {'enabled_plugins': []})
+    lines = _FileLines('a.c', line_docs(), {'line_count': 2}, tree)
+    eq_(lines.count, 2)
+    eq_(lines.links, [])
+    eq_(fetched, [])
+    lines = iter(lines)
+    eq_(next(lines), u'<span class="k">int</span> a;\n')
+    eq_(fetched, [1])
+    eq_(next(lines), u'<span class="k">int</span> b;\n')
@@ -0,0 +1,144 @@
+"""Tests for the parts of the indexing machinery that don't need ES"""
+
+from os import symlink
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from nose.tools import eq_, ok_
+
+from dxr.build import (content_hash, depends_only_on_contents,
+                       DuplicateCache, index_fingerprint, IndexingJournal,
+                       size_balanced_chunks, TreeIndexersSnapshot)
+from dxr.indexers import FileToIndex
+from dxr.testing import buglink_config
+
+
+def tree_config(buglink_regex='bug (\d+)'):
+    """Return the TreeConfig of a one-tree config having buglink enabled."""
+    return buglink_config(buglink_regex=buglink_regex).trees['some_tree']
+
+
+def test_fingerprint_stable():
+    """Identical configs should yield identical fingerprints, even when they
+    contain compiled regexes."""
+    eq_(index_fingerprint(tree_config()), index_fingerprint(tree_config()))
+
+
+def test_fingerprint_plugin_config():
+    """Changing plugin config should change the fingerprint."""
+    ok_(index_fingerprint(tree_config()) !=
+        index_fingerprint(tree_config('Bug (\d+)')))
+
+
+def test_content_hash():
+    """Make sure hashes follow contents and distinguish symlinks."""
+    folder = mkdtemp()
+    try:
+        one, two, link = [join(folder, name) for name in 'one', 'two', 'link']
+        for path in one, two:
+            with open(path, 'w') as file:
+                file.write('same')
+        symlink(one, link)
+        eq_(content_hash(one), content_hash(two))
+        ok_(content_hash(link) != content_hash(one))
+        eq_(content_hash(join(folder, 'absent')), None)
+    finally:
+        rmtree(folder)
+
+
+def test_size_balanced_chunks():
+    """Make sure big files come first and chunks respect both budgets."""
+    folder = mkdtemp()
+    try:
+        sizes = {'huge': 50, 'big': 20, 'a': 5, 'b': 5, 'c': 5, 'd': 5}
+        for name, size in sizes.iteritems():
+            with open(join(folder, name), 'w') as file:
+                file.write('x' * size)
+        chunks = list(size_balanced_chunks(
+            (join(folder, name) for name in sizes),
+            bytes_per_chunk=25,
+            paths_per_chunk=3))
+        eq_([[p[len(folder) + 1:] for p in chunk] for chunk in chunks],
+            [['huge'], ['big', 'd'], ['c', 'b', 'a']])
+    finally:
+        rmtree(folder)
+
+
+def test_tree_indexers_snapshot():
+    """Snapshots should unpickle once per process and then be reused."""
+    folder = mkdtemp()
+    try:
+        snapshot = TreeIndexersSnapshot([{'graph': range(3)}],
+                                        join(folder, 'snapshot'))
+        loaded = snapshot.tree_indexers()
+        eq_(loaded, [{'graph': [0, 1, 2]}])
+        ok_(snapshot.tree_indexers() is loaded)
+
+        # A new snapshot at the same path shouldn't be served the old one:
+        eq_(TreeIndexersSnapshot(['new'], join(folder, 'snapshot'))
+                .tree_indexers(),
+            ['new'])
+    finally:
+        rmtree(folder)
+
+
+def test_journal_round_trip():
+    """A journal should read back what was written to it, ignoring a
+    half-written final record."""
+    folder = mkdtemp()
+    try:
+        path = join(folder, 'journal.pickle')
+        eq_(IndexingJournal.load(path), None)
+        journal = IndexingJournal(path)
+        journal.start('dxr_hot_1', 'fingerprint', 'dxr_hot_0')
+        journal.note_build()
+        journal.note_chunk(['/a', '/b'])
+        journal.note_chunk(['/c'])
+        with open(path, 'ab') as file:
+            file.write('\x80\x02(U')  # the start of a record cut short
+
+        loaded = IndexingJournal.load(path)
+        ok_(loaded.resuming)
+        eq_((loaded.index, loaded.fingerprint, loaded.previous_index),
+            ('dxr_hot_1', 'fingerprint', 'dxr_hot_0'))
+        ok_(loaded.build_done)
+        ok_(not loaded.folders_done)
+        eq_(loaded.completed_paths, set(['/a', '/b', '/c']))
+
+        loaded.finish()
+        eq_(IndexingJournal.load(path), None)
+    finally:
+        rmtree(folder)
+
+
+def test_duplicate_cache_eviction():
+    """The oldest entries should go once the cache covers too many lines."""
+    cache = DuplicateCache(max_lines=10)
+    cache.put('a', ['a stuff'], 4)
+    cache.put('b', [], 4)
+    eq_(cache.get('b'), [])  # Empty values are still hits.
+    cache.put('c', ['c stuff'], 4)
+    eq_(cache.get('a'), None)
+    eq_(cache.get('c'), ['c stuff'])
+    cache.put('huge', ['too big to bother with'], 11)
+    eq_(cache.get('huge'), None)
+
+
+def test_depends_only_on_contents():
+    """Plugins that don't override refs or regions needn't vouch for
+    themselves, but ones that do must."""
+    class Plain(FileToIndex):
+        def needles(self):
+            return []
+
+    class Analyzed(FileToIndex):
+        def refs(self):
+            return []
+
+    class Vouched(Analyzed):
+        contents_only = True
+
+    for cls, expected in [(Plain, True), (Analyzed, False), (Vouched, True)]:
+        eq_(depends_only_on_contents(cls('a.c', u'', 'plugin', None)),
+            expected)
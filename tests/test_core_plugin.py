@@ -83,11 +83,22 @@ class PathFilterTests(TestCase):
             {
                 'and': [
                     {
-                        'query': {
-                            'match_phrase': {
-                                'path.trigrams': 'fooba'
+                        'or': [
+                            {
+                                'query': {
+                                    'match_phrase': {
+                                        'path.trigrams': 'foobar'
+                                    }
+                                }
+                            },
+                            {
+                                'query': {
+                                    'match_phrase': {
+                                        'path.trigrams': 'foobaz'
+                                    }
+                                }
                             }
-                        }
+                        ]
                     },
                     {
                         'script': {
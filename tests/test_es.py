@@ -0,0 +1,169 @@
+"""Tests for the ES helpers which don't need a live ES"""
+
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+from time import sleep
+
+from flask import Flask
+from nose.tools import eq_, assert_raises
+from werkzeug.exceptions import NotFound
+
+from dxr.config import FORMAT
+from dxr.es import (BulkSender, BulkStats, CatalogCache, connect,
+                    frozen_config, frozen_configs, invalidate_catalog_cache,
+                    TREE)
+
+
+class FakeES(object):
+    """Enough of an ElasticSearch to record bulk requests"""
+
+    def __init__(self, fail_on=None):
+        self.chunks = []
+        self.fail_on = fail_on
+
+    def bulk(self, chunk, index=None, doc_type=None):
+        if chunk == self.fail_on:
+            raise ValueError('ES is sad.')
+        self.chunks.append((chunk, index, doc_type))
+
+
+def test_bulk_sender():
+    """Every chunk should get sent, and stats should add up."""
+    for in_flight in 0, 1, 3:
+        es = FakeES()
+        sender = BulkSender(es, 'some_index', 'line', in_flight=in_flight)
+        for i in xrange(10):
+            sender.send(['{"a": %s}' % i, '{}'])
+        sender.close()
+        eq_(sorted(es.chunks),
+            sorted((['{"a": %s}' % i, '{}'], 'some_index', 'line')
+                   for i in xrange(10)))
+        eq_(sender.stats.requests, 10)
+        eq_(sender.stats.docs, 20)
+        eq_(sum(sender.stats.histogram), 10)
+
+
+def test_bulk_sender_errors():
+    """Errors in the sending threads should surface in the caller."""
+    sender = BulkSender(FakeES(fail_on=['bad']), 'some_index', in_flight=1)
+    sender.send(['bad'])
+    assert_raises(ValueError, sender.close)
+
+
+def test_bulk_sender_abort():
+    """Aborting should stop the threads without raising, and closing before
+    aborting should make the abort a no-op."""
+    sender = BulkSender(FakeES(fail_on=['bad']), 'some_index', in_flight=2)
+    threads = sender._threads
+    sender.send(['bad'])
+    sender.abort()
+    eq_([t for t in threads if t.is_alive()], [])
+
+    es = FakeES()
+    sender = BulkSender(es, 'some_index', in_flight=2)
+    sender.send(['{}'])
+    sender.close()
+    sender.abort()
+    eq_(len(es.chunks), 1)
+
+
+def test_bulk_stats_merge():
+    one, two = BulkStats(), BulkStats()
+    one.record(['abc'], 0.001)
+    two.record(['abc', 'de'], 100)
+    one.merge(two)
+    eq_((one.requests, one.docs, one.bytes), (2, 3, 11))
+    eq_(one.histogram[0], 1)
+    eq_(one.histogram[-1], 1)
+
+
+def test_catalog_cache():
+    """Frozen configs should come from memory until invalidated, except that
+    trees new to the cache should be looked up right away."""
+    folder = mkdtemp()
+    try:
+        app = Flask(__name__)
+        app.es = connect('sqlite:///' + join(folder, 'es.sqlite'))
+        app.dxr_config = type('FakeConfig', (), {'es_catalog_index': 'cat'})
+        app.catalog_cache = CatalogCache(ttl=1000)
+
+        def deploy(name, date):
+            app.es.index('cat', TREE,
+                         {'name': name, 'format': FORMAT,
+                          'generated_date': date},
+                         id='%s/%s' % (FORMAT, name))
+
+        with app.app_context():
+            deploy('a', 'Mon')
+            eq_(frozen_config('a')['generated_date'], 'Mon')
+            generation = app.catalog_cache.generation()
+
+            deploy('a', 'Tue')
+            eq_(frozen_config('a')['generated_date'], 'Mon')
+            eq_(app.catalog_cache.generation(), generation)
+
+            deploy('b', 'Tue')
+            eq_(frozen_config('b')['generated_date'], 'Tue')
+            eq_([c['generated_date'] for c in frozen_configs()],
+                ['Tue', 'Tue'])
+            assert app.catalog_cache.generation() != generation
+            assert_raises(NotFound, frozen_config, 'c')
+    finally:
+        rmtree(folder)
+
+
+class SlowCatalogES(object):
+    """An ES whose catalog searches are slow and counted"""
+
+    def __init__(self):
+        self.searches = 0
+
+    def search(self, query, index=None, doc_type=None, size=None):
+        self.searches += 1
+        sleep(0.05)
+        return {'hits': {'hits': [{'_source': {'name': 'a',
+                                               'format': FORMAT,
+                                               'generated_date': 'Mon'}}]}}
+
+
+def test_catalog_cache_threads():
+    """Threads finding the cache expired at once should share one fetch, and
+    a deploy should be able to expire it without an app context."""
+    app = Flask(__name__)
+    app.es = SlowCatalogES()
+    app.dxr_config = type('FakeConfig', (), {'es_catalog_index': 'cat'})
+    app.catalog_cache = CatalogCache(ttl=1000)
+    generations = []
+
+    def look():
+        with app.app_context():
+            generations.append(app.catalog_cache.generation())
+
+    threads = [Thread(target=look) for _ in xrange(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    eq_(app.es.searches, 1)
+    eq_(generations, [(('a', 'Mon'),)] * 5)
+
+    invalidate_catalog_cache()
+    look()
+    eq_(app.es.searches, 2)
+
+
+def test_uncached_catalog_per_request():
+    """With caching off, each app context should search the catalog once, no
+    matter how many lookups it makes."""
+    app = Flask(__name__)
+    app.es = SlowCatalogES()
+    app.dxr_config = type('FakeConfig', (), {'es_catalog_index': 'cat'})
+    app.catalog_cache = CatalogCache(ttl=0)
+    for searches in [1, 2]:
+        with app.app_context():
+            app.catalog_cache.generation()
+            eq_(frozen_config('a')['generated_date'], 'Mon')
+            eq_([c['name'] for c in frozen_configs()], ['a'])
+            eq_(app.es.searches, searches)
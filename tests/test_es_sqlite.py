@@ -0,0 +1,172 @@
+"""Tests for the SQLite stand-in for elasticsearch"""
+
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import sleep
+from unittest import TestCase
+
+from flask import Flask
+from nose.tools import eq_, assert_raises
+from pyelasticsearch import ElasticHttpNotFoundError, IndexAlreadyExistsError
+
+from dxr.es import (connect, filtered_query_pages, multi_search,
+                    scroll_hits)
+from dxr.es_sqlite import SqliteElasticSearch
+from dxr.plugins.core import analyzers, mappings
+from dxr.trigrammer import es_regex_filter, regex_grammar
+
+
+class SqliteTests(TestCase):
+    def setUp(self):
+        self.folder = mkdtemp()
+        self.es = connect(['sqlite:///' + join(self.folder, 'es.sqlite')])
+        self.es.create_index('idx', {'settings': {'analysis': analyzers},
+                                     'mappings': mappings})
+        self.es.bulk([self.es.index_op({'path': ['a/b.c'],
+                                        'number': [n],
+                                        'content': [content]},
+                                       id='a/b.c:%s' % n)
+                      for n, content in enumerate(['int main() {',
+                                                   '  return FooBar;',
+                                                   '}',
+                                                   '// foobar'],
+                                                  1)] +
+                     [self.es.index_op({'path': ['z.c'],
+                                        'number': [1],
+                                        'content': ['FooBar();']})],
+                     index='idx',
+                     doc_type='line')
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def _numbers(self, filter, **kwargs):
+        """Return the (path, line number) of each line matching a filter."""
+        hits = self.es.search({'query': {'filtered': {
+                                  'query': {'match_all': {}},
+                                  'filter': filter}},
+                               'sort': ['path', 'number']},
+                              index='idx',
+                              doc_type='line',
+                              **kwargs)['hits']['hits']
+        return [(h['_source']['path'][0], h['_source']['number'][0])
+                for h in hits]
+
+    def test_connect(self):
+        """A sqlite: URL should get the embedded backend."""
+        eq_(type(self.es), SqliteElasticSearch)
+
+    def test_terms_and_ranges(self):
+        eq_(self._numbers({'term': {'path': 'z.c'}}), [('z.c', 1)])
+        eq_(self._numbers({'and': [{'terms': {'path': ['a/b.c', 'q']}},
+                                   {'range': {'number': {'gte': 2,
+                                                         'lte': 3}}}]}),
+            [('a/b.c', 2), ('a/b.c', 3)])
+        eq_(self._numbers({'not': {'term': {'path': 'a/b.c'}}}),
+            [('z.c', 1)])
+
+    def test_trigram_phrases(self):
+        """Case-folded and case-sensitive phrase matching should both work
+        against the trigram subfields."""
+        eq_(self._numbers({'query': {'match_phrase': {
+                'content.trigrams_lower': 'FOOBAR'}}}),
+            [('a/b.c', 2), ('a/b.c', 4), ('z.c', 1)])
+        eq_(self._numbers({'query': {'match_phrase': {
+                'content.trigrams': 'FooBar'}}}),
+            [('a/b.c', 2), ('z.c', 1)])
+
+    def test_regex_script(self):
+        """The JS regex scripts from the trigrammer should be honored."""
+        filter = es_regex_filter(regex_grammar.parse(r'^Foo\w+\('),
+                                 'content',
+                                 is_case_sensitive=True)
+        eq_(self._numbers(filter), [('z.c', 1)])
+
+    def test_paging_and_source_filtering(self):
+        result = self.es.search({'query': {'match_all': {}},
+                                 'sort': [{'number': 'desc'}, 'path'],
+                                 '_source': {'include': ['number']}},
+                                index='idx',
+                                size=2)['hits']
+        eq_(result['total'], 5)
+        eq_([h['_source'] for h in result['hits']],
+            [{'number': [4]}, {'number': [3]}])
+
+    def test_scroll(self):
+        hits = scroll_hits(self.es, {'query': {'match_all': {}}}, 'idx',
+                           size=2)
+        eq_(len(list(hits)), 5)
+        eq_(self.es._scrolls, {})  # cleared once done
+
+    def test_scroll_expiry(self):
+        """Scrolls left unfinished should be forgotten once they time out."""
+        def start_scroll(keep_alive):
+            return self.es.search({'query': {'match_all': {}}},
+                                  index='idx',
+                                  size=2,
+                                  es_scroll=keep_alive)['_scroll_id']
+
+        def next_page(scroll_id):
+            return self.es.send_request('GET', ['_search', 'scroll'],
+                                        scroll_id,
+                                        query_params={'scroll': '1m'})
+
+        abandoned = start_scroll('1ms')
+        kept = start_scroll('1m')
+        sleep(0.01)
+        eq_(len(next_page(kept)['hits']['hits']), 2)
+        eq_(self.es._scrolls.keys(), [kept])
+        assert_raises(ElasticHttpNotFoundError, next_page, abandoned)
+
+    def test_filtered_query_pages(self):
+        """Paging by a key field should turn up every matching doc, in order,
+        however the pages happen to divide them."""
+        app = Flask(__name__)
+        app.es = self.es
+        with app.app_context():
+            for size in [2, 3, 10]:
+                eq_([doc['number'] for doc in
+                     filtered_query_pages('idx', 'line', {'path': 'a/b.c'},
+                                          'number',
+                                          size=size,
+                                          include=['number'])],
+                    [[1], [2], [3], [4]])
+
+    def test_multi_search(self):
+        """Each search in a batch should get its own response, in order."""
+        responses = multi_search(
+            self.es,
+            [('line', {'query': {'term': {'path': 'z.c'}}}),
+             ('line', {'query': {'match_all': {}}, 'size': 2})],
+            'idx')
+        eq_([(r['hits']['total'], len(r['hits']['hits'])) for r in responses],
+            [(1, 1), (5, 2)])
+
+    def test_multi_search_across_indices(self):
+        """Searches naming their own indices should each hit theirs."""
+        self.es.create_index('other')
+        self.es.update_aliases([{'add': {'index': 'idx', 'alias': 'al'}}])
+        responses = multi_search(
+            self.es,
+            [('al', 'line', {'query': {'term': {'path': 'z.c'}}}),
+             ('other', 'line', {'query': {'term': {'path': 'z.c'}}})])
+        eq_([r['hits']['total'] for r in responses], [1, 0])
+
+    def test_aliases(self):
+        """Searches and gets should work through an alias, and creating an
+        index twice should fail like it does in ES."""
+        self.es.update_aliases([{'add': {'index': 'idx', 'alias': 'al'}}])
+        eq_(self.es.aliases('al').keys(), ['idx'])
+        eq_(self.es.get('al', 'line', 'a/b.c:3')['_source']['content'],
+            ['}'])
+        assert_raises(IndexAlreadyExistsError, self.es.create_index, 'idx')
+
+    def test_deletion(self):
+        self.es.delete_by_query('idx', 'line',
+                                {'filtered': {'filter': {'term': {
+                                    'path': 'a/b.c'}}}})
+        eq_(self._numbers({'match_all': {}}), [('z.c', 1)])
+        self.es.delete_index('id*')
+        assert_raises(ElasticHttpNotFoundError,
+                      self.es.get, 'idx', 'line', 'a/b.c:1')
@@ -0,0 +1,67 @@
+"""Tests for conditional requests, cache headers, and compression"""
+
+from nose.tools import eq_, ok_
+
+from dxr.compression import gunzipped
+
+from dxr.testing import SingleFileTestCase
+
+
+class HttpCachingTests(SingleFileTestCase):
+    source = """
+        int main(int argc, char* argv[]) {
+            return 0;
+        }
+        """
+
+    def test_not_modified(self):
+        """A request bearing the ETag of the current index should get a
+        304, and views varying by header should have ETags to match."""
+        client = self.client()
+        response = client.get('/code/source/main')
+        eq_(response.status_code, 200)
+        etag = response.headers['ETag']
+        ok_(response.headers['Last-Modified'])
+        ok_('public' in response.headers['Cache-Control'])
+
+        response = client.get('/code/source/main',
+                              headers={'If-None-Match': etag})
+        eq_(response.status_code, 304)
+        eq_(response.data, '')
+        eq_(response.headers['ETag'], etag)
+        eq_(response.headers['Vary'], 'Accept-Encoding')
+
+        html = client.get('/code/search?q=main')
+        json = client.get('/code/search?q=main',
+                          headers={'Accept': 'application/json'})
+        ok_(html.headers['ETag'] != json.headers['ETag'])
+        ok_('Accept' in json.headers['Vary'].split(', '))
+        ok_('Accept-Encoding' in html.headers['Vary'].split(', '))
+
+    def test_errors_uncached(self):
+        """Error responses shouldn't be marked cacheable."""
+        response = self.client().get('/code/source/nonexistent')
+        eq_(response.status_code, 404)
+        ok_('ETag' not in response.headers)
+
+    def test_gzip(self):
+        """Clients that take gzip should get the same page, gzipped."""
+        client = self.client()
+        plain = client.get('/code/source/main')
+        gzipped = client.get('/code/source/main',
+                             headers={'Accept-Encoding': 'gzip'})
+        ok_('Content-Encoding' not in plain.headers)
+        eq_(gzipped.headers['Content-Encoding'], 'gzip')
+        eq_(gunzipped(gzipped.data), plain.data)
+        eq_(gzipped.headers['Vary'], 'Accept-Encoding')
+
+    def test_page_version(self):
+        """Upgrading or reconfiguring DXR should invalidate old ETags."""
+        app = self.app()
+        client = app.test_client()
+        etag = client.get('/code/source/main').headers['ETag']
+        app.page_version = 'something else'
+        response = client.get('/code/source/main',
+                              headers={'If-None-Match': etag})
+        eq_(response.status_code, 200)
+        ok_(response.headers['ETag'] != etag)
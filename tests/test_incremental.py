@@ -0,0 +1,45 @@
+"""Tests for incremental re-indexing"""
+
+import json
+from os import mkdir
+from os.path import join
+
+from nose.tools import eq_, ok_
+
+from dxr.build import index_and_deploy_tree
+from dxr.testing import GenerativeTestCase, make_file
+
+
+class IncrementalTests(GenerativeTestCase):
+    """An incremental index should copy the docs of files whose contents and
+    neighbors haven't changed and re-index the rest."""
+
+    @classmethod
+    def config_input(cls, config_dir_path):
+        config = super(IncrementalTests, cls).config_input(config_dir_path)
+        config['DXR']['enabled_plugins'] = 'pygmentize extmatch'
+        return config
+
+    @classmethod
+    def generate_source(cls):
+        make_file(cls.code_dir(), 'main.h', u'int main(int argc);\n')
+        mkdir(join(cls.code_dir(), 'lib'))
+        make_file(join(cls.code_dir(), 'lib'), 'util.h', u'int util();\n')
+
+    def test_new_sibling(self):
+        """A sibling's appearance should get an unchanged file re-indexed so
+        it shows up in its links. Files in other folders should be copied."""
+        ok_('main.cpp' not in self.source_page('main.h'))
+
+        make_file(self.code_dir(), 'main.cpp', u'int main(int argc) {}\n')
+        tree = self.config().trees['code']
+        index_and_deploy_tree(tree, incremental=True)
+        self._es().refresh()
+
+        markup = self.source_page('main.h')
+        ok_('source/main.cpp" title="main.cpp"' in markup)
+        ok_('class="k"' in markup)  # pygmentize's keyword highlighting
+
+        with open(join(tree.log_folder, 'indexing-profile.json')) as file:
+            eq_(json.load(file)['counters']['reused_files'], 1)
+        ok_('class="k"' in self.source_page('lib/util.h'))
@@ -6,11 +6,12 @@ import warnings
 from warnings import catch_warnings
 
 from more_itertools import first
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 
 from dxr.lines import (line_boundaries, remove_overlapping_refs, Region, LINE,
-                       Ref, balanced_tags, finished_tags, tag_boundaries,
-                       html_line, nesting_order, tags_per_line)
+                       Ref, RefTable, balanced_tags, finished_tags,
+                       tag_boundaries, html_line, nesting_order, tags_per_line)
+from dxr.plugins.clang.menus import TypeRef
 from dxr.utils import build_offset_map, split_content_lines
 
 
@@ -316,3 +317,23 @@ def test_unusual_whitespace():
              u"This is the last line\n"]
     eq_(split_content_lines(u''.join(lines)), lines)
 
+
+def test_ref_table():
+    """Packing refs should store each distinct payload once, and unpacking
+    should give back equivalent refs at the same spots."""
+    foo, bar = [TypeRef('tree', {'qualname': q}, qualname=q)
+                for q in ['Foo', 'Bar']]
+    table = RefTable()
+    packed = [table.pack([{'start': s, 'end': e, 'payload': r.es()}
+                          for s, e, r in line])
+              for line in [[(0, 3, foo), (4, 7, bar)], [(9, 12, foo)]]]
+    eq_(packed, [[[0, 3, 0], [4, 7, 1]], [[9, 12, 0]]])
+    eq_(len(table.payloads), 2)
+
+    triples = list(RefTable.es_to_triples(packed, table.es(), 'tree'))
+    eq_([(start, end, type(ref), ref.menu_data, ref.qualname_hash)
+         for start, end, ref in triples],
+        [(0, 3, TypeRef, {'qualname': 'Foo'}, hash('Foo')),
+         (4, 7, TypeRef, {'qualname': 'Bar'}, hash('Bar')),
+         (9, 12, TypeRef, {'qualname': 'Foo'}, hash('Foo'))])
+    ok_(triples[0][2] is triples[2][2])
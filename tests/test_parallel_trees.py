@@ -0,0 +1,33 @@
+"""Tests for the "which trees have this file" endpoint"""
+
+from json import loads
+
+from nose.tools import eq_
+
+from dxr.testing import SingleFileTestCase
+
+
+class ParallelTreesTests(SingleFileTestCase):
+    source = """
+        int main(int argc, char* argv[]) {
+            return 0;
+        }
+        """
+
+    def test_present(self):
+        """A path which exists should list its tree, with a link to it."""
+        response = self.client().get('/code/parallel-trees/main')
+        eq_(response.status_code, 200)
+        eq_(loads(response.data)['trees'],
+            [{'name': 'code', 'url': '/code/source/main'}])
+
+    def test_absent(self):
+        """A path which exists nowhere should list no trees."""
+        response = self.client().get('/code/parallel-trees/nothing')
+        eq_(loads(response.data)['trees'], [])
+
+    def test_root(self):
+        """The root, which has no file doc, should be in every tree."""
+        response = self.client().get('/code/parallel-trees/')
+        eq_(loads(response.data)['trees'],
+            [{'name': 'code', 'url': '/code/source/'}])
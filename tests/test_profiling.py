@@ -0,0 +1,56 @@
+"""Tests for the indexing profiler"""
+
+import json
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from nose.tools import eq_, ok_
+
+from dxr.profiling import IndexingProfile
+
+
+def test_timed_iter():
+    """Make sure timed_iter passes items through and records a single call
+    once the iterable is exhausted."""
+    profile = IndexingProfile()
+    eq_(list(profile.timed_iter('file:x.refs', iter([1, 2, 3]))), [1, 2, 3])
+    calls, wall, cpu, rss = profile.stages['file:x.refs']
+    eq_(calls, 1)
+    ok_(wall >= 0)
+
+
+def test_merge():
+    """Merging should sum stages and counters and keep only the slowest
+    files."""
+    a, b = IndexingProfile(), IndexingProfile()
+    with a.timing('build'):
+        pass
+    with b.timing('build'):
+        pass
+    for i in xrange(IndexingProfile.SLOWEST_FILES):
+        a.note_file('a%s' % i, i)
+    b.note_file('slowpoke', 1000)
+    a.count('files', 3)
+    b.count('files')
+    a.merge(b)
+    eq_(a.stages['build'][0], 2)
+    eq_(a.counters['files'], 4)
+    slowest = a.as_dict()['slowest_files']
+    eq_(len(slowest), IndexingProfile.SLOWEST_FILES)
+    eq_(slowest[0], {'path': 'slowpoke', 'seconds': 1000})
+    ok_('a0' not in [f['path'] for f in slowest])
+
+
+def test_write():
+    """The written file should be loadable JSON."""
+    folder = mkdtemp()
+    try:
+        profile = IndexingProfile()
+        with profile.timing('post_build:clang'):
+            pass
+        with open(profile.write(folder)) as file:
+            eq_(json.load(file)['stages']['post_build:clang']['calls'], 1)
+        eq_(profile.write(folder), join(folder, 'indexing-profile.json'))
+    finally:
+        rmtree(folder)
@@ -6,9 +6,12 @@ everything else. Here are a few unit tests.
 """
 from unittest import TestCase
 
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 
-from dxr.query import fix_extents_overlap
+from dxr.plugins import core_plugin
+from dxr.query import (filter_cost, fix_extents_overlap, Query,
+                       MAX_VERIFY_CANDIDATES)
+from dxr.utils import LruCache
 
 
 class FixExtentsOverlapTests(TestCase):
@@ -49,3 +52,161 @@ class FixExtentsOverlapTests(TestCase):
         """Work even if the highlighting starts at offset 0."""
         eq_(list(fix_extents_overlap([(0, 3), (2, 5), (11, 14)])),
             [(0, 5), (11, 14)])
+
+
+def test_results_cache():
+    """Results should be fetched and highlighted once per index, query, and
+    page, no matter how the query is spelled."""
+    searches = []
+
+    def es_search(query, doc_type):
+        searches.append(query)
+        return {'hits': {'total': 1,
+                         'hits': [{'_source': {'path': ['a.c'],
+                                               'number': [3],
+                                               'content': ['int main']}}]}}
+
+    def results(query_text, index='idx', offset=0):
+        query = Query(es_search, query_text, [core_plugin()],
+                      results_cache=cache, cache_key=index)
+        results = query.results(offset=offset)
+        return results['result_count'], list(results['results'])
+
+    cache = LruCache(10)
+    first = results('main')
+    eq_(results('  main '), first)
+    eq_(len(searches), 1)
+    results('main', index='idx2')
+    results('main', offset=100)
+    eq_(len(searches), 3)
+    eq_((cache.hits, cache.misses), (1, 3))
+
+
+def scrolling(contents):
+    """Return a fake ``es_scroll`` which pages through LINE docs of a.c having
+    the given contents, recording the queries it's given."""
+    def es_scroll(query, doc_type, size):
+        es_scroll.queries.append(query)
+        for start in xrange(0, len(contents), size):
+            yield {'hits': {'total': len(contents),
+                            'hits': [{'_source': {'path': ['a.c'],
+                                                  'number': [number],
+                                                  'content': [content]}}
+                                     for number, content in
+                                     enumerate(contents[start:start + size],
+                                               start + 1)]}}
+    es_scroll.queries = []
+    return es_scroll
+
+
+def test_native_verification():
+    """With native verification, regex candidates should be found by trigrams
+    alone and checked in Python, stopping once there are enough."""
+    es_scroll = scrolling(['foo1bar', 'foobar', 'foo2bar', 'fooxbar',
+                           'foo3bar'])
+
+    def results(limit):
+        query = Query(None, r'regexp:foo\dbar', [core_plugin()],
+                      verify_natively=True, es_scroll=es_scroll)
+        results = query.results(limit=limit)
+        return (results['result_count'],
+                results['result_count_approximate'],
+                [line for _, _, lines in results['results']
+                 for line, _ in lines])
+
+    # Stopping early leaves the count an upper bound:
+    eq_(results(2), (4, True, [1, 3]))
+    ok_('script' not in repr(es_scroll.queries[0]))
+    eq_(results(10), (3, False, [1, 3, 5]))
+
+
+def test_verification_fallback():
+    """Past MAX_VERIFY_CANDIDATES candidates, the regex should be checked by
+    ES after all."""
+    searches = []
+
+    def es_search(query, doc_type):
+        searches.append(query)
+        return {'hits': {'total': 0, 'hits': []}}
+
+    query = Query(es_search, r'regexp:foo\dbar', [core_plugin()],
+                  verify_natively=True,
+                  es_scroll=scrolling(['fooxbar'] *
+                                      (MAX_VERIFY_CANDIDATES + 1)))
+    eq_(query.results()['result_count'], 0)
+    eq_(len(searches), 1)
+    ok_('script' in repr(searches[0]))
+
+
+def test_plan():
+    """Cheap, selective clauses should come before expensive ones, whatever
+    order the user typed them in, and constraints on whole files should be
+    described rather than looked up."""
+    def es_search(query, doc_type):
+        raise AssertionError("Explaining a query shouldn't search.")
+
+    query = Query(es_search,
+                  r'regexp:foo\dbar path:somepath ext:c ext:c',
+                  [core_plugin()])
+    plan = query.plan()
+    eq_(plan['doc_type'], 'line')
+    clauses = [clause['filter'] for clause in plan['clauses']]
+    eq_(len(clauses), 2)
+    prefilter = plan['file_prefilter']
+    eq_(clauses[0], {'terms': {'path': {'files_matching':
+                                            prefilter['filter']}}})
+    file_clauses = prefilter['filter']['and']
+    eq_(file_clauses[0], {'term': {'ext': 'c'}})  # Duplicates are pruned.
+    eq_(len(file_clauses), 3)
+    eq_(prefilter['cost'], sum(filter_cost(c) for c in file_clauses))
+    ok_('content' in repr(clauses[1]))
+    eq_([c['cost'] for c in plan['clauses']],
+        sorted(c['cost'] for c in plan['clauses']))
+
+
+def test_file_paths():
+    """Constraints on whole files should be resolved to a list of paths
+    first, leaving the LINE query to look only within those, and the paths
+    should be remembered for the next page."""
+    searches = []
+
+    def es_search(query, doc_type):
+        searches.append((doc_type, query))
+        if doc_type == 'line':
+            return {'hits': {'total': 0, 'hits': []}}
+        return {'hits': {'total': 2,
+                         'hits': [{'_source': {'path': ['dom/a.c']}},
+                                  {'_source': {'path': ['dom/b.c']}}]}}
+
+    cache = LruCache(10)
+
+    def results(offset):
+        Query(es_search, 'path:dom/ ext:c regexp:foo.*bar', [core_plugin()],
+              results_cache=cache, cache_key='idx').results(offset=offset)
+
+    results(0)
+    eq_([doc_type for doc_type, _ in searches], ['file', 'line'])
+    clauses = searches[1][1]['query']['filtered']['filter']['and']
+    eq_(clauses[0], {'terms': {'path': ['dom/a.c', 'dom/b.c']}})
+    eq_(len(clauses), 2)
+    ok_('content' in repr(clauses[1]))
+
+    results(100)
+    eq_([doc_type for doc_type, _ in searches], ['file', 'line', 'line'])
+
+
+def test_parse_cache():
+    """A query string seen before should reuse its terms and filters rather
+    than being reparsed."""
+    def es_search(query, doc_type):
+        return {'hits': {'total': 0, 'hits': []}}
+
+    cache = LruCache(10)
+    first = Query(es_search, 'regexp:foo.*bar', [core_plugin()],
+                  parse_cache=cache)
+    first.results()
+    second = Query(es_search, 'regexp:foo.*bar', [core_plugin()],
+                   parse_cache=cache)
+    ok_(second.terms is first.terms)
+    ok_(second._filters() is first._filters())
+    eq_((cache.hits, cache.misses), (1, 1))
@@ -0,0 +1,48 @@
+"""Tests for the cache of rendered file pages"""
+
+from os import listdir
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from nose.tools import eq_
+
+from dxr.compression import gunzipped
+from dxr.render_cache import RenderCache
+
+
+def test_round_trip_and_eviction():
+    """Pages should come back as stored, and caching a page for a new index
+    should evict the tree's older ones."""
+    folder = mkdtemp()
+    try:
+        cache = RenderCache(folder)
+        eq_(cache.get('tree', 'index1', 'a.c'), None)
+        cache.put('tree', 'index1', 'a.c', u'<p>\N{SNOWMAN}</p>')
+        cache.put('other', 'index9', 'a.c', u'other')
+        eq_(cache.get('tree', 'index1', 'a.c'), u'<p>\N{SNOWMAN}</p>')
+
+        cache.put('tree', 'index2', 'b.c', u'new')
+        eq_(listdir(folder + '/tree'), ['index2'])
+        eq_(cache.get('tree', 'index1', 'a.c'), None)
+        eq_(cache.get('other', 'index9', 'a.c'), u'other')
+    finally:
+        rmtree(folder)
+
+
+def test_tee():
+    """A streamed page should be stored only once it's been sent in full."""
+    folder = mkdtemp()
+    try:
+        cache = RenderCache(folder)
+        chunks = cache.tee('tree', 'index', 'a.c', [u'<p>', u'hi', u'</p>'])
+        eq_(next(chunks), u'<p>')
+        chunks.close()  # The client went away.
+        eq_(cache.get('tree', 'index', 'a.c'), None)
+        eq_(listdir(folder + '/tree/index'), [])
+
+        eq_(list(cache.tee('tree', 'index', 'a.c', [u'<p>', u'hi'])),
+            [u'<p>', u'hi'])
+        eq_(cache.get('tree', 'index', 'a.c'), u'<p>hi')
+        eq_(gunzipped(cache.get_gzipped('tree', 'index', 'a.c')), '<p>hi')
+    finally:
+        rmtree(folder)
@@ -0,0 +1,38 @@
+"""Tests for resuming a failed, checkpointed indexing run"""
+
+from os.path import exists, join
+
+from funcy import first
+from nose.tools import eq_, ok_
+
+from dxr.build import (ensure_folder, index_fingerprint, index_tree,
+                       IndexingJournal)
+from dxr.config import FORMAT
+from dxr.testing import SingleFileTestCase
+
+
+class ResumeTests(SingleFileTestCase):
+    source = """
+        int main(int argc, char* argv[]) {
+            return 0;
+        }
+        """
+
+    def test_cleanup(self):
+        """A resumed run that finishes should delete its journal and, like any
+        other run, its temp folder."""
+        tree = self.config().trees['code']
+        es = self._es()
+        index = first(es.aliases(tree.config.es_alias.format(format=FORMAT,
+                                                             tree='code')))
+
+        # Pretend a run into the live index failed after doing everything:
+        ensure_folder(tree.temp_folder)
+        journal = IndexingJournal(join(tree.temp_folder, 'journal.pickle'))
+        journal.start(index, index_fingerprint(tree))
+        journal.note_build()
+        journal.note_folders()
+        journal.note_chunk([join(tree.source_folder, 'main')])
+
+        eq_(index_tree(tree, es, resume=True), index)
+        ok_(not exists(tree.temp_folder))
@@ -0,0 +1,26 @@
+"""Tests for the cache statistics endpoint"""
+
+from json import loads
+
+from nose.tools import eq_, ok_
+
+from dxr.testing import SingleFileTestCase
+
+
+class StatsTests(SingleFileTestCase):
+    source = """
+        int main(int argc, char* argv[]) {
+            return 0;
+        }
+        """
+
+    def test_query_cache(self):
+        """Repeating a search should show up as a query cache hit."""
+        client = self.client()
+        before = loads(client.get('/stats').data)['query_cache']
+        for _ in xrange(2):
+            client.get('/code/search?q=argc&redirect=false')
+        after = loads(client.get('/stats').data)
+        eq_(after['query_cache']['misses'], before['misses'] + 1)
+        eq_(after['query_cache']['hits'], before['hits'] + 1)
+        ok_('hits' in after['search_cache'])
@@ -9,7 +9,8 @@ from parsimonious import ParseError
 from parsimonious.expressions import OneOf
 
 from dxr.trigrammer import (regex_grammar, SubstringTreeVisitor, And, Or,
-                            BadRegex, JsRegexVisitor, PythonRegexVisitor)
+                            BadRegex, JsRegexVisitor, PythonRegexVisitor,
+                            regex_substrings)
 
 
 # Make sure we don't have have both "ab" and "abc" both as possible prefixes. This is equivalent to just "ab".
@@ -194,6 +195,65 @@ class ClassTests(TestCase):
         eq_simplified(u'[♣-♥]', Or([u'♣', u'♤', u'♥']))
 
 
+def eq_substrings(regex, expected):
+    """Assert that the query extracted from a regex, Cox-style, is as
+    expected."""
+    eq_(regex_substrings(regex_grammar.parse(regex)), expected)
+
+
+class CoxTests(TestCase):
+    """Tests for extracting queries by tracking prefixes, suffixes, and exact
+    matches, which lets trigrams span subpatterns"""
+
+    def test_literal(self):
+        eq_substrings('abcd', 'abcd')
+        eq_substrings('.*abc.*', 'abc')
+
+    def test_too_short(self):
+        """Patterns without a trigram to require should come out empty."""
+        eq_substrings('ab', '')
+        eq_substrings('abc|d', '')
+        eq_substrings('ab[a-z]cd', '')
+
+    def test_small_classes(self):
+        """Small classes should multiply out into their neighbors."""
+        eq_substrings('sp[rn]intf', Or(['spnintf', 'sprintf']))
+
+    def test_optional(self):
+        eq_substrings('foo(bar)?baz', Or(['foobarbaz', 'foobaz']))
+
+    def test_bounded_repeat(self):
+        eq_substrings('ab{1,3}c', Or(['abbbc', 'abbc', 'abc']))
+        eq_substrings('ab{2}c', 'abbc')
+
+    def test_plus(self):
+        """A+ should keep its prefixes and suffixes, so trigrams can span
+        it."""
+        eq_substrings('a+bcd', 'abcd')
+        eq_substrings('ab(cd)+ef', And(['abcd', 'cdef']))
+
+    def test_across_uselesses(self):
+        """Literals on either side of a star shouldn't be merged."""
+        eq_substrings('arkb*cork', And(['ark', 'cork']))
+
+    def test_alternation(self):
+        eq_substrings('(ab|cd)ef', Or(['abef', 'cdef']))
+
+    def test_anchors(self):
+        """Anchors match nothing in the text themselves."""
+        eq_substrings('(/|^)foo\\.c$', 'foo.c')
+
+    def test_big_cross_product(self):
+        """Once the exact set gets big, we should settle for trigrams from
+        prefixes and suffixes."""
+        eq_substrings('sp[rne][iou]nt',
+                      And([Or(['spei', 'speo', 'speu',
+                               'spni', 'spno', 'spnu',
+                               'spri', 'spro', 'spru']),
+                           Or(['eint', 'eont', 'eunt',
+                               'nint', 'nont', 'nunt',
+                               'rint', 'ront', 'runt'])]))
+
 def test_parse_classes():
     """Make sure we recognize character classes."""
 
@@ -2,12 +2,13 @@
 
 from datetime import datetime
 
-from nose.tools import eq_, assert_raises
+from nose.tools import eq_, assert_raises, ok_
 
 from dxr.testing import TestCase
 from dxr.utils import (DXR_BLUEPRINT, append_update, append_update_by_line,
                        append_by_line, browse_file_url, decode_es_datetime,
-                       deep_update, glob_to_regex, search_url)
+                       deep_update, glob_to_regex, IgnoreMatcher, LruCache,
+                       search_url)
 
 
 class DeepUpdateTests(TestCase):
@@ -98,6 +99,43 @@ def test_glob_to_regex():
     eq_(glob_to_regex('hi'), 'hi')
 
 
+def test_ignore_matcher():
+    """IgnoreMatcher should agree with fnmatchcase-ing each pattern in
+    turn."""
+    matcher = IgnoreMatcher(['.hg', '*.pyc', 'x?z', '[ab]c'],
+                            ['/obj/', '/docs/*.txt', '/literal/path.c'])
+    for path in ['.hg', 'sub/.hg', 'a.pyc', 'sub/b.pyc', 'xyz', 'ac',
+                 'docs/readme.txt', 'docs/more/deep.txt', 'literal/path.c']:
+        ok_(matcher.is_ignored_file(path), path)
+    for path in ['hg', 'a.py', 'pyc', 'xz', 'cc', 'docs/readme.rst',
+                 'sub/docs/readme.txt', 'literal/path.cc', 'obj']:
+        ok_(not matcher.is_ignored_file(path), path)
+    ok_(matcher.is_ignored_folder('obj'))
+    ok_(matcher.is_ignored_folder('sub/.hg'))
+    ok_(not matcher.is_ignored_folder('sub/obj'))
+
+
+def test_ignore_matcher_no_patterns():
+    """Having nothing to compile shouldn't confuse anything."""
+    ok_(not IgnoreMatcher([], []).is_ignored_file('anything.c'))
+
+
+def test_lru_cache():
+    """The least recently used entry should be the one evicted."""
+    cache = LruCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    eq_(cache.get('a'), 1)  # so b is now the least recently used
+    cache.put('c', 3)
+    eq_([cache.get(k) for k in 'abc'], [1, None, 3])
+    eq_((cache.hits, cache.misses), (3, 1))
+    eq_(cache.stats(), {'size': 2, 'entries': 2, 'hits': 3, 'misses': 1})
+
+    disabled = LruCache(0)
+    disabled.put('a', 1)
+    eq_(disabled.get('a'), None)
+
+
 def test_decode_es_datetime():
     """Test that both ES datetime formats are decoded."""
     eq_(datetime(1992, 6, 27, 0, 0), decode_es_datetime("1992-06-27T00:00:00"))
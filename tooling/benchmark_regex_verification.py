@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""Time regex searches under both settings of ``regex_verification``::
+
+    benchmark_regex_verification.py [--es-hosts URL] [--files N] [--repeat N]
+
+Builds a synthetic tree--the same one every time, for a given ``--files``--
+indexes it into the given ES (by default, a throwaway SQLite one), and then
+runs the same regex searches through the web app once with ``script`` and
+once with ``python`` verification, printing the median time of each. The
+search cache is turned off so every run does the real work.
+
+"""
+from os import mkdir
+from os.path import join
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from click import command, option
+from tabulate import tabulate
+
+from dxr.app import make_app
+from dxr.build import index_and_deploy_tree
+from dxr.config import Config
+
+
+# Regex searches of varying selectivity, from ones whose trigrams leave few
+# false positives to ones which match nearly every candidate. (Spaces would
+# split them into several terms, hence the \s.)
+QUERIES = [r'regexp:widget_\d+_frob\(',
+           r'regexp:return\s(gizmo|widget)\d+;',
+           r'regexp:int\s\w+\s=\sfrob',
+           r'regexp:node,\s\w+\);',
+           r'regexp:int\s\w+']
+
+WORDS = ['widget', 'gizmo', 'frob', 'count', 'total', 'buffer', 'index',
+         'value', 'result', 'node']
+
+LINES_PER_FILE = 200
+
+
+def synthetic_line(random):
+    """Return a plausible line of C, built from a small vocabulary so that
+    trigrams recur a lot, as they do in real code."""
+    a, b, c = (random.choice(WORDS) for _ in xrange(3))
+    n = random.randint(0, 999)
+    return random.choice([
+        '    int %s_%s_%s = %s(%s, %s);' % (a, n, b, c, a, b),
+        '    return %s%s;' % (a, n),
+        '    if (%s_%s > %s) { %s++; }' % (a, n, b, c),
+        '    %s_%s_frob(%s%03d);' % (a, n, b, n),
+        '    /* %s %s %s */' % (a, b, c)])
+
+
+def make_tree(folder, files):
+    """Write ``files`` synthetic C files into ``folder``."""
+    random = Random(0)
+    for i in xrange(files):
+        with open(join(folder, 'file%s.c' % i), 'w') as file:
+            file.write('\n'.join(synthetic_line(random)
+                                 for _ in xrange(LINES_PER_FILE)) + '\n')
+
+
+def config(folder, es_hosts, verification):
+    return Config({
+        'DXR': {
+            'enabled_plugins': '',
+            'temp_folder': join(folder, 'temp'),
+            'log_folder': join(folder, 'logs'),
+            'es_hosts': es_hosts,
+            'es_index': 'dxr_bench_{format}_{tree}_{unique}',
+            'es_alias': 'dxr_bench_{format}_{tree}',
+            'es_catalog_index': 'dxr_bench_catalog',
+            'regex_verification': verification,
+            'search_cache_size': 0,
+            'workers': 0
+        },
+        'code': {
+            'source_folder': join(folder, 'code'),
+            'build_command': ''
+        }
+    }, relative_to=folder)
+
+
+def median_seconds(client, query, repeat):
+    """Return the median wall time of a search, and its last response."""
+    times = []
+    for _ in xrange(repeat):
+        start = time()
+        response = client.get('/code/search',
+                              query_string={'q': query, 'redirect': 'false'},
+                              headers={'Accept': 'application/json'})
+        times.append(time() - start)
+    if response.status_code != 200:
+        raise RuntimeError('%s returned %s: %s' %
+                           (query, response.status, response.data))
+    return sorted(times)[len(times) // 2], response.data
+
+
+@command()
+@option('--es-hosts',
+        help='ES to index into and search. Default: a temporary SQLite '
+             'database')
+@option('--files', default=100, help='How many 200-line files to make')
+@option('--repeat', default=5, help='How many times to run each search')
+def main(es_hosts, files, repeat):
+    folder = mkdtemp()
+    try:
+        mkdir(join(folder, 'code'))
+        make_tree(join(folder, 'code'), files)
+        es_hosts = es_hosts or 'sqlite:///' + join(folder, 'es.sqlite')
+        configs = dict((v, config(folder, es_hosts, v))
+                       for v in ['script', 'python'])
+        index_and_deploy_tree(configs['script'].trees['code'])
+
+        rows = []
+        for query in QUERIES:
+            row = [query]
+            for verification in ['script', 'python']:
+                client = make_app(configs[verification]).test_client()
+                seconds, _ = median_seconds(client, query, repeat)
+                row.append('%.1f' % (seconds * 1000))
+            rows.append(row)
+        print tabulate(rows,
+                       headers=['Query', 'script (ms)', 'python (ms)'])
+    finally:
+        rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()